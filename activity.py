@@ -1,10 +1,11 @@
 from uuid import uuid4
 from datetime import datetime
 from enum import Enum
-from sqlalchemy import Column, Integer, String, ForeignKey, DateTime
+from sqlalchemy import Column, Integer, String, ForeignKey, Date, DateTime, Index, case, cast, func, type_coerce
 from sqlalchemy import Enum as SqlEnum
+from sqlalchemy.ext.hybrid import hybrid_property
 
-from imports import Base
+from imports import Base, activity_storage
 
 
 class Category(Enum):
@@ -22,6 +23,7 @@ class Category(Enum):
     displayed_activity = 6
     deleted_activity = 7
     user_deleted = 8
+    logged_out = 9
 
     # habit module activities
     created_habit = 10
@@ -38,6 +40,11 @@ class Category(Enum):
     displayed_the_longest_streak_of_habit = 22
     displayed_the_habit_with_the_longest_streak = 23
     displayed_activity_on_habit = 24
+    displayed_streak_leaderboard = 25
+    displayed_habit_adherence = 26
+    displayed_completion_heatmap = 27
+    displayed_completion_trend = 28
+    displayed_habit_stats = 29
 
     @staticmethod
     def from_string(s):
@@ -54,6 +61,16 @@ class Category(Enum):
             raise ValueError()
 
 
+# activities that only record that something was looked at, their audit can be relaxed (see dbutil.audit_activity) and
+# old ones are kept as daily counts (see retention.py)
+read_categories = [Category.displayed_user_info, Category.displayed_activity, Category.displayed_habit,
+                   Category.displayed_habits, Category.displayed_habits_with_periodicity,
+                   Category.displayed_the_longest_streak_of_habit, Category.displayed_the_habit_with_the_longest_streak,
+                   Category.displayed_activity_on_habit, Category.displayed_streak_leaderboard,
+                   Category.displayed_habit_adherence, Category.displayed_completion_heatmap,
+                   Category.displayed_completion_trend, Category.displayed_habit_stats]
+
+
 class Activity(Base):
     """
     SQL Alchemy ORM model for 'Activity' objects
@@ -62,10 +79,17 @@ class Activity(Base):
     __tablename__ = "Activity"
     activity_id = Column(Integer, primary_key=True)
     category = Column(SqlEnum(Category))
-    description = Column(String)
+    _description = Column('description', String)
     timestamp = Column(DateTime, nullable=False)
     user_id = Column(Integer, ForeignKey("User.user_id", ondelete='cascade'), nullable=False)
     habit_id = Column(Integer, ForeignKey("Habit.habit_id", ondelete='cascade'))
+    periodicity = Column(String)
+
+    # activity history of a user or a habit is always read in chronological order, the oldest activities are rolled
+    # up and archived (see retention.py)
+    __table_args__ = (Index('ix_activity_user_id_timestamp', 'user_id', 'timestamp'),
+                      Index('ix_activity_habit_id_timestamp', 'habit_id', 'timestamp'),
+                      Index('ix_activity_timestamp', 'timestamp'))
 
     def __init__(self, category, user_id, habit_id=None, periodicity=None, timestamp=None):
         """
@@ -83,28 +107,129 @@ class Activity(Base):
         self.category = category
         self.user_id = user_id
         self.habit_id = habit_id
+        self.periodicity = periodicity
         self.timestamp = current_time if timestamp is None else timestamp
 
-        # create a meaningful description based on the activity
+        # store a meaningful description based on the activity, in compact storage it is rendered on read instead
+        if activity_storage == 'verbose':
+            self._description = Activity.render_description(self.category, self.user_id, self.habit_id,
+                                                            self.periodicity, self.timestamp)
+
+    @staticmethod
+    def render_description(category, user_id, habit_id, periodicity, timestamp):
+        """
+        Helper function to create a meaningful description of an activity from its attributes.
+
+        :param category: enum for activity category
+        :param user_id: id of the user the activity belongs to
+        :param habit_id: id of the habit if the activity is related to a habit
+        :param periodicity: periodicity of a habit
+        :param timestamp: when the activity occurred
+        :return: description of the activity
+        """
+
         if category == Category.user_registered:
-            self.description = "A new user registered in the database with id {0} at {1}".format(self.user_id,
-                                                                                                 self.timestamp)
+            return "A new user registered in the database with id {0} at {1}".format(user_id, timestamp)
         elif category == Category.user_deleted:
-            self.description = "User {0} deleted their account at {1}".format(self.user_id,
-                                                                              self.timestamp)
+            return "User {0} deleted their account at {1}".format(user_id, timestamp)
+        elif habit_id is not None:
+            return "User {0} {1} {2} at {3}".format(user_id, category.name.replace('_', ' '), habit_id, timestamp)
+        elif periodicity is not None:
+            return "User {0} {1} '{2}' at {3}".format(user_id, category.name.replace('_', ' '), periodicity, timestamp)
         else:
-            if habit_id is None:
-                if periodicity is None:
-                    self.description = "User {0} {1} at {2}".format(self.user_id,
-                                                                    self.category.name.replace('_', ' '),
-                                                                    self.timestamp)
-                else:
-                    self.description = "User {0} {1} '{2}' at {3}".format(self.user_id,
-                                                                          self.category.name.replace('_', ' '),
-                                                                          periodicity,
-                                                                          self.timestamp)
-            else:
-                self.description = "User {0} {1} {2} at {3}".format(self.user_id,
-                                                                    self.category.name.replace('_', ' '),
-                                                                    self.habit_id,
-                                                                    self.timestamp)
+            return "User {0} {1} at {2}".format(user_id, category.name.replace('_', ' '), timestamp)
+
+    @hybrid_property
+    def description(self):
+        """
+        Description of the activity, the stored one or rendered from the structured columns in compact storage.
+        """
+
+        if self._description is not None:
+            return self._description
+        return Activity.render_description(self.category, self.user_id, self.habit_id, self.periodicity,
+                                           self.timestamp)
+
+    @description.setter
+    def description(self, value):
+        self._description = value
+
+    @description.expression
+    def description(cls):
+        return func.coalesce(cls._description, cls.rendered_description()).label('description')
+
+    @classmethod
+    def rendered_description(cls, columns=None):
+        """
+        SQL version of render_description() for queries and migrations.
+
+        :param columns: activity columns of another table, e.g. ActivityArchive.__table__.c, the ones of 'Activity' if
+            None
+        :return: SQL expression of the rendered description
+        """
+
+        columns = cls if columns is None else columns
+
+        # SQLite stores timestamps as 'YYYY-MM-DD HH:MM:SS.ffffff' while str(datetime) omits zero microseconds
+        timestamp = type_coerce(columns.timestamp, String)
+        timestamp = case((func.substr(timestamp, 21) == '000000', func.substr(timestamp, 1, 19)), else_=timestamp)
+        user_id = cast(columns.user_id, String)
+        category = func.replace(type_coerce(columns.category, String), '_', ' ')
+
+        return case(
+            (columns.category == Category.user_registered,
+             'A new user registered in the database with id ' + user_id + ' at ' + timestamp),
+            (columns.category == Category.user_deleted,
+             'User ' + user_id + ' deleted their account at ' + timestamp),
+            (columns.habit_id.isnot(None),
+             'User ' + user_id + ' ' + category + ' ' + cast(columns.habit_id, String) + ' at ' + timestamp),
+            (columns.periodicity.isnot(None),
+             'User ' + user_id + ' ' + category + " '" + columns.periodicity + "' at " + timestamp),
+            else_='User ' + user_id + ' ' + category + ' at ' + timestamp)
+
+
+def describe(category, user_id, habit_id, timestamp):
+    """
+    Helper function to create the stored description of an activity inserted in bulk.
+
+    :param category: activity category
+    :param user_id: id of the user the activity belongs to
+    :param habit_id: id of the habit if the activity is related to a habit
+    :param timestamp: when the activity occurred
+    :return: description of the activity, None in compact storage
+    """
+
+    if activity_storage == 'compact':
+        return None
+    return Activity.render_description(category, user_id, habit_id, None, timestamp)
+
+
+class ActivityRollup(Base):
+    """
+    SQL Alchemy ORM model for daily counts of rolled up 'Activity' records per user and category
+    """
+
+    __tablename__ = "ActivityRollup"
+    user_id = Column(Integer, ForeignKey("User.user_id", ondelete='cascade'), primary_key=True)
+    day = Column(Date, primary_key=True)
+    category = Column(SqlEnum(Category), primary_key=True)
+    count = Column(Integer, nullable=False)
+
+
+class ActivityArchive(Base):
+    """
+    SQL Alchemy ORM model for archived 'Activity' records, the columns are copied as they are
+    """
+
+    __tablename__ = "ActivityArchive"
+    activity_id = Column(Integer, primary_key=True)
+    category = Column(SqlEnum(Category))
+    description = Column(String)
+    timestamp = Column(DateTime, nullable=False)
+    user_id = Column(Integer, nullable=False)
+    habit_id = Column(Integer)
+    periodicity = Column(String)
+
+    __table_args__ = (Index('ix_activityarchive_user_id_timestamp', 'user_id', 'timestamp'),
+                      Index('ix_activityarchive_habit_id_timestamp', 'habit_id', 'timestamp'),
+                      Index('ix_activityarchive_timestamp', 'timestamp'))
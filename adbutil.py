@@ -0,0 +1,269 @@
+"""
+    Asyncio variant of the dbutil API for embedding the Habit Tracker in async services (requires aiosqlite)
+
+    The functions mirror their dbutil counterparts and share the ORM models, the snapshot cache and the activity
+    semantics: the activities logged by the model methods are committed in the transaction of the action.
+"""
+
+import asyncio
+import sys
+from contextlib import asynccontextmanager
+from contextvars import ContextVar
+from sqlalchemy import exc, inspect, delete
+from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
+from sqlalchemy.orm import sessionmaker, selectinload
+from sqlalchemy.orm.attributes import set_committed_value
+
+import authutil
+import dbutil
+import imports
+import tokenutil
+from activity import Activity, ActivityArchive, ActivityRollup, Category
+from habit import Habit
+from user import User
+
+
+def create_async_tuned_engine(url, profile):
+    """
+    Function to create an async database engine which applies the pragmas of an engine profile on connect.
+
+    :param url: database url of the synchronous driver, e.g. 'sqlite:///Habit_Tracker.db'
+    :param profile: dictionary of SQLite pragmas and their values
+    :return async_engine: async database engine using aiosqlite
+    """
+
+    async_engine = create_async_engine(url.replace('sqlite://', 'sqlite+aiosqlite://', 1))
+    imports.apply_profile(async_engine.sync_engine, profile)
+
+    return async_engine
+
+
+# initialize async db engine on the same database as dbutil
+async_engine = create_async_tuned_engine(imports.db_url, imports.engine_profile)
+AsyncSessionMaker = sessionmaker(bind=async_engine, class_=AsyncSession, expire_on_commit=False)
+
+# async session of the unit of work in progress
+_current_session = ContextVar('current_async_session', default=None)
+
+
+@asynccontextmanager
+async def unit_of_work():
+    """
+    Async database utility context manager to run one action in a single transaction, see dbutil.unit_of_work().
+    The synchronous session behind the async session is registered as dbutil's unit of work as well, so that the
+    activities logged by the model methods (e.g. Habit.complete()) are committed with the action instead of being
+    buffered. Every task runs in its own context, concurrent tasks get their own sessions.
+
+    :return session: the shared async session
+    """
+
+    session = _current_session.get()
+    if session is not None:
+        # join the unit of work in progress
+        yield session
+        return
+
+    session = AsyncSessionMaker()
+    token = _current_session.set(session)
+    sync_token = dbutil._current_session.set(session.sync_session)
+
+    try:
+        yield session
+        await session.commit()
+
+    except BaseException:
+        await session.rollback()
+        raise
+
+    finally:
+        dbutil._current_session.reset(sync_token)
+        _current_session.reset(token)
+        await session.close()
+
+    # the functions registered with dbutil.after_commit(), e.g. by the model methods, may block
+    await asyncio.to_thread(dbutil.run_after_commit, session.sync_session)
+
+
+async def authenticate(email, password):
+    """
+    Async authorization function to check user credentials, see authutil.authenticate(). The check runs in a thread
+    and the password is hashed in the verifier pool, so that the event loop keeps serving other tasks meanwhile.
+
+    :param email: user email
+    :param password: user password
+    :return user_id: id of the user as a 1-tuple, None if the credentials are wrong
+    """
+
+    return await asyncio.to_thread(authutil.authenticate, email, password)
+
+
+async def insert_into_db(obj):
+    """
+    Async database utility function to insert an object into the database.
+
+    :param obj: object
+    """
+
+    try:
+        async with unit_of_work() as session:
+            # insert the object into the database
+            session.add(obj)
+            await session.flush()
+
+    except exc.IntegrityError:
+        # catch to prevent duplicate errors for unique fields in the database
+        print('ERROR: This entity already exist in the database.')
+        raise
+
+
+async def fetch_from_db(obj_id, obj_type):
+    """
+    Async database utility function to retrieve an object from the database, read through dbutil's snapshot cache
+    outside a unit of work.
+
+    :param obj_id: object id
+    :param obj_type: object type (class name)
+    """
+
+    key = dbutil.snapshot_key(obj_type, obj_id)
+    cached = key is not None and _current_session.get() is None
+    snapshot = dbutil.snapshot_cache.get(key) if cached else None
+
+    async with unit_of_work() as session:
+        if snapshot is None:
+            generation = dbutil.snapshot_cache.generation
+            # retrieve the object from the database
+            obj = await session.get(obj_type, obj_id)
+            snapshot = {column.key: getattr(obj, column.key) for column in inspect(obj_type).column_attrs}
+            if cached:
+                dbutil.snapshot_cache.put(key, snapshot, generation)
+
+        # display a detached copy of the snapshot, the activity is committed with the session
+        obj = obj_type.__mapper__.class_manager.new_instance()
+        for name, value in snapshot.items():
+            set_committed_value(obj, name, value)
+        obj.display()
+
+
+async def update_in_db(obj_id, obj_type, values):
+    """
+    Async database utility function to update an object in the database.
+
+    :param obj_id: object id
+    :param obj_type: object type (class name)
+    :param values: new attribute values
+    """
+
+    async with unit_of_work() as session:
+        # update the object in the database, the related activities are committed in the same transaction. editing
+        # hashes passwords and reschedules jobs, it runs in a thread to keep the event loop free
+        obj = await session.get(obj_type, obj_id)
+        await asyncio.to_thread(obj.edit, *values)
+
+    dbutil.snapshot_cache.invalidate(obj_type, obj_id)
+
+
+async def complete_in_db(obj_id, obj_type):
+    """
+    Async database utility function to update the parameters of an object in the database due to 'complete' action.
+
+    :param obj_id: object id
+    :param obj_type: object type (class name)
+    """
+
+    async with unit_of_work() as session:
+        # update the parameters of the object in the database due to complete action. the statistics of a habit are
+        # loaded with it, complete() can't load them lazily in an async session
+        options = [selectinload(Habit.stats)] if obj_type is Habit else []
+        obj = await session.get(obj_type, obj_id, options=options)
+        obj.complete()
+
+    dbutil.snapshot_cache.invalidate(obj_type, obj_id)
+
+
+async def delete_from_db(obj_id, obj_type):
+    """
+    Async database utility function to delete an object in the database.
+
+    :param obj_id: object id
+    :param obj_type: object type (class name)
+    """
+
+    # write activities buffered by synchronous callers first, the deletion cascades to them
+    await asyncio.to_thread(dbutil.activity_logger.flush)
+
+    async with unit_of_work() as session:
+        # delete the object from the database, the cascade is loaded by the async session
+        obj = await session.get(obj_type, obj_id)
+        await session.delete(obj)
+
+        # the rolled up and archived activities are not covered by the cascade
+        if obj_type is User:
+            await session.execute(delete(ActivityRollup).where(ActivityRollup.user_id == obj_id))
+            await session.execute(delete(ActivityArchive).where(ActivityArchive.user_id == obj_id))
+        elif obj_type is Habit:
+            await session.execute(delete(ActivityArchive).where(ActivityArchive.habit_id == obj_id))
+
+    dbutil.snapshot_cache.invalidate(obj_type, obj_id)
+    if obj_type is User:
+        # the habits of the user are deleted as well
+        dbutil.snapshot_cache.invalidate(Habit)
+        # sign the user out everywhere
+        await asyncio.to_thread(tokenutil.token_store.revoke, user_id=obj_id)
+
+
+async def iter_activity(user_id, habit_id=None, start=None, end=None, categories=None, page_size=500):
+    """
+    Async database utility function to read the activity of a user page by page, see dbutil.iter_activity().
+
+    :param user_id: user id
+    :param habit_id: habit id, all activities of the user if None
+    :param start: earliest timestamp (inclusive)
+    :param end: latest timestamp (exclusive)
+    :param categories: list of activity categories, all categories if None
+    :param page_size: number of activities per page
+    :return: async generator of pages, lists of rows with timestamp, activity_id, category and description
+    """
+
+    # write activities buffered by synchronous callers first to read the complete history
+    await asyncio.to_thread(dbutil.activity_logger.flush)
+
+    query = dbutil.activity_query(user_id, habit_id=habit_id, start=start, end=end, categories=categories,
+                                  page_size=page_size)
+
+    page = None
+    while page is None or len(page) == page_size:
+        async with AsyncSessionMaker() as session:
+            # continue after the last activity of the previous page
+            page = (await session.execute(query if page is None else dbutil.next_page_query(query, page))).fetchall()
+
+        if len(page) != 0:
+            yield page
+
+
+async def display_activity(user_id, start=None, end=None, categories=None, page_size=500, file=None):
+    """
+    Async database utility function to fetch and display user activity page by page.
+
+    :param user_id: user id
+    :param start: earliest timestamp (inclusive)
+    :param end: latest timestamp (exclusive)
+    :param categories: list of activity categories, all categories if None
+    :param page_size: number of activities read and written at once
+    :param file: text stream to write to, stdout if None
+    """
+
+    file = sys.stdout if file is None else file
+
+    # stream user activity descriptions ordered by timestamp
+    print()
+    count = 0
+    async for page in iter_activity(user_id, start=start, end=end, categories=categories, page_size=page_size):
+        file.write(''.join(row.description + '\n' for row in page))
+        count += len(page)
+    if count == 0:
+        print('This user has no recorded activity!')
+
+    # create related activity and insert into database table 'Activity'
+    async with unit_of_work():
+        dbutil.log_activity(Activity(category=Category.displayed_activity, user_id=user_id))
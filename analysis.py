@@ -1,13 +1,12 @@
-import pandas
 from tabulate import tabulate
 from sqlalchemy import select, and_, func
 
 import dbutil
-from habit import Habit, Periodicity
+from habit import Habit, HabitStats, Periodicity
 from activity import Activity, Category
 
 
-def list_habits(user_id, periodicity=None):
+def list_habits(user_id, periodicity=None, display=True):
     """
     Analysis function to display the tracked habits of the current user. It can print out the results for the below
     commands:
@@ -16,38 +15,42 @@ def list_habits(user_id, periodicity=None):
 
     :param user_id: current user
     :param periodicity: enumeration [daily/weekly]
+    :param display: if False, the results are only returned
+    :return results: rows of the listed habits, None if the periodicity is invalid
     """
 
-    session = dbutil.Session(autoflush=True)
+    results = None
 
     try:
-        if periodicity is None:
-            # list_my_habits
-            results = session.execute(select(Habit.habit_id, Habit.name).where(Habit.user_id == user_id)).fetchall()
-            headers = ['ID', 'Name']
-
-            # create related activity
-            activity = Activity(category=Category.displayed_habits, user_id=user_id)
-
-        else:
-            # list_my_habits_with_periodicity
-            results = session.execute(select(Habit.habit_id, Habit.name, Habit.periodicity).where(and_(
-                Habit.user_id == user_id, Habit.periodicity == Periodicity.from_string(periodicity)))).fetchall()
-            headers = ['ID', 'Name', 'Periodicity']
-
-            # create related activity
-            activity = Activity(category=Category.displayed_habits_with_periodicity, user_id=user_id,
-                                periodicity=periodicity)
-
-        if len(results) != 0:
-            # print the results in a tabular form
-            df = pandas.DataFrame(results, columns=headers)
-            print(tabulate(df, showindex=False, headers=df.columns, colalign=("left",)))
-        else:
-            print("\nYou don't have any habits!")
-
-        # insert activity into database table 'Activity'
-        dbutil.insert_into_db(activity)
+        with dbutil.unit_of_work(read_only=True) as session:
+            if periodicity is None:
+                # list_my_habits
+                results = session.execute(
+                    select(Habit.habit_id, Habit.name).where(Habit.user_id == user_id)).fetchall()
+                headers = ['ID', 'Name']
+
+                # create related activity
+                activity = Activity(category=Category.displayed_habits, user_id=user_id)
+
+            else:
+                # list_my_habits_with_periodicity
+                results = session.execute(select(Habit.habit_id, Habit.name, Habit.periodicity).where(and_(
+                    Habit.user_id == user_id, Habit.periodicity == Periodicity.from_string(periodicity)))).fetchall()
+                headers = ['ID', 'Name', 'Periodicity']
+
+                # create related activity
+                activity = Activity(category=Category.displayed_habits_with_periodicity, user_id=user_id,
+                                    periodicity=periodicity)
+
+            if display:
+                if len(results) != 0:
+                    # print the results in a tabular form
+                    print(tabulate(results, headers=headers, colalign=("left",)))
+                else:
+                    print("\nYou don't have any habits!")
+
+            # insert activity into database table 'Activity'
+            dbutil.log_activity(activity)
 
     except ValueError:
         # catch invalid periodicity input
@@ -58,11 +61,10 @@ def list_habits(user_id, periodicity=None):
     #     print('\nERROR: Something went wrong!')
     #     exit()
 
-    finally:
-        session.close()
+    return results
 
 
-def get_longest_streak(user_id, habit_id=None):
+def get_longest_streak(user_id, habit_id=None, display=True):
     """
     Analysis function to display the longest streak of the tracked habits of the current user. It can print out the
     results for the below commands:
@@ -71,16 +73,18 @@ def get_longest_streak(user_id, habit_id=None):
 
     :param user_id: current user
     :param habit_id: id of a specific habit
+    :param display: if False, the results are only returned
+    :return results: rows of habit names and longest streaks
     """
 
-    session = dbutil.Session(autoflush=True)
-
-    try:
+    with dbutil.unit_of_work(read_only=True) as session:
         if habit_id is None:
-            # get_the_habit_with_the_longest_streak
+            # get_the_habit_with_the_longest_streak, the maximum of the user is found in the index on
+            # (user_id, longest_streak)
             results = session.execute(select(Habit.name, Habit.longest_streak).where(and_(
                 Habit.user_id == user_id,
-                Habit.longest_streak == select(func.max(Habit.longest_streak)).scalar_subquery()))).fetchall()
+                Habit.longest_streak == select(func.max(Habit.longest_streak)).where(
+                    Habit.user_id == user_id).scalar_subquery()))).fetchall()
             headers = ['Name', 'Longest Streak']
 
             # create related activity
@@ -97,58 +101,130 @@ def get_longest_streak(user_id, habit_id=None):
             activity = Activity(category=Category.displayed_the_longest_streak_of_habit, user_id=user_id,
                                 habit_id=habit_id)
 
-        if len(results) != 0:
-            # print the results in a tabular form
-            df = pandas.DataFrame(results, columns=headers)
-            print(tabulate(df, showindex=False, headers=df.columns, colalign=('left', 'left')))
-        else:
-            print('\nThis habit does not exist!')
+        if display:
+            if len(results) != 0:
+                # print the results in a tabular form
+                print(tabulate(results, headers=headers, colalign=('left', 'left')))
+            else:
+                print('\nThis habit does not exist!')
 
         # insert activity into database table 'Activity'
-        dbutil.insert_into_db(activity)
+        dbutil.log_activity(activity)
 
-    # except:
-    #     # safely exit the app in case of other exceptions
-    #     print('\nERROR: Something went wrong!.')
-    #     exit()
+    return results
 
-    finally:
-        session.close()
 
+def streak_leaderboard(user_id=None, limit=10, display=True):
+    """
+    Analysis function to display the habits with the longest streaks, either of the current user
+    (get_my_streak_leaderboard) or of all users. The top habits are read from the end of the indexes on
+    (user_id, longest_streak) and (longest_streak), so the query does not scan the table.
+
+    :param user_id: current user, None for the global leaderboard of all users (e.g. for admins)
+    :param limit: number of habits in the leaderboard
+    :param display: if False, the results are only returned
+    :return results: rows of ranks, habit ids, names and longest streaks (and user ids in the global leaderboard)
+    """
 
-def display_activity_on_habit(user_id, habit_id):
+    with dbutil.unit_of_work(read_only=True) as session:
+        if user_id is None:
+            columns = (Habit.user_id, Habit.habit_id, Habit.name, Habit.longest_streak)
+            headers = ['Rank', 'User ID', 'ID', 'Name', 'Longest Streak']
+            query = select(*columns)
+        else:
+            columns = (Habit.habit_id, Habit.name, Habit.longest_streak)
+            headers = ['Rank', 'ID', 'Name', 'Longest Streak']
+            query = select(*columns).where(Habit.user_id == user_id)
+
+        top = query.order_by(Habit.longest_streak.desc(), Habit.habit_id.desc()).limit(limit).subquery()
+        # rank with ties on the small top-k result only
+        results = session.execute(select(
+            func.rank().over(order_by=top.c.longest_streak.desc()).label('rank'),
+            *[top.c[column.key] for column in columns]).order_by(top.c.longest_streak.desc(),
+                                                                 top.c.habit_id.desc())).fetchall()
+
+        if display:
+            if len(results) != 0:
+                # print the results in a tabular form
+                print(tabulate(results, headers=headers, colalign=('left',) * len(headers)))
+            else:
+                print("\nYou don't have any habits!")
+
+        if user_id is not None:
+            # create related activity and insert into database table 'Activity'
+            activity = Activity(category=Category.displayed_streak_leaderboard, user_id=user_id)
+            dbutil.log_activity(activity)
+
+    return results
+
+
+def habit_stats(user_id, habit_id=None, display=True):
+    """
+    Analysis function to display the statistics of the habits of the current user (get_my_habit_stats). They are
+    maintained with every completion and period rollover (see HabitStats), so they are read with one indexed lookup
+    per habit instead of scanning the activities as analytics.habit_adherence() does.
+
+    :param user_id: current user
+    :param habit_id: id of a specific habit, all habits of the user if None
+    :param display: if False, the results are only returned
+    :return results: rows of habit ids, names, periodicities and statistics
     """
-    Analysis function to display the activities the current user performed on a habit.
+
+    with dbutil.unit_of_work(read_only=True) as session:
+        query = select(Habit.habit_id, Habit.name, Habit.periodicity, HabitStats.total_completions,
+                       HabitStats.last_completion, HabitStats.periods, HabitStats.completed_periods,
+                       HabitStats.missed_periods, HabitStats.adherence_rate.label('adherence_rate')).join(
+            HabitStats, HabitStats.habit_id == Habit.habit_id).where(HabitStats.user_id == user_id)
+        if habit_id is not None:
+            query = query.where(Habit.habit_id == habit_id)
+        results = session.execute(query.order_by(Habit.habit_id)).fetchall()
+
+        if display:
+            if len(results) != 0:
+                # print the results in a tabular form
+                print(tabulate([(*row[:2], row.periodicity.name, *row[3:]) for row in results],
+                               headers=['ID', 'Name', 'Periodicity', 'Completions', 'Last Completion', 'Periods',
+                                        'Completed', 'Missed', 'Adherence Rate'], floatfmt='.2f'))
+            else:
+                print("\nYou don't have any habits!")
+
+        # create related activity and insert into database table 'Activity'
+        activity = Activity(category=Category.displayed_habit_stats, user_id=user_id, habit_id=habit_id)
+        dbutil.log_activity(activity)
+
+    return results
+
+
+def display_activity_on_habit(user_id, habit_id, display=True, start=None, end=None, categories=None, page_size=500,
+                              file=None):
+    """
+    Analysis function to display the activities the current user performed on a habit. The activities are streamed
+    page by page (see dbutil.iter_activity()).
 
     :param user_id: current user
     :param habit_id: id of a specific habit
+    :param display: if False, the results are only returned
+    :param start: earliest timestamp (inclusive)
+    :param end: latest timestamp (exclusive)
+    :param categories: list of activity categories, all categories if None
+    :param page_size: number of activities read and written at once
+    :param file: text stream to write to, stdout if None
+    :return results: rows of activity descriptions if display is False, otherwise the number of displayed activities
     """
 
-    session = dbutil.Session(autoflush=True)
+    # display_my_activity_on_a_habit
+    pages = dbutil.iter_activity(user_id, habit_id=habit_id, start=start, end=end, categories=categories,
+                                 page_size=page_size)
 
-    try:
-        # display_my_activity_on_a_habit
-        results = session.execute(
-            select(Activity.description).where(
-                and_(Activity.user_id == user_id, Activity.habit_id == habit_id)).order_by(
-                Activity.timestamp)).fetchall()
-
-        # create related activity
-        activity = Activity(category=Category.displayed_activity_on_habit, user_id=user_id, habit_id=habit_id)
-
-        if len(results) != 0:
-            # print the results in a tabular form
-            print(tabulate(results, tablefmt='simple'))
-        else:
+    if display:
+        results = dbutil.write_activity(pages, file=file)
+        if results == 0:
             print('\nThis user has no recorded activity!')
+    else:
+        results = [row for page in pages for row in page]
 
-        # insert activity into database table 'Activity'
-        dbutil.insert_into_db(activity)
-
-    # except:
-    #     # safely exit the app in case of other exceptions
-    #     print('\nERROR: Something went wrong!.')
-    #     exit()
+    # create related activity and insert into database table 'Activity'
+    activity = Activity(category=Category.displayed_activity_on_habit, user_id=user_id, habit_id=habit_id)
+    dbutil.log_activity(activity)
 
-    finally:
-        session.close()
+    return results
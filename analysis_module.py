@@ -1,4 +1,4 @@
-from analysis import list_habits, get_longest_streak, display_activity_on_habit
+from analysis import list_habits, get_longest_streak, streak_leaderboard, habit_stats, display_activity_on_habit
 
 
 def analysis_module(user_id):
@@ -29,10 +29,27 @@ def analysis_module(user_id):
         elif command == 'get_the_habit_with_the_longest_streak':
             get_longest_streak(user_id=user_id)
 
+        elif command == 'get_my_streak_leaderboard':
+            streak_leaderboard(user_id=user_id)
+
+        elif command == 'get_my_habit_stats':
+            habit_stats(user_id=user_id)
+
         elif command == 'display_my_activity_on_a_habit':
             habit_id = input('Habit ID: ')
             display_activity_on_habit(user_id=user_id, habit_id=habit_id)
 
+        elif command in ('get_my_adherence', 'get_my_completion_heatmap', 'get_my_completion_trend'):
+            # pandas is imported on first use, it would slow down the start of the app
+            import analytics
+
+            if command == 'get_my_adherence':
+                analytics.habit_adherence(user_id=user_id)
+            elif command == 'get_my_completion_heatmap':
+                analytics.completion_heatmap(user_id=user_id)
+            else:
+                analytics.completion_trend(user_id=user_id)
+
         elif command == 'list_analysis_commands':
             print()
             list_analysis_commands()
@@ -56,5 +73,10 @@ def list_analysis_commands():
           '-\tlist_my_habits_with_periodicity',
           '-\tget_the_habit_with_the_longest_streak',
           '-\tget_the_longest_streak_of_a_habit',
+          '-\tget_my_streak_leaderboard',
+          '-\tget_my_habit_stats',
           '-\tdisplay_my_activity_on_a_habit',
+          '-\tget_my_adherence',
+          '-\tget_my_completion_heatmap',
+          '-\tget_my_completion_trend',
           '-\tlist_analysis_commands', sep='\n')
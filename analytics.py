@@ -0,0 +1,224 @@
+"""
+    Completion analytics
+
+    The 'completed_habit' activities of a user, or of all users, are loaded in one query into columnar arrays and
+    evaluated with vectorized pandas/NumPy operations. As in streak.py, the completions are bucketed into periods of the
+    habit periodicity counted from the day the habit was created. The module imports pandas, the interactive menu
+    imports it on first use only.
+"""
+
+import numpy
+import pandas
+from datetime import datetime
+from tabulate import tabulate
+from sqlalchemy import select, union_all
+
+import dbutil
+from activity import Activity, ActivityArchive, Category
+from habit import Habit
+
+weekdays = ['Monday', 'Tuesday', 'Wednesday', 'Thursday', 'Friday', 'Saturday', 'Sunday']
+
+
+def load_completions(user_id=None, now=None):
+    """
+    Analytics function to load the habits and the timestamps of their completions, archived ones included.
+
+    :param user_id: id of the user whose habits are evaluated, all users if None
+    :param now: point in time defining the current period
+    :return habits, completions: data frame of the habits indexed by habit_id with 'name', 'periodicity', 'days' (per
+        period), 'first_day' and 'current_period'; data frame of the completions with 'habit_id', 'timestamp' and
+        'period'
+    """
+
+    now = datetime.now() if now is None else now
+
+    # write pending activities first to evaluate the complete history
+    dbutil.activity_logger.flush()
+
+    with dbutil.unit_of_work(read_only=True) as session:
+        habit_query = select(Habit.habit_id, Habit.name, Habit.periodicity, Habit.time_of_creation)
+        completion_queries = []
+        for model in (Activity, ActivityArchive):
+            completion_query = select(model.habit_id, model.timestamp).where(model.category == Category.completed_habit)
+            if user_id is not None:
+                completion_query = completion_query.where(model.user_id == user_id)
+            completion_queries.append(completion_query)
+        if user_id is not None:
+            habit_query = habit_query.where(Habit.user_id == user_id)
+
+        habits = pandas.DataFrame(session.execute(habit_query).fetchall(),
+                                  columns=['habit_id', 'name', 'periodicity', 'time_of_creation'])
+        completions = pandas.DataFrame(session.execute(union_all(*completion_queries)).fetchall(),
+                                       columns=['habit_id', 'timestamp'])
+
+    habits = habits.set_index('habit_id')
+    habits['days'] = habits['periodicity'].map(lambda periodicity: periodicity.value).astype('int64')
+    habits['first_day'] = pandas.to_datetime(habits['time_of_creation']).dt.normalize()
+    habits['current_period'] = (pandas.Timestamp(now).normalize() - habits['first_day']).dt.days // habits['days']
+    habits = habits.drop(columns='time_of_creation')
+
+    # completions of deleted habits are dropped, later ones than 'now' are not evaluated
+    completions = completions[completions['habit_id'].isin(habits.index)].copy()
+    completions['timestamp'] = pandas.to_datetime(completions['timestamp'])
+    completions = completions[completions['timestamp'] <= pandas.Timestamp(now)]
+    first_day = habits['first_day'].reindex(completions['habit_id']).to_numpy()
+    days = habits['days'].reindex(completions['habit_id']).to_numpy()
+    completions['period'] = (completions['timestamp'].dt.normalize().to_numpy() - first_day) // \
+        numpy.timedelta64(1, 'D') // days
+
+    return habits, completions.reset_index(drop=True)
+
+
+def covered_days(habits, completions, now=None):
+    """
+    Analytics function to expand the completed periods into the days they cover, e.g. the 7 days of a completed
+    week, without a loop over the periods. Days after 'now' are cut off.
+
+    :param habits: habits as returned by load_completions()
+    :param completions: completions as returned by load_completions()
+    :param now: point in time defining the current period
+    :return: data frame with 'habit_id' and 'day' (days before today, 0 is today) of every covered day
+    """
+
+    today = pandas.Timestamp(datetime.now() if now is None else now).normalize()
+
+    periods = completions[['habit_id', 'period']].drop_duplicates()
+    days = habits['days'].reindex(periods['habit_id']).to_numpy()
+    first_day = (today - habits['first_day'].reindex(periods['habit_id'])).dt.days.to_numpy()
+
+    # first covered day of each period counted backwards from today, and the number of days up to today
+    start = first_day - periods['period'].to_numpy() * days
+    lengths = numpy.minimum(days, start + 1).clip(min=0)
+
+    offsets = numpy.arange(lengths.sum()) - numpy.repeat(numpy.cumsum(lengths) - lengths, lengths)
+    return pandas.DataFrame({'habit_id': numpy.repeat(periods['habit_id'].to_numpy(), lengths),
+                             'day': numpy.repeat(start, lengths) - offsets})
+
+
+def habit_adherence(user_id=None, windows=(7, 30), display=True, now=None):
+    """
+    Analytics function to display the completion statistics of the habits of the current user (get_my_adherence):
+        - completions: number of completions, several completions in a period count separately
+        - last_completion: time of the last completion
+        - periods: number of periods since the habit was created, including the current one
+        - missed_periods: past periods without a completion
+        - adherence_rate: share of the completed periods among the past periods and the current one if it is completed
+        - ratio_<n>d: share of the last n days whose period was completed
+
+    :param user_id: current user, all users if None
+    :param windows: lengths in days of the trailing windows of the completion ratios
+    :param display: if False, the results are only returned
+    :param now: point in time defining the current period
+    :return stats: data frame indexed by habit_id
+    """
+
+    habits, completions = load_completions(user_id=user_id, now=now)
+
+    periods = completions[['habit_id', 'period']].drop_duplicates()
+    completed_periods = periods.groupby('habit_id').size().reindex(habits.index, fill_value=0)
+    current_completed = periods[periods['period'].to_numpy() ==
+                                habits['current_period'].reindex(periods['habit_id']).to_numpy()]
+    current_completed = current_completed.groupby('habit_id').size().reindex(habits.index, fill_value=0)
+
+    stats = habits[['name', 'periodicity']].copy()
+    stats['completions'] = completions.groupby('habit_id').size().reindex(habits.index, fill_value=0)
+    stats['last_completion'] = completions.groupby('habit_id')['timestamp'].max().reindex(habits.index)
+    stats['periods'] = habits['current_period'] + 1
+    stats['missed_periods'] = habits['current_period'] - (completed_periods - current_completed)
+    stats['adherence_rate'] = completed_periods / (habits['current_period'] + current_completed).clip(lower=1)
+
+    # covered days in the trailing windows over the days the habit existed in them
+    days = covered_days(habits, completions, now=now)
+    age = (pandas.Timestamp(datetime.now() if now is None else now).normalize() - habits['first_day']).dt.days + 1
+    for window in windows:
+        covered = days[days['day'] < window].groupby('habit_id').size().reindex(habits.index, fill_value=0)
+        stats['ratio_{0}d'.format(window)] = covered / age.clip(upper=window)
+
+    if display:
+        if len(stats) != 0:
+            # print the results in a tabular form
+            print(tabulate(stats.assign(periodicity=stats['periodicity'].map(lambda periodicity: periodicity.name)),
+                           headers='keys', floatfmt='.2f'))
+        else:
+            print("\nYou don't have any habits!")
+
+    if user_id is not None:
+        # create related activity and insert into database table 'Activity'
+        dbutil.log_activity(Activity(category=Category.displayed_habit_adherence, user_id=user_id))
+
+    return stats
+
+
+def completion_heatmap(user_id=None, display=True, now=None):
+    """
+    Analytics function to display the number of completions by weekday and hour of the day
+    (get_my_completion_heatmap).
+
+    :param user_id: current user, all users if None
+    :param display: if False, the results are only returned
+    :param now: completions up to this point in time are counted
+    :return heatmap: data frame of counts with the weekdays as index and the hours as columns
+    """
+
+    _, completions = load_completions(user_id=user_id, now=now)
+
+    cells = completions['timestamp'].dt.weekday.to_numpy() * 24 + completions['timestamp'].dt.hour.to_numpy()
+    heatmap = pandas.DataFrame(numpy.bincount(cells, minlength=7 * 24).reshape(7, 24), index=weekdays)
+
+    if display:
+        if len(completions) != 0:
+            # print the hours with completions only, 24 columns do not fit on a terminal
+            print(tabulate(heatmap.loc[:, heatmap.sum() != 0], headers='keys'))
+        else:
+            print("\nYou haven't completed any habits yet!")
+
+    if user_id is not None:
+        # create related activity and insert into database table 'Activity'
+        dbutil.log_activity(Activity(category=Category.displayed_completion_heatmap, user_id=user_id))
+
+    return heatmap
+
+
+def completion_trend(user_id=None, windows=(7, 30), days=30, display=True, now=None):
+    """
+    Analytics function to display the daily completion ratios over trailing windows (get_my_completion_trend): the
+    share of the days in the window whose period was completed, over all habits existing on those days.
+
+    :param user_id: current user, all users if None
+    :param windows: lengths in days of the trailing windows
+    :param days: number of days up to today in the result
+    :param display: if False, the results are only returned
+    :param now: point in time defining today
+    :return trend: data frame indexed by date with a column 'ratio_<n>d' per window
+    """
+
+    today = pandas.Timestamp(datetime.now() if now is None else now).normalize()
+    habits, completions = load_completions(user_id=user_id, now=now)
+
+    # covered days and existing habits per day, day 0 is the earliest evaluated day
+    span = days + max(windows) - 1
+    covered = covered_days(habits, completions, now=now)['day'].to_numpy()
+    covered = numpy.bincount(span - 1 - covered[covered < span], minlength=span)
+    created = (today - habits['first_day']).dt.days.to_numpy()
+    existing = numpy.bincount(numpy.maximum(span - 1 - created, 0), minlength=span).cumsum()
+
+    trend = pandas.DataFrame(index=pandas.date_range(end=today, periods=span, freq='D'))
+    for window in windows:
+        ratio = pandas.Series(covered).rolling(window, min_periods=1).sum() / \
+            pandas.Series(existing).rolling(window, min_periods=1).sum()
+        trend['ratio_{0}d'.format(window)] = ratio.fillna(0).to_numpy()
+    trend = trend.tail(days)
+
+    if display:
+        if len(habits) != 0:
+            # print the results in a tabular form
+            print(tabulate(trend.set_index(trend.index.date), headers='keys', floatfmt='.2f'))
+        else:
+            print("\nYou don't have any habits!")
+
+    if user_id is not None:
+        # create related activity and insert into database table 'Activity'
+        dbutil.log_activity(Activity(category=Category.displayed_completion_trend, user_id=user_id))
+
+    return trend
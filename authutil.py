@@ -1,9 +1,40 @@
+import hashlib
+import hmac
+import os
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from getpass import getpass
 from sqlalchemy import exc
 
 import dbutil
+import imports
+import tokenutil
 from activity import Activity, Category
-from user import User
+from user import User, hash_password, verify_password, needs_rehash
+
+# threads hashing passwords, the hash releases the GIL so that logins run in parallel with the other requests
+verifier_pool = ThreadPoolExecutor(max_workers=imports.verifier_threads or os.cpu_count(),
+                                   thread_name_prefix='verifier')
+
+# verified passwords by email, kept as a keyed digest of the password and the stored hash. A repeat login with the same
+# password skips the hash as long as the stored hash is unchanged, the key never leaves the process.
+verifier_cache = dbutil.SnapshotCache(max_size=imports.cache_size, ttl=imports.verifier_ttl)
+_verifier_key = os.urandom(32)
+
+# recent failed logins by email
+_failures = {}
+_failures_lock = threading.Lock()
+
+# hash verified for unknown emails, so that they take as long as wrong passwords
+_unknown_user_hash = None
+
+
+class TooManyAttempts(Exception):
+    """
+    Exception raised by authenticate() if an email had too many failed logins recently.
+    """
 
 
 def access():
@@ -44,15 +75,21 @@ def login():
     while login_attempt != 0:
         login_attempt -= 1
         email = input('Email: ')
-        # TODO: password scrambling
         password = getpass()
 
         # check the database for the credentials
-        user_id = authenticate(email, password)
+        try:
+            user_id = authenticate(email, password)
+        except TooManyAttempts:
+            print('Access denied, too many failed logins. Try again later. Goodbye!')
+            exit()
+
         if user_id is not None:
             # create related activity and insert into database table 'Activity'
             activity = Activity(category=Category.logged_in, user_id=user_id[0])
-            dbutil.insert_into_db(activity)
+            dbutil.log_activity(activity)
+            # keep the session for the next runs
+            tokenutil.token_store.issue(user_id[0], session=True)
             print('Login was successful. Welcome!\n')
             return user_id[0]
         elif login_attempt != 0:
@@ -73,39 +110,139 @@ def register():
     email = input('Email: ')
     password = getpass()
     user = User(email, password)
+    user_id = user.user_id
     try:
-        # insert user into the database
-        dbutil.insert_into_db(user)
+        # register the user and the related activity in one transaction. the password is hashed once by User(),
+        # authenticating the new user would hash it again
+        with dbutil.unit_of_work():
+            # insert user into the database
+            dbutil.insert_into_db(user)
 
-        # check if the database is updated with the user credentials
-        user_id = authenticate(email, password)
-        if user_id is not None:
             # create related activity and insert into database table 'Activity'
-            activity = Activity(category=Category.user_registered, user_id=user_id[0])
-            dbutil.insert_into_db(activity)
-            print('Registration was successful. Welcome!\n')
-            return user_id[0]
+            activity = Activity(category=Category.user_registered, user_id=user_id)
+            dbutil.log_activity(activity)
+
+        # keep the session for the next runs
+        tokenutil.token_store.issue(user_id, session=True)
+        print('Registration was successful. Welcome!\n')
+        return user_id
     except exc.IntegrityError:
         exit()
 
 
+def resume_session():
+    """
+    Authorization utility function to resume the session of the last login or registration, checked by its token
+    without querying the database.
+
+    :return user_id: id of the current user, None if there is no valid session
+    """
+
+    return tokenutil.token_store.session()
+
+
+def logout(user_id):
+    """
+    Authorization utility function to end the session of the CLI, the next run asks for the credentials again.
+
+    :param user_id: the current user
+    """
+
+    tokenutil.token_store.end_session()
+    # create related activity and insert into database table 'Activity'
+    dbutil.log_activity(Activity(category=Category.logged_out, user_id=user_id))
+
+
 def authenticate(email, password):
     """
-    Authorization utility function to check if the provided user credentials match the records in the database
+    Authorization utility function to check if the provided user credentials match the records in the database. The
+    user is looked up by the indexed email and the password is verified against the stored hash in the verifier pool.
+    Hashes in plain text or of a lower cost than imports.kdf_iterations are upgraded on success.
 
-    :return user_id: id of the current user
+    :param email: user email
+    :param password: user password
+    :return user_id: id of the current user as a 1-tuple, None if the credentials are wrong
     """
 
-    session = dbutil.Session()
+    check_failures(email)
 
     try:
-        # check the user credentials in the database
-        user_id = session.query(User.user_id).filter(User.email == email, User.password == password).one_or_none()
+        # look up the user (within the registration transaction if there is one)
+        with dbutil.unit_of_work(read_only=True) as session:
+            user = session.query(User.user_id, User.password).filter(User.email == email).one_or_none()
     except exc.MultipleResultsFound:
         # catch if the email is not unique
         print('ERROR: There are multiple entries for this user.')
         exit()
-    finally:
-        session.close()
 
-    return user_id
+    if user is None:
+        global _unknown_user_hash
+        if _unknown_user_hash is None:
+            _unknown_user_hash = hash_password('')
+        verifier_pool.submit(verify_password, password, _unknown_user_hash).result()
+        record_failure(email)
+        return None
+
+    # the keyed digest of a password verified before
+    digest = hmac.new(_verifier_key, user.password.encode() + b'\0' + password.encode(), hashlib.sha256).digest()
+    cached = verifier_cache.get(email)
+    if cached is None or not hmac.compare_digest(cached, digest):
+        generation = verifier_cache.generation
+        if not verifier_pool.submit(verify_password, password, user.password).result():
+            record_failure(email)
+            return None
+        verifier_cache.put(email, digest, generation)
+
+    with _failures_lock:
+        _failures.pop(email, None)
+
+    if needs_rehash(user.password):
+        rehash_password(user.user_id, password)
+
+    return (user.user_id,)
+
+
+def check_failures(email):
+    """
+    Authorization utility function to refuse a login if the email had imports.auth_max_failures failed logins within
+    the last imports.auth_window seconds.
+
+    :param email: user email
+    """
+
+    with _failures_lock:
+        failures = _failures.get(email)
+        if failures is None:
+            return
+        while len(failures) != 0 and failures[0] < time.monotonic() - imports.auth_window:
+            failures.popleft()
+        if len(failures) == 0:
+            del _failures[email]
+        elif len(failures) >= imports.auth_max_failures:
+            raise TooManyAttempts(email)
+
+
+def record_failure(email):
+    """
+    Authorization utility function to record a failed login.
+
+    :param email: user email
+    """
+
+    with _failures_lock:
+        _failures.setdefault(email, deque(maxlen=max(imports.auth_max_failures, 1))).append(time.monotonic())
+
+
+def rehash_password(user_id, password):
+    """
+    Authorization utility function to store the password of a user hashed at the current cost.
+
+    :param user_id: user id
+    :param password: verified password
+    """
+
+    password_hash = verifier_pool.submit(hash_password, password).result()
+    with dbutil.unit_of_work() as session:
+        session.query(User).filter(User.user_id == user_id).update({'password': password_hash},
+                                                                   synchronize_session=False)
+    dbutil.snapshot_cache.invalidate(User, user_id)
@@ -0,0 +1,299 @@
+"""
+    Non-interactive command runner
+
+    Reads one command per JSON line or CSV row and writes one JSON result per command to stdout, e.g.
+
+        {"command": "create_habit", "name": "read", "periodicity": "daily"}
+        {"command": "complete_habit", "habit_id": 1234567890}
+        {"command": "list_my_habits"}
+
+    Usage: python batch.py [--email EMAIL --password PASSWORD | --token TOKEN] [--format jsonl|csv] [--batch-size N]
+                           [FILE]
+
+    Without credentials the commands run as the user of the CLI session (see authutil.resume_session()). Commands
+    can't act as another user, habit commands fail for habits of other users. Scripts
+    calling the runner repeatedly log in once with '--email EMAIL --password PASSWORD --issue-token' and pass the
+    printed token with '--token', which is checked without querying the database.
+"""
+
+import argparse
+import csv
+import json
+import sys
+from contextlib import redirect_stdout
+from datetime import datetime
+from sqlalchemy import exc
+
+import authutil
+import dbutil
+import tokenutil
+from activity import Category
+from analysis import list_habits, get_longest_streak, streak_leaderboard, habit_stats, display_activity_on_habit
+from habit import Habit, Periodicity
+from habit_module import create_habit, delete_habit
+
+# fields holding ids, CSV delivers them as strings
+id_fields = ('habit_id',)
+
+
+def own_habit(user_id, habit_id):
+    """
+    Batch function to check that a habit exists and belongs to the current user.
+
+    :param user_id: the current user
+    :param habit_id: habit id
+    """
+
+    with dbutil.unit_of_work(read_only=True) as session:
+        owner = session.query(Habit.user_id).filter(Habit.habit_id == habit_id).scalar()
+    if owner != user_id:
+        raise ValueError('This Habit ID does not exist!')
+
+
+def run_command(user_id, command, args):
+    """
+    Batch function to execute a single command with the logic of the interactive modules.
+
+    :param user_id: the current user
+    :param command: command name as in the interactive menus
+    :param args: dictionary of command arguments
+    :return result: JSON serializable result of the command
+    """
+
+    if args.get('habit_id') is not None:
+        own_habit(user_id, args['habit_id'])
+
+    if command == 'create_habit':
+        habit_id = create_habit(user_id=user_id, name=args['name'], periodicity=args['periodicity'],
+                                description=args.get('description'))
+        return {'habit_id': habit_id}
+
+    elif command == 'edit_habit':
+        values = (args.get('name'), args.get('description'), args.get('periodicity', ''))
+        dbutil.update_in_db(args['habit_id'], Habit, values)
+        return {'habit_id': args['habit_id']}
+
+    elif command == 'complete_habit':
+        dbutil.complete_in_db(args['habit_id'], Habit)
+        return {'habit_id': args['habit_id']}
+
+    elif command == 'delete_habit':
+        delete_habit(user_id=user_id, habit_id=args['habit_id'])
+        return {'habit_id': args['habit_id']}
+
+    elif command == 'list_my_habits':
+        results = list_habits(user_id=user_id, display=False)
+
+    elif command == 'list_my_habits_with_periodicity':
+        # validate here, list_habits() only prints invalid periodicities
+        Periodicity.from_string(args['periodicity'])
+        results = list_habits(user_id=user_id, periodicity=args['periodicity'], display=False)
+
+    elif command == 'get_the_habit_with_the_longest_streak':
+        results = get_longest_streak(user_id=user_id, display=False)
+
+    elif command == 'get_the_longest_streak_of_a_habit':
+        results = get_longest_streak(user_id=user_id, habit_id=args['habit_id'], display=False)
+
+    elif command == 'get_my_streak_leaderboard':
+        results = streak_leaderboard(user_id=user_id, limit=int(args.get('limit', 10)), display=False)
+
+    elif command == 'get_my_habit_stats':
+        results = habit_stats(user_id=user_id, habit_id=args.get('habit_id'), display=False)
+
+    elif command == 'display_my_activity_on_a_habit':
+        categories = args.get('categories')
+        if isinstance(categories, str):
+            categories = categories.split(',')
+        results = display_activity_on_habit(
+            user_id=user_id, habit_id=args['habit_id'], display=False,
+            start=None if args.get('start') is None else datetime.fromisoformat(args['start']),
+            end=None if args.get('end') is None else datetime.fromisoformat(args['end']),
+            categories=None if categories is None else [Category.from_string(category) for category in categories])
+
+    else:
+        raise ValueError('Invalid command: {0}'.format(command))
+
+    return [dict(row._mapping) for row in results]
+
+
+def read_commands(stream, input_format='jsonl'):
+    """
+    Batch function to parse commands from a stream lazily.
+
+    :param stream: text stream with one command per JSON line or CSV row (with header)
+    :param input_format: 'jsonl' or 'csv'
+    :return: generator of (line number, command dictionary or parse error)
+    """
+
+    if input_format == 'csv':
+        for line_number, record in enumerate(csv.DictReader(stream), start=2):
+            yield line_number, {key: value for key, value in record.items() if value not in ('', None)}
+
+    else:
+        for line_number, line in enumerate(stream, start=1):
+            if line.strip() == '':
+                continue
+            try:
+                yield line_number, json.loads(line)
+            except ValueError as error:
+                yield line_number, error
+
+
+def execute_batch(batch, user_id, output):
+    """
+    Batch function to execute a batch of commands in one transaction and write their results. Each command runs in a
+    savepoint, a failing command is reported and its changes are rolled back. A database error rolls back and fails
+    the whole batch, every command of it is reported as rolled back.
+
+    :param batch: list of (line number, command dictionary or parse error)
+    :param user_id: the current user
+    :param output: text stream for the JSON results
+    :return: number of failed commands
+    """
+
+    results = []
+
+    # activity reads flush the buffered activities through another connection, which would wait for the write lock
+    # of the batch
+    dbutil.activity_logger.flush()
+
+    try:
+        with dbutil.unit_of_work() as session:
+            # pysqlite only begins a transaction before DML, the first savepoint would start (and its release commit)
+            # the transaction otherwise
+            session.connection().exec_driver_sql('BEGIN')
+
+            for line_number, record in batch:
+                result = {'line': line_number}
+                results.append(result)
+                savepoint = session.begin_nested()
+                try:
+                    if isinstance(record, Exception):
+                        raise record
+
+                    args = {key: int(value) if key in id_fields else value for key, value in record.items()}
+                    result['command'] = args.pop('command')
+                    if 'user_id' in args:
+                        raise ValueError('Commands run as the logged in user, user_id is not accepted')
+                    if user_id is None:
+                        raise ValueError('No user, log in with --email/--password or --token')
+
+                    # human readable messages of the reused functions go to stderr
+                    with redirect_stdout(sys.stderr):
+                        result['result'] = run_command(user_id, result['command'], args)
+                    savepoint.commit()
+                    result['status'] = 'ok'
+
+                except exc.DBAPIError as error:
+                    savepoint.rollback()
+                    result.update(status='error', error=repr(error))
+                    raise
+
+                except Exception as error:
+                    savepoint.rollback()
+                    result.update(status='error', error=repr(error))
+
+    except exc.DBAPIError as error:
+        rolled_back = 'transaction rolled back: {0!r}'.format(error)
+        for result in results:
+            result.pop('result', None)
+            if result['status'] == 'ok':
+                result.update(status='error', error=rolled_back)
+
+        # the commands after the failing one didn't run
+        for line_number, record in batch[len(results):]:
+            result = {'line': line_number, 'status': 'error', 'error': 'not executed, ' + rolled_back}
+            if isinstance(record, dict) and 'command' in record:
+                result['command'] = record['command']
+            results.append(result)
+
+    for result in results:
+        output.write(json.dumps(result, default=str) + '\n')
+    output.flush()
+
+    return sum(result['status'] == 'error' for result in results)
+
+
+def run_batch(commands, user_id=None, batch_size=100, output=sys.stdout):
+    """
+    Batch function to execute a stream of commands in transactions of 'batch_size' commands.
+
+    :param commands: iterable of (line number, command dictionary or parse error), see read_commands()
+    :param user_id: the current user
+    :param batch_size: number of commands per transaction
+    :param output: text stream for the JSON results
+    :return: number of failed commands
+    """
+
+    failed = 0
+    batch = []
+    for item in commands:
+        batch.append(item)
+        if len(batch) >= batch_size:
+            failed += execute_batch(batch, user_id, output)
+            batch = []
+
+    if len(batch) != 0:
+        failed += execute_batch(batch, user_id, output)
+
+    return failed
+
+
+def main(argv=None):
+    """
+    Entry point of the non-interactive command runner.
+
+    :param argv: command line arguments
+    :return: exit code, 1 if any command failed
+    """
+
+    parser = argparse.ArgumentParser(description='Run Habit Tracker commands non-interactively.')
+    parser.add_argument('file', nargs='?', help='command file, stdin if omitted')
+    parser.add_argument('--format', choices=('jsonl', 'csv'), default='jsonl', help='input format')
+    parser.add_argument('--batch-size', type=int, default=100, help='commands per transaction')
+    parser.add_argument('--email', help='email of the user running the commands')
+    parser.add_argument('--password', help='password of the user running the commands')
+    parser.add_argument('--token', help='session token of the user running the commands')
+    parser.add_argument('--issue-token', action='store_true', help='log in, print a session token and exit')
+    args = parser.parse_args(argv)
+
+    # start the periods that elapsed since the last run
+    dbutil.catch_up_cycles()
+
+    user_id = None
+    if args.token is not None:
+        user_id = tokenutil.token_store.verify(args.token)
+        if user_id is None:
+            print('ERROR: The token is invalid, expired or revoked.', file=sys.stderr)
+            return 2
+
+    elif args.email is not None:
+        try:
+            user_id = authutil.authenticate(args.email, args.password)
+        except authutil.TooManyAttempts:
+            print('ERROR: Too many failed logins, try again later.', file=sys.stderr)
+            return 2
+        if user_id is None:
+            print('ERROR: Either email or password is wrong.', file=sys.stderr)
+            return 2
+        user_id = user_id[0]
+
+        if args.issue_token:
+            print(tokenutil.token_store.issue(user_id))
+            return 0
+
+    else:
+        user_id = authutil.resume_session()
+
+    stream = sys.stdin if args.file is None else open(args.file, newline='')
+    try:
+        failed = run_batch(read_commands(stream, args.format), user_id=user_id, batch_size=args.batch_size)
+    finally:
+        stream.close()
+
+    return 0 if failed == 0 else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,65 @@
+"""
+    Benchmark of the database size and activity scan speed in verbose and compact activity storage
+
+    A synthetic activity log is generated in verbose storage, measured, migrated with dbutil.compact_activity() and
+    measured again.
+
+    Usage: python bench_activity_storage.py [number of users, ~230 activities each]
+"""
+
+import os
+import sys
+import tempfile
+import time
+
+# keep the benchmark away from the application database
+db_path = os.path.join(tempfile.mkdtemp(), 'bench.db')
+os.environ['HABIT_TRACKER_DB_URL'] = 'sqlite:///' + db_path
+os.environ['HABIT_TRACKER_ACTIVITY_STORAGE'] = 'verbose'
+
+from sqlalchemy import select, text
+
+import dbutil
+from activity import Activity
+from imports import engine
+from loadgen import generate_load
+
+
+def database_size():
+    """
+    Function to measure the size of the database file after a checkpoint of the write-ahead log.
+
+    :return: size in MB
+    """
+
+    with engine.connect() as connection:
+        connection.execute(text('PRAGMA wal_checkpoint(TRUNCATE)'))
+    return os.path.getsize(db_path) / 2 ** 20
+
+
+def scan_seconds(repeat=3):
+    """
+    Function to measure the time to read the descriptions of all activities (the best of 'repeat' runs).
+
+    :param repeat: number of runs
+    :return: seconds
+    """
+
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        with dbutil.unit_of_work(read_only=True) as session:
+            for _ in session.execute(select(Activity.description)):
+                pass
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+if __name__ == '__main__':
+    users = int(sys.argv[1]) if len(sys.argv) > 1 else 1000
+    _, activity_count = generate_load(users=users, seed=0)
+    print('{0} activities'.format(activity_count))
+
+    print('{0:<8} {1:>8.1f} MB {2:>8.3f} s scan'.format('verbose', database_size(), scan_seconds()))
+    dbutil.compact_activity(vacuum=True)
+    print('{0:<8} {1:>8.1f} MB {2:>8.3f} s scan'.format('compact', database_size(), scan_seconds()))
@@ -0,0 +1,67 @@
+"""
+    Benchmark of the logins per second of authutil.authenticate() at chosen costs of the password hash
+
+    For every cost, users are created with passwords hashed at that cost and logged in from concurrent threads, first
+    with an empty verifier cache (every login hashes the password) and again with the verified passwords cached.
+
+    Usage: python bench_auth.py [--iterations 100000 600000] [--users 50] [--threads 4]
+"""
+
+import argparse
+import os
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+# keep the benchmark away from the application database
+os.environ['HABIT_TRACKER_DB_URL'] = 'sqlite:///' + os.path.join(tempfile.mkdtemp(), 'bench.db')
+
+from sqlalchemy import insert
+
+import authutil
+import imports
+from imports import Base, engine
+from user import User, hash_password
+
+
+def logins_per_second(users, threads):
+    """
+    Function to measure the login rate of the users from concurrent threads.
+
+    :param users: list of (email, password)
+    :param threads: number of client threads
+    :return: logins per second
+    """
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=threads) as executor:
+        results = list(executor.map(lambda user: authutil.authenticate(*user), users))
+    seconds = time.perf_counter() - start
+
+    assert None not in results
+    return len(users) / seconds
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the login rate at chosen password hash costs.')
+    parser.add_argument('--iterations', type=int, nargs='+', default=[100000, 600000], help='PBKDF2 iterations')
+    parser.add_argument('--users', type=int, default=50, help='number of users logging in')
+    parser.add_argument('--threads', type=int, default=4, help='number of client threads')
+    args = parser.parse_args()
+
+    Base.metadata.create_all(engine)
+    print('{0} verifier threads, {1} client threads'.format(imports.verifier_threads or os.cpu_count(), args.threads))
+    print('{0:>10} {1:>14} {2:>14}'.format('iterations', 'logins/s', 'cached/s'))
+
+    for iterations in args.iterations:
+        # users of this cost, the stored hashes are already at the cost so that no login rehashes
+        imports.kdf_iterations = iterations
+        password_hash = hash_password('password')
+        users = [('{0}-{1}@example.com'.format(iterations, i), 'password') for i in range(args.users)]
+        with engine.begin() as connection:
+            connection.execute(insert(User), [{'email': email, 'password': password_hash} for email, _ in users])
+
+        # new emails, the first round misses the verifier cache
+        cold = logins_per_second(users, args.threads)
+        cached = logins_per_second(users, args.threads)
+        print('{0:>10} {1:>14.1f} {2:>14.1f}'.format(iterations, cold, cached))
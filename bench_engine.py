@@ -0,0 +1,52 @@
+"""
+    Benchmark of single-row commits per second for each engine profile in imports.engine_profiles
+
+    Usage: python bench_engine.py [number of commits]
+"""
+
+import os
+import sys
+import tempfile
+import time
+
+# keep the benchmark away from the application database
+os.environ.setdefault('HABIT_TRACKER_DB_URL', 'sqlite:///' + os.path.join(tempfile.mkdtemp(), 'bench.db'))
+
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+
+from imports import Base, create_tuned_engine, engine_profiles
+from activity import Activity, Category
+import dbutil  # registers all ORM models
+
+
+def commits_per_second(profile, commits):
+    """
+    Function to measure how many single-activity transactions an engine profile commits per second.
+
+    :param profile: dictionary of SQLite pragmas, None for an engine with SQLAlchemy defaults (no pool, no pragmas)
+    :param commits: number of transactions to run
+    :return: commits per second
+    """
+
+    db_url = 'sqlite:///' + os.path.join(tempfile.mkdtemp(), 'profile.db')
+    bench_engine = create_engine(db_url) if profile is None else create_tuned_engine(db_url, profile)
+    Base.metadata.create_all(bench_engine)
+    BenchSession = sessionmaker(bind=bench_engine)
+
+    start = time.perf_counter()
+    for _ in range(commits):
+        session = BenchSession()
+        session.add(Activity(category=Category.displayed_habit, user_id=1, habit_id=1))
+        session.commit()
+        session.close()
+    elapsed = time.perf_counter() - start
+
+    bench_engine.dispose()
+    return commits / elapsed
+
+
+if __name__ == '__main__':
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 1000
+    for name, engine_profile in [('baseline', None)] + list(engine_profiles.items()):
+        print('{0:<10} {1:>10.0f} commits/s'.format(name, commits_per_second(engine_profile, n)))
@@ -0,0 +1,77 @@
+"""
+    Benchmark suite of the hot paths at growing database sizes (requires pytest-benchmark)
+
+    The database is grown with the synthetic load generator to each size in HABIT_TRACKER_BENCH_SIZES (number of
+    'Activity' rows, default 10^3 to 10^5) and the operations of one user are timed at every size. Per-user operations
+    should stay flat while the tables grow, compare runs with pytest-benchmark's --benchmark-compare.
+
+    Usage: HABIT_TRACKER_BENCH_SIZES=1000,10000,100000,1000000 pytest bench_hotpaths.py --benchmark-autosave
+"""
+
+import os
+import tempfile
+from datetime import datetime
+
+import pytest
+
+pytest.importorskip('pytest_benchmark')
+
+# keep the benchmark away from the application database
+os.environ.setdefault('HABIT_TRACKER_DB_URL', 'sqlite:///' + os.path.join(tempfile.mkdtemp(), 'bench.db'))
+
+from sqlalchemy import func, select
+
+import dbutil
+from activity import Activity
+from analysis import list_habits, get_longest_streak
+from habit import Habit
+from loadgen import generate_load
+
+sizes = [int(size) for size in os.environ.get('HABIT_TRACKER_BENCH_SIZES', '1000,10000,100000').split(',')]
+
+
+@pytest.fixture(scope='module')
+def probe():
+    # the user whose operations are timed, generated first so that the user's data is the same at every size
+    user_ids, _ = generate_load(users=1, habits_per_user=5, weeks=12, seed=0)
+    with dbutil.unit_of_work(read_only=True) as session:
+        habit_id = session.execute(select(Habit.habit_id).where(Habit.user_id == user_ids[0])).scalars().first()
+    return user_ids[0], habit_id
+
+
+@pytest.fixture(scope='module', params=sizes)
+def rows(request, probe):
+    # grow the 'Activity' table to the requested size, the fixture runs for the sizes in ascending order
+    with dbutil.unit_of_work(read_only=True) as session:
+        count = session.execute(select(func.count(Activity.activity_id))).scalar()
+    seed = count
+    while count < request.param:
+        _, activity_count = generate_load(users=max(1, (request.param - count) // 250), weeks=12, seed=seed)
+        count += activity_count
+        seed += 1
+    return count
+
+
+def test_list_habits(benchmark, probe, rows):
+    benchmark.extra_info['rows'] = rows
+    benchmark(list_habits, user_id=probe[0], display=False)
+
+
+def test_get_longest_streak(benchmark, probe, rows):
+    benchmark.extra_info['rows'] = rows
+    benchmark(get_longest_streak, user_id=probe[0], display=False)
+
+
+def test_display_activity(benchmark, probe, rows, capsys):
+    benchmark.extra_info['rows'] = rows
+    benchmark(dbutil.display_activity, user_id=probe[0])
+
+
+def test_complete_in_db(benchmark, probe, rows):
+    benchmark.extra_info['rows'] = rows
+    benchmark(dbutil.complete_in_db, probe[1], Habit)
+
+
+def test_new_cycle(benchmark, probe, rows):
+    benchmark.extra_info['rows'] = rows
+    benchmark(dbutil.new_cycle, probe[1], now=datetime.max)  # rolls over on every call
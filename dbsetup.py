@@ -1,15 +1,32 @@
-import os
+import argparse
 import logging
+import os
 from datetime import datetime, timedelta
 
-from imports import Base, engine, update_scheduler
-from dbutil import Session
+from imports import Base, engine, job_stores, update_scheduler, scheduler_mode, token_store_path
+from dbutil import Session, activity_logger, schedule_sweeper, rebuild_stats
 from habit import Habit, Periodicity
 from user import User
-
-# remove the old database to prevent db integrity errors
-db_path = os.path.join(os.getcwd(), 'Habit_Tracker.db')
-os.remove(db_path)
+from loadgen import generate_load
+from retention import schedule_retention
+
+# optional synthetic load on top of the example data, e.g. 'python dbsetup.py --users 1000 --weeks 52'
+parser = argparse.ArgumentParser(description='Recreate the database with example data.')
+parser.add_argument('--users', type=int, default=0, help='number of synthetic users')
+parser.add_argument('--habits', type=int, default=5, help='habits per synthetic user')
+parser.add_argument('--weeks', type=int, default=12, help='weeks of completion history')
+parser.add_argument('--adherence', type=float, default=0.8, help='probability of a period to be completed')
+parser.add_argument('--seed', type=int, default=None, help='seed for reproducible data')
+args = parser.parse_args()
+
+# drop the old tables (including the persisted jobs) to prevent db integrity errors. the database file itself is kept so
+# that open connections, e.g. the connection pool of a running test session, stay valid
+Base.metadata.drop_all(engine)
+job_stores['default'].jobs_t.drop(engine, checkfirst=True)
+
+# the session tokens belong to the dropped users
+if os.path.exists(token_store_path):
+    os.remove(token_store_path)
 
 # suppress logging of missed jobs. disabling the specific logger didn't work, might be because of threading.
 logging.disable(logging.WARNING)
@@ -18,6 +35,9 @@ logging.disable(logging.WARNING)
 # models
 Base.metadata.create_all(engine)
 update_scheduler.start()  # called here to trigger creation of persistent job db table 'apscheduler_jobs'
+if scheduler_mode == 'sweeper':
+    schedule_sweeper()
+schedule_retention()
 
 
 # function to generate the example objects in the db (called here subsequently)
@@ -62,7 +82,8 @@ def generate_example_data():
                 four_weeks_ago + timedelta(weeks=3))), yoga.update()  # current_streak = 4, longest_streak = 4
         yoga.complete(time_of_completion=datetime.now())  # current_streak = 5, longest_streak = 5
         yoga.next_cycle_start_time = datetime.combine(yoga.next_cycle_start_time.date(), datetime.min.time())
-        update_scheduler.get_job(job_id=yoga.update_job_id).modify(next_run_time=yoga.next_cycle_start_time)
+        if yoga.update_job_id is not None:
+            update_scheduler.modify_job(yoga.update_job_id, next_run_time=yoga.next_cycle_start_time)
         session.commit()
         session.flush()
 
@@ -98,7 +119,8 @@ def generate_example_data():
         water.update()  # current_streak = 0, longest_streak = 7
         water.complete(time_of_completion=datetime.now())  # current_streak = 1, longest_streak = 7
         water.next_cycle_start_time = datetime.combine(water.next_cycle_start_time.date(), datetime.min.time())
-        update_scheduler.get_job(job_id=water.update_job_id).modify(next_run_time=water.next_cycle_start_time)
+        if water.update_job_id is not None:
+            update_scheduler.modify_job(water.update_job_id, next_run_time=water.next_cycle_start_time)
         session.commit()
         session.flush()
 
@@ -113,7 +135,8 @@ def generate_example_data():
                 four_weeks_ago + timedelta(weeks=3))), date_night.update()  # current_streak = 4, longest_streak = 4
         date_night.complete(time_of_completion=datetime.now())  # current_streak = 5, longest_streak = 5
         date_night.next_cycle_start_time = datetime.combine(date_night.next_cycle_start_time.date(), datetime.min.time())
-        update_scheduler.get_job(job_id=date_night.update_job_id).modify(next_run_time=date_night.next_cycle_start_time)
+        if date_night.update_job_id is not None:
+            update_scheduler.modify_job(date_night.update_job_id, next_run_time=date_night.next_cycle_start_time)
         session.commit()
         session.flush()
 
@@ -127,7 +150,8 @@ def generate_example_data():
                 four_weeks_ago + timedelta(weeks=3))), tennis.update()  # current_streak = 1, longest_streak = 2
         tennis.update()  # current_streak = 0, longest_streak = 2
         tennis.next_cycle_start_time = datetime.combine(tennis.next_cycle_start_time.date(), datetime.min.time())
-        update_scheduler.get_job(job_id=tennis.update_job_id).modify(next_run_time=tennis.next_cycle_start_time)
+        if tennis.update_job_id is not None:
+            update_scheduler.modify_job(tennis.update_job_id, next_run_time=tennis.next_cycle_start_time)
         session.commit()
         session.flush()
 
@@ -162,11 +186,18 @@ def generate_example_data():
                 four_weeks_ago + timedelta(days=27))), walk.update()  # current_streak = 1, longest_streak = 9
         walk.complete(time_of_completion=datetime.now())  # current_streak = 2, longest_streak = 9
         walk.next_cycle_start_time = datetime.combine(walk.next_cycle_start_time.date(), datetime.min.time())
-        update_scheduler.get_job(job_id=walk.update_job_id).modify(next_run_time=walk.next_cycle_start_time)
+        if walk.update_job_id is not None:
+            update_scheduler.modify_job(walk.update_job_id, next_run_time=walk.next_cycle_start_time)
         session.commit()
 
         session.close()
 
+        # write the buffered example activities
+        activity_logger.flush()
+
+        # the bulk saved habits were inserted without their statistics, derive them from the example activities
+        rebuild_stats()
+
         print('\nSetup successfully completed!\n')
 
     except:
@@ -174,3 +205,8 @@ def generate_example_data():
 
 
 generate_example_data()
+if args.users > 0:
+    user_ids, activity_count = generate_load(users=args.users, habits_per_user=args.habits, weeks=args.weeks,
+                                             adherence=args.adherence, seed=args.seed)
+    print('Generated {0} users, {1} habits and {2} activities.\n'.format(len(user_ids), len(user_ids) * args.habits,
+                                                                          activity_count))
@@ -1,15 +1,475 @@
-from sqlalchemy import exc, select, delete
+import atexit
+import logging
+import random
+import sys
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+from contextvars import ContextVar
+from datetime import datetime, timedelta
+from sqlalchemy import exc, select, delete, insert, update, case, cast, func, tuple_, union_all, bindparam, inspect, text
+from sqlalchemy import Integer, String
 from sqlalchemy.orm import sessionmaker
+from sqlalchemy.orm.attributes import set_committed_value
 from user import *
 from habit import *
 from activity import *
+import imports
+import tokenutil
 from imports import engine
 
-# create the db tables 'Activity', 'Habit', 'User' from defined SQLAlchemy ORM models (w/o running dbsetup.py)
+
+def migrate_indexes():
+    """
+    Database utility function to add the indexes declared on the ORM models to an existing database. create_all()
+    only creates the indexes of the tables it creates, so databases from older versions would miss them.
+    """
+
+    for table in Base.metadata.sorted_tables:
+        for index in table.indexes:
+            index.create(engine, checkfirst=True)
+
+
+def migrate_columns():
+    """
+    Database utility function to add the nullable columns declared on the ORM models to the tables of an existing
+    database, e.g. 'Activity.periodicity'.
+    """
+
+    inspector = inspect(engine)
+    for table in Base.metadata.sorted_tables:
+        if not inspector.has_table(table.name):
+            continue
+        existing = {column['name'] for column in inspector.get_columns(table.name)}
+        for column in table.columns:
+            if column.name not in existing and column.nullable:
+                with engine.begin() as connection:
+                    connection.execute(text('ALTER TABLE "{0}" ADD COLUMN "{1}" {2}'.format(
+                        table.name, column.name, column.type.compile(engine.dialect))))
+
+
+# create the db tables 'Activity', 'Habit', 'User' from defined SQLAlchemy ORM models (w/o running dbsetup.py) and
+# migrate existing databases
+migrate_columns()
+missing_stats = not inspect(engine).has_table(HabitStats.__tablename__)
 Base.metadata.create_all(engine)
+migrate_indexes()
 
 Session = sessionmaker(bind=engine)
 
+# session of the unit of work in progress, shared by the nested database operations
+_current_session = ContextVar('current_session', default=None)
+
+logger = logging.getLogger(__name__)
+
+
+class ActivityLogger:
+    """
+    Write-behind buffer for 'Activity' records. Activities are kept in memory and inserted in bulk, so that logging
+    an action does not cost a separate database transaction. The buffer is flushed by a background thread when it
+    reaches 'max_batch_size' and every 'flush_interval' seconds, on demand via flush() and on shutdown.
+
+    A batch that fails, e.g. because the database is locked, is kept for the next flush. Activities violating a
+    constraint are dropped (and logged), otherwise they would fail every later flush.
+    """
+
+    def __init__(self, max_batch_size=100, flush_interval=5.0):
+        """
+        Constructor for 'ActivityLogger' class.
+
+        :param max_batch_size: number of buffered activities that triggers a flush
+        :param flush_interval: maximum time in seconds an activity stays in the buffer
+        """
+
+        self.max_batch_size = max_batch_size
+        self.flush_interval = flush_interval
+        self._buffer = []
+        self._lock = threading.RLock()
+        self._stopped = threading.Event()
+        self._full = threading.Event()
+        self._flusher = None
+
+    def log(self, activity):
+        """
+        ActivityLogger class method to buffer an activity.
+
+        :param activity: activity object
+        """
+
+        with self._lock:
+            self._buffer.append(activity)
+            if self._flusher is None:
+                # start the background flushing on first use
+                self._flusher = threading.Thread(target=self._run, name='activity-flusher', daemon=True)
+                self._flusher.start()
+            if len(self._buffer) >= self.max_batch_size:
+                # a full buffer is flushed by the background thread as well, so that a failing flush (e.g. a locked
+                # database) doesn't fail the logged action
+                self._full.set()
+
+    def flush(self):
+        """
+        ActivityLogger class method to synchronously insert all buffered activities into the database.
+        """
+
+        with self._lock:
+            if len(self._buffer) == 0:
+                return
+
+            # keep the insertion order consistent with the activity timestamps
+            batch = sorted(self._buffer, key=lambda activity: activity.timestamp)
+            self._buffer = []
+
+            session = Session(autoflush=True, expire_on_commit=True)
+
+            try:
+                session.bulk_save_objects(batch)
+                session.commit()
+
+            except exc.IntegrityError:
+                # find the offending activities by inserting one by one
+                session.rollback()
+                self._save_each(batch)
+
+            except exc.SQLAlchemyError:
+                # put the batch back so that the activities are not lost
+                session.rollback()
+                self._buffer[:0] = batch
+                raise
+
+            finally:
+                session.close()
+
+    def _save_each(self, batch):
+        """
+        ActivityLogger class method to insert a batch activity by activity, dropping the activities that violate a
+        constraint.
+
+        :param batch: list of activity objects
+        """
+
+        for i, activity in enumerate(batch):
+            session = Session(autoflush=True, expire_on_commit=True)
+
+            try:
+                session.bulk_save_objects([activity])
+                session.commit()
+
+            except exc.IntegrityError as error:
+                session.rollback()
+                logger.error('Dropped activity %s (%s): %s', activity.activity_id, activity.category, error.orig)
+
+            except exc.SQLAlchemyError:
+                session.rollback()
+                self._buffer[:0] = batch[i:]
+                raise
+
+            finally:
+                session.close()
+
+    def close(self):
+        """
+        ActivityLogger class method to stop the background flushing and flush the remaining activities.
+        """
+
+        self._stopped.set()
+        self._full.set()
+        self.flush()
+
+    def _run(self):
+        """
+        Background loop flushing the buffer periodically and when it is full.
+        """
+
+        while True:
+            self._full.wait(self.flush_interval)
+            self._full.clear()
+            if self._stopped.is_set():
+                break
+
+            try:
+                self.flush()
+            except exc.SQLAlchemyError:
+                # the batch stays buffered, the next interval retries it
+                logger.warning('Flushing the activity buffer failed', exc_info=True)
+                self._stopped.wait(self.flush_interval)
+
+
+# shared activity logger, flushed on shutdown
+activity_logger = ActivityLogger()
+atexit.register(activity_logger.close)
+
+
+class SnapshotCache:
+    """
+    LRU cache of object snapshots (dictionaries of the column values) keyed by object type and id, whose entries
+    expire after 'ttl' seconds. The dbutil functions changing an object invalidate its entry after the change, inside
+    a unit of work once it is committed. A snapshot read from the database is only stored if no invalidation happened
+    in the meantime, so that a concurrent change, e.g. by a scheduled job, is not overwritten by an older snapshot.
+    """
+
+    def __init__(self, max_size=1024, ttl=60.0):
+        """
+        Constructor for 'SnapshotCache' class.
+
+        :param max_size: maximum number of entries, 0 disables the cache
+        :param ttl: time in seconds an entry is valid
+        """
+
+        self.max_size = max_size
+        self.ttl = ttl
+        self.generation = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._counters = {'hits': 0, 'misses': 0, 'evictions': 0, 'invalidations': 0}
+
+    def get(self, key):
+        """
+        SnapshotCache class method to look up a snapshot.
+
+        :param key: (object type, object id)
+        :return: snapshot or None
+        """
+
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] > time.monotonic():
+                self._entries.move_to_end(key)
+                self._counters['hits'] += 1
+                return entry[1]
+
+            if entry is not None:
+                del self._entries[key]
+            self._counters['misses'] += 1
+            return None
+
+    def put(self, key, snapshot, generation):
+        """
+        SnapshotCache class method to store a snapshot.
+
+        :param key: (object type, object id)
+        :param snapshot: dictionary of column values
+        :param generation: value of 'generation' before the snapshot was read
+        """
+
+        with self._lock:
+            if self.max_size == 0 or generation != self.generation:
+                return
+
+            self._entries[key] = (time.monotonic() + self.ttl, snapshot)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+                self._counters['evictions'] += 1
+
+    def invalidate(self, obj_type, obj_id=None):
+        """
+        SnapshotCache class method to remove the snapshot of an object or of all objects of a type. Inside a unit of
+        work the snapshot is removed after the commit of the outermost one (see unit_of_work()), until then other
+        threads still read the old values and could cache them again.
+
+        :param obj_type: object type (class name)
+        :param obj_id: object id, all objects of the type if None
+        """
+
+        if _current_session.get() is not None:
+            after_commit(lambda: self.invalidate(obj_type, obj_id))
+            return
+
+        with self._lock:
+            self.generation += 1
+            self._counters['invalidations'] += 1
+            if obj_id is not None:
+                self._entries.pop(snapshot_key(obj_type, obj_id), None)
+            else:
+                for key in [key for key in self._entries if key[0] is obj_type]:
+                    del self._entries[key]
+
+    def stats(self):
+        """
+        SnapshotCache class method to read the counters for monitoring.
+
+        :return: dictionary of hits, misses, evictions, invalidations and the current size
+        """
+
+        with self._lock:
+            return dict(self._counters, size=len(self._entries))
+
+
+def snapshot_key(obj_type, obj_id):
+    """
+    Database utility function to create the cache key of an object, ids entered as strings are converted.
+
+    :param obj_type: object type (class name)
+    :param obj_id: object id
+    :return: (object type, object id) or None if the id is not an integer
+    """
+
+    try:
+        return obj_type, int(obj_id)
+    except (TypeError, ValueError):
+        return None
+
+
+# shared snapshot cache of fetch_from_db
+snapshot_cache = SnapshotCache(max_size=imports.cache_size, ttl=imports.cache_ttl)
+
+
+@contextmanager
+def unit_of_work(read_only=False):
+    """
+    Database utility context manager to run one action in a single transaction. The dbutil functions, nested units
+    of work and the activities logged inside join the session of the outermost unit of work, which is committed once
+    on exit and rolled back on error. The functions registered with after_commit() run after the commit.
+
+    :param read_only: if True, no transaction is committed and the logged activities are buffered as usual
+    :return session: the shared session
+    """
+
+    session = _current_session.get()
+    if session is not None:
+        # join the unit of work in progress
+        yield session
+        return
+
+    session = Session(autoflush=True, expire_on_commit=True)
+    token = None if read_only else _current_session.set(session)
+
+    try:
+        yield session
+        if not read_only:
+            session.commit()
+
+    except BaseException:
+        session.rollback()
+        raise
+
+    finally:
+        if token is not None:
+            _current_session.reset(token)
+        session.close()
+
+    # e.g. the snapshots of the changed objects are removed once the changes are visible to the other connections
+    run_after_commit(session)
+
+
+def after_commit(callback):
+    """
+    Database utility function to run a function once the outermost unit of work is committed, e.g. to act on a change
+    outside the database only if it is stored. Outside a unit of work the function runs at once, after a rollback
+    not at all.
+
+    :param callback: function without arguments
+    """
+
+    session = _current_session.get()
+    if session is None:
+        callback()
+    else:
+        session.info.setdefault('after_commit', []).append(callback)
+
+
+def run_after_commit(session):
+    """
+    Database utility function to run the functions registered with after_commit() once a session is committed.
+
+    :param session: session of the outermost unit of work
+    """
+
+    for callback in session.info.pop('after_commit', []):
+        callback()
+
+
+def parse_audit_policies(spec):
+    """
+    Database utility function to parse audit policies, e.g. 'read=coalesced,displayed_habit=off'. 'read' stands for
+    all read-type categories (see activity.read_categories), later entries override earlier ones.
+
+    :param spec: comma separated list of 'category=policy' with the policies 'always', 'sampled', 'coalesced', 'off'
+    :return policies: dictionary of categories and their policies
+    """
+
+    policies = {}
+    for entry in filter(None, spec.replace(' ', '').split(',')):
+        name, policy = entry.split('=')
+        if policy not in ('always', 'sampled', 'coalesced', 'off'):
+            raise ValueError('Invalid audit policy: {0}'.format(policy))
+
+        categories = read_categories if name == 'read' else [Category.from_string(name)]
+        for category in categories:
+            # changes of the data are always recorded
+            if category not in read_categories and policy != 'always':
+                raise ValueError('Only read-type activities can be sampled, coalesced or turned off: {0}'.format(name))
+            policies[category] = policy
+
+    return policies
+
+
+# audit policy per activity category, categories without a policy are always recorded
+audit_policies = parse_audit_policies(imports.audit_policy)
+audit_sample_rate = imports.audit_sample_rate
+audit_window = timedelta(seconds=imports.audit_window)
+
+# time of the last recorded activity per (user, habit, category) for the 'coalesced' policy
+_last_audited = {}
+_audit_lock = threading.Lock()
+
+
+def audit_activity(activity):
+    """
+    Database utility function to decide with the audit policy of its category whether an activity is recorded:
+        - always: every activity
+        - sampled: a random share 'audit_sample_rate' of the activities
+        - coalesced: the first activity of a user on a habit in every time window 'audit_window'
+        - off: none
+
+    :param activity: activity object
+    :return: True if the activity is recorded
+    """
+
+    policy = audit_policies.get(activity.category, 'always')
+    if policy == 'always':
+        return True
+    elif policy == 'off':
+        return False
+    elif policy == 'sampled':
+        return random.random() < audit_sample_rate
+
+    key = (activity.user_id, activity.habit_id, activity.category)
+    with _audit_lock:
+        last = _last_audited.get(key)
+        if last is not None and activity.timestamp - last < audit_window:
+            return False
+
+        # forget the windows that are over from time to time
+        if len(_last_audited) >= 10000:
+            for stale in [stale for stale, timestamp in _last_audited.items()
+                          if activity.timestamp - timestamp >= audit_window]:
+                del _last_audited[stale]
+
+        _last_audited[key] = activity.timestamp
+        return True
+
+
+def log_activity(activity):
+    """
+    Database utility function to record an activity according to the audit policy of its category (see
+    audit_activity()). Inside a unit of work the activity is committed together with the action, otherwise it is
+    buffered and inserted in bulk later on.
+
+    :param activity: activity object
+    """
+
+    if not audit_activity(activity):
+        return
+
+    session = _current_session.get()
+    if session is not None:
+        session.add(activity)
+    else:
+        activity_logger.log(activity)
+
 
 def insert_into_db(obj):
     """
@@ -18,12 +478,11 @@ def insert_into_db(obj):
     :param obj: object
     """
 
-    session = Session(autoflush=True, expire_on_commit=True)
-
     try:
-        # insert the object into the database
-        session.add(obj)
-        session.commit()
+        with unit_of_work() as session:
+            # insert the object into the database
+            session.add(obj)
+            session.flush()
 
     except exc.IntegrityError:
         # catch to prevent duplicate errors for unique fields in the database
@@ -35,24 +494,34 @@ def insert_into_db(obj):
     #     print('ERROR: Something went wrong with database insertion.')
     #     exit()
 
-    finally:
-        session.close()
-
 
 def fetch_from_db(obj_id, obj_type):
     """
-    Database utility function to retrieve an object from the database.
+    Database utility function to retrieve an object from the database. Outside a unit of work the object is read
+    through the snapshot cache (see SnapshotCache), inside it is always read from the session to see its changes.
 
     :param obj_id: object id
     :param obj_type: object type (class name)
     """
 
-    session = Session(autoflush=True, expire_on_commit=True)
-
-
     try:
-        # retrieve the object from the database
-        obj = session.get(obj_type, obj_id)
+        key = snapshot_key(obj_type, obj_id)
+        cached = key is not None and _current_session.get() is None
+        snapshot = snapshot_cache.get(key) if cached else None
+
+        if snapshot is None:
+            generation = snapshot_cache.generation
+            with unit_of_work(read_only=True) as session:
+                # retrieve the object from the database
+                obj = session.get(obj_type, obj_id)
+                snapshot = {column.key: getattr(obj, column.key) for column in inspect(obj_type).column_attrs}
+            if cached:
+                snapshot_cache.put(key, snapshot, generation)
+
+        # display a detached copy of the snapshot
+        obj = obj_type.__mapper__.class_manager.new_instance()
+        for name, value in snapshot.items():
+            set_committed_value(obj, name, value)
         obj.display()
 
     except AttributeError:
@@ -64,9 +533,6 @@ def fetch_from_db(obj_id, obj_type):
     #     print('ERROR: Something went wrong!.')
     #     exit()
 
-    finally:
-        session.close()
-
 
 def update_in_db(obj_id, obj_type, values):
     """
@@ -77,21 +543,12 @@ def update_in_db(obj_id, obj_type, values):
     :param values: new attribute values
     """
 
-    session = Session(autoflush=True, expire_on_commit=True)
-
-    try:
-        # update the object in the database
+    with unit_of_work() as session:
+        # update the object in the database, the related activities are committed in the same transaction
         obj = session.get(obj_type, obj_id)
         obj.edit(*values)
-        session.commit()
 
-    # except:
-    #     # safely exit the app in case of other exceptions
-    #     print('ERROR: Something went wrong with entity update.')
-    #     exit()
-
-    finally:
-        session.close()
+    snapshot_cache.invalidate(obj_type, obj_id)
 
 
 def complete_in_db(obj_id, obj_type):
@@ -105,21 +562,73 @@ def complete_in_db(obj_id, obj_type):
     :param obj_type: object type (class name)
     """
 
-    session = Session(autoflush=True, expire_on_commit=True)
-
-    try:
+    with unit_of_work() as session:
         # update the parameters of the object in the database due to complete action
         obj = session.get(obj_type, obj_id)
         obj.complete()
-        session.commit()
 
-    # except:
-    #     # safely exit the app in case of other exceptions
-    #     print('ERROR: Something went wrong with habit completion.')
-    #     exit()
+    snapshot_cache.invalidate(obj_type, obj_id)
 
-    finally:
-        session.close()
+
+def complete_many(completions, chunk_size=500):
+    """
+    Database utility function to complete many habits at once, e.g. for imported tracker data. The affected habits
+    are loaded with one query per chunk, the completions are applied in chronological order with the semantics of
+    Habit.complete() and the habits and 'completed_habit' activities are written with bulk statements in a single
+    transaction.
+
+    :param completions: iterable of (habit_id, time_of_completion) pairs
+    :param chunk_size: number of habit ids per query, below the SQLite limit of bound parameters
+    :return unknown: ids of the habits that do not exist, their completions are skipped
+    """
+
+    completions = sorted(completions, key=lambda completion: completion[1])
+    habit_ids = list({habit_id for habit_id, _ in completions})
+
+    with unit_of_work() as session:
+        # current state of the affected habits
+        habits = {}
+        for i in range(0, len(habit_ids), chunk_size):
+            for row in session.execute(select(
+                    Habit.habit_id, Habit.user_id, Habit.is_completed, Habit.current_streak, Habit.longest_streak,
+                    Habit.next_cycle_start_time).where(Habit.habit_id.in_(habit_ids[i:i + chunk_size]))):
+                habits[row.habit_id] = dict(row._mapping)
+
+        # apply the completions in memory, the statistics are updated by the increments
+        activities, increments = [], {}
+        for habit_id, time_of_completion in completions:
+            habit = habits.get(habit_id)
+            if habit is None:
+                continue
+            was_completed = habit['is_completed']
+            habit['time_of_completion'] = time_of_completion
+            habit['is_completed'], habit['current_streak'], habit['longest_streak'] = Habit.completion_state(
+                habit['is_completed'], habit['current_streak'], habit['longest_streak'],
+                habit['next_cycle_start_time'], time_of_completion)
+            activities.append(Activity(category=Category.completed_habit, user_id=habit['user_id'],
+                                       habit_id=habit_id, timestamp=time_of_completion))
+            increment = increments.setdefault(habit_id, {'b_habit_id': habit_id, 'b_total': 0, 'b_completed': 0})
+            increment['b_total'] += 1
+            increment['b_completed'] += int(habit['is_completed'] and not was_completed)
+            increment['b_last'] = time_of_completion
+
+        # write the habits and activities with bulk statements
+        session.bulk_update_mappings(Habit, [
+            {key: habit[key] for key in ('habit_id', 'is_completed', 'time_of_completion', 'current_streak',
+                                         'longest_streak')}
+            for habit in habits.values() if 'time_of_completion' in habit])
+        session.bulk_save_objects(activities)
+        if increments:
+            session.execute(update(HabitStats.__table__).where(
+                HabitStats.habit_id == bindparam('b_habit_id')).values(
+                total_completions=HabitStats.total_completions + bindparam('b_total'),
+                completed_periods=HabitStats.completed_periods + bindparam('b_completed'),
+                last_completion=case((HabitStats.last_completion > bindparam('b_last'), HabitStats.last_completion),
+                                     else_=bindparam('b_last'))), list(increments.values()))
+
+    snapshot_cache.invalidate(Habit)
+
+    return [habit_id for habit_id in habit_ids if habit_id not in habits]
 
 
 def delete_from_db(obj_id, obj_type):
@@ -130,37 +639,48 @@ def delete_from_db(obj_id, obj_type):
     :param obj_type: object type (class name)
     """
 
-    session = Session(autoflush=True, expire_on_commit=True)
+    # write pending activities first, the deletion cascades to them
+    activity_logger.flush()
 
-    try:
+    with unit_of_work() as session:
         # delete the object from the database
         obj = session.get(obj_type, obj_id)
         session.delete(obj)
-        session.commit()
 
-    # except:
-    #     # safely exit the app in case of other exceptions
-    #     print('ERROR: Something went wrong with entity deletion.')
-    #     exit()
+        # the rolled up and archived activities are not covered by the cascade
+        if obj_type is User:
+            session.execute(delete(ActivityRollup).where(ActivityRollup.user_id == obj_id))
+            session.execute(delete(ActivityArchive).where(ActivityArchive.user_id == obj_id))
+        elif obj_type is Habit:
+            session.execute(delete(ActivityArchive).where(ActivityArchive.habit_id == obj_id))
 
-    finally:
-        session.close()
+    snapshot_cache.invalidate(obj_type, obj_id)
+    if obj_type is User:
+        # the habits of the user are deleted as well
+        snapshot_cache.invalidate(Habit)
+        # sign the user out everywhere
+        tokenutil.token_store.revoke(user_id=obj_id)
 
 
-def new_cycle(habit_id):
+def new_cycle(habit_id, now=None):
     """
-    Database utility function to update the scheduled task of a habit.
+    Database utility function to update the scheduled task of a habit. A habit whose next cycle hasn't started yet,
+    e.g. because catch_up_cycles() of another process rolled it over just before the job ran, is left as it is.
 
     :param habit_id: habit id
+    :param now: point in time of the rollover
     """
-    session = Session(autoflush=True, expire_on_commit=True)
+
+    now = datetime.now() if now is None else now
 
     try:
-        # retrieve the object from the database and trigger update
-        obj = session.get(Habit, habit_id)
-        if obj is not None:
-            obj.update()
-            session.commit()
+        with unit_of_work() as session:
+            # retrieve the object from the database and trigger update
+            obj = session.get(Habit, habit_id)
+            if obj is not None and obj.next_cycle_start_time <= now:
+                obj.update()
+
+        snapshot_cache.invalidate(Habit, habit_id)
 
     except AttributeError:
         # catch if the object does not exist in the database
@@ -171,44 +691,407 @@ def new_cycle(habit_id):
     #     print('ERROR: Something went wrong!.')
     #     exit()
 
-    finally:
-        session.close()
 
+def move_jobs(next_runs):
+    """
+    Database utility function to move the scheduled jobs of habits to the start of their next cycle. A stopped
+    scheduler only knows the jobs added by this process, the jobs stored by other processes are changed in the job
+    store directly. Call it after the unit of work changing the habits, the job store writes through a connection of
+    its own.
+
+    :param next_runs: list of (job id, next cycle start time)
+    """
+
+    scheduler = imports.update_scheduler
+    store = imports.job_stores['default']
+    stored = scheduler.running or inspect(engine).has_table(store.jobs_t.name)
+
+    for job_id, next_run_time in next_runs:
+        if scheduler.get_job(job_id) is not None:
+            scheduler.modify_job(job_id, next_run_time=next_run_time)
+        elif not scheduler.running and stored:
+            job = store.lookup_job(job_id)
+            if job is not None:
+                job.next_run_time = next_run_time.replace(tzinfo=scheduler.timezone)
+                store.update_job(job)
+
+
+def sweep_cycles(now=None):
+    """
+    Database utility function to start the next cycle of all due habits with one set-based UPDATE. For each habit
+    whose next cycle has started the effect is the same as new_cycle(habit_id) at that time.
+
+    :param now: point in time of the sweep
+    """
+
+    now = datetime.now() if now is None else now
+    today = datetime.combine(now.date(), datetime.min.time())
+
+    # same rules as Habit.update(), all SET expressions see the values before the update
+    kept_streak = case((Habit.is_completed == True, Habit.current_streak), else_=0)
+    values = {
+        'current_streak': kept_streak,
+        'longest_streak': case((kept_streak > Habit.longest_streak, kept_streak), else_=Habit.longest_streak),
+        'is_completed': False,
+        'next_cycle_start_time': case(*[(Habit.periodicity == periodicity, today + timedelta(days=periodicity.value))
+                                        for periodicity in Periodicity]),
+    }
+
+    with unit_of_work() as session:
+        # count the ending periods in the statistics before the habits are reset
+        due = select(Habit.habit_id).where(Habit.habit_id == HabitStats.habit_id, Habit.next_cycle_start_time <= now)
+        missed = select(Habit.habit_id).where(Habit.habit_id == HabitStats.habit_id, Habit.is_completed == False)
+        session.execute(update(HabitStats).where(due.exists()).values(
+            periods=HabitStats.periods + 1,
+            missed_periods=HabitStats.missed_periods + case((missed.exists(), 1), else_=0)).execution_options(
+            synchronize_session=False))
+        session.execute(update(Habit).where(Habit.next_cycle_start_time <= now).values(**values).execution_options(
+            synchronize_session=False))
+
+    snapshot_cache.invalidate(Habit)
+
+
+def catch_up_cycles(now=None):
+    """
+    Database utility function to roll over the periods that passed while the application was not running, called
+    on start-up. The scheduler runs a job that missed several runs only once (see 'coalesce' in imports.job_defaults),
+    so Habit.update() would count several elapsed periods as one. Here the number of elapsed periods of every due habit
+    is derived from the start of its next cycle, and the habits and their statistics are updated with one set-based
+    UPDATE each in a single transaction.
+
+    If the scheduler of this process is started (paused, see service.py), the jobs that missed their run are moved to
+    the next cycle of their habit, otherwise they would repeat the rollover when it resumes.
+
+    :param now: point in time of the catch-up
+    :return count: number of rolled over habits
+    """
+
+    now = datetime.now() if now is None else now
+
+    # number of period boundaries passed since the start of the next cycle, at least one for a due habit (in whole
+    # seconds, the fractional days of julianday() could round a boundary down)
+    days = case(*[(Habit.periodicity == periodicity, periodicity.value) for periodicity in Periodicity])
+    elapsed = cast((cast(func.strftime('%s', now), Integer) -
+                    cast(func.strftime('%s', Habit.next_cycle_start_time), Integer)) / (days * 86400), Integer) + 1
+
+    # the first boundary keeps the streak of a completed period, the periods after it were missed. all SET
+    # expressions see the values before the update
+    kept_streak = case((Habit.is_completed == True, Habit.current_streak), else_=0)
+    values = {
+        'current_streak': case((elapsed == 1, kept_streak), else_=0),
+        'longest_streak': case((kept_streak > Habit.longest_streak, kept_streak), else_=Habit.longest_streak),
+        'is_completed': False,
+        'next_cycle_start_time': func.datetime(Habit.next_cycle_start_time,
+                                               '+' + cast(elapsed * days, String) + ' days'),
+    }
+
+    with unit_of_work() as session:
+        count = session.execute(select(func.count()).where(Habit.next_cycle_start_time <= now)).scalar()
+
+        # count the elapsed periods in the statistics before the habits are updated
+        habit = select(Habit.habit_id).where(Habit.habit_id == HabitStats.habit_id)
+        session.execute(update(HabitStats).where(
+            habit.where(Habit.next_cycle_start_time <= now).exists()).values(
+            periods=HabitStats.periods + habit.with_only_columns(elapsed).scalar_subquery(),
+            missed_periods=HabitStats.missed_periods + habit.with_only_columns(
+                elapsed - case((Habit.is_completed == True, 1), else_=0)).scalar_subquery()).execution_options(
+            synchronize_session=False))
+        session.execute(update(Habit).where(Habit.next_cycle_start_time <= now).values(**values).execution_options(
+            synchronize_session=False))
+
+    snapshot_cache.invalidate(Habit)
+
+    # a stopped scheduler can't modify stored jobs, the CLI doesn't start it (and doesn't import APScheduler for it)
+    scheduler = vars(imports).get('update_scheduler')
+    if scheduler is not None and scheduler.running:
+        # the job store keeps the next run time as a UNIX timestamp. the jobs are moved after the commit, the job
+        # store writes through a connection of its own
+        jobs_table = imports.job_stores['default'].jobs_t
+        with unit_of_work(read_only=True) as session:
+            jobs = session.execute(select(Habit.update_job_id, Habit.next_cycle_start_time).join(
+                jobs_table, jobs_table.c.id == Habit.update_job_id).where(
+                jobs_table.c.next_run_time <= now.timestamp())).fetchall()
+        for job_id, next_cycle_start_time in jobs:
+            scheduler.modify_job(job_id, next_run_time=next_cycle_start_time)
+
+    return count
+
+
+def rebuild_stats(user_id=None, habit_ids=None, now=None):
+    """
+    Database utility function to recompute the habit statistics (HabitStats) from the 'completed_habit' activities,
+    archived ones included, with one DELETE and one INSERT ... SELECT. As in analytics.py, the completions are
+    bucketed into periods of the habit periodicity counted from the day the habit was created. Used to fill the
+    statistics of existing databases and of bulk inserted habits, and to repair them.
+
+    :param user_id: id of the user whose statistics are rebuilt, all users if None
+    :param habit_ids: ids of the habits whose statistics are rebuilt, all habits (of the user) if None
+    :param now: point in time defining the current period
+    :return count: number of rebuilt habits
+    """
+
+    now = datetime.now() if now is None else now
+
+    # include the pending activities
+    activity_logger.flush()
+
+    completion_queries = []
+    for model in (Activity, ActivityArchive):
+        completion_query = select(model.habit_id, model.timestamp).where(model.category == Category.completed_habit,
+                                                                          model.timestamp <= now)
+        if user_id is not None:
+            completion_query = completion_query.where(model.user_id == user_id)
+        if habit_ids is not None:
+            completion_query = completion_query.where(model.habit_id.in_(habit_ids))
+        completion_queries.append(completion_query)
+    completions = union_all(*completion_queries).subquery()
+
+    # period of a day counted from the day the habit was created
+    days = case(*[(Habit.periodicity == periodicity, periodicity.value) for periodicity in Periodicity])
+    first_day = func.julianday(func.date(Habit.time_of_creation))
+    period = cast((func.julianday(func.date(completions.c.timestamp)) - first_day) / days, Integer)
+    current_period = cast((func.julianday(func.date(now)) - first_day) / days, Integer)
+
+    counts = select(
+        Habit.habit_id, Habit.user_id,
+        func.count(completions.c.timestamp).label('total_completions'),
+        func.max(completions.c.timestamp).label('last_completion'),
+        (current_period + 1).label('periods'),
+        func.count(period.distinct()).label('completed_periods'),
+        current_period.label('current_period'),
+        func.count(case((period == current_period, period)).distinct()).label('current_completed')).outerjoin(
+        completions, completions.c.habit_id == Habit.habit_id).group_by(Habit.habit_id)
+    if user_id is not None:
+        counts = counts.where(Habit.user_id == user_id)
+    if habit_ids is not None:
+        counts = counts.where(Habit.habit_id.in_(habit_ids))
+    counts = counts.subquery()
+
+    with unit_of_work() as session:
+        query = delete(HabitStats)
+        if user_id is not None:
+            query = query.where(HabitStats.user_id == user_id)
+        if habit_ids is not None:
+            query = query.where(HabitStats.habit_id.in_(habit_ids))
+        session.execute(query.execution_options(synchronize_session=False))
+
+        # a past period without a completion is missed
+        count = session.execute(insert(HabitStats).from_select(
+            ['habit_id', 'user_id', 'total_completions', 'last_completion', 'periods', 'completed_periods',
+             'missed_periods'],
+            select(counts.c.habit_id, counts.c.user_id, counts.c.total_completions, counts.c.last_completion,
+                   counts.c.periods, counts.c.completed_periods,
+                   counts.c.current_period - (counts.c.completed_periods - counts.c.current_completed)))).rowcount
+
+    return count
+
+
+def schedule_sweeper():
+    """
+    Database utility function to switch to the sweeper mode: the jobs of the habits are removed and a single job
+    sweeps the due habits every midnight. Every cycle of a habit starts at midnight, so one job covers all
+    periodicities.
+    """
+
+    from apscheduler.triggers.cron import CronTrigger
+
+    jobs_table = imports.job_stores['default'].jobs_t
+
+    with unit_of_work() as session:
+        session.execute(jobs_table.delete().where(jobs_table.c.id.in_(
+            select(Habit.update_job_id).where(Habit.update_job_id.isnot(None)).scalar_subquery())))
+        session.execute(update(Habit).values(update_job_id=None).execution_options(synchronize_session=False))
 
-def display_activity(user_id):
+    snapshot_cache.invalidate(Habit)
+
+    imports.update_scheduler.add_job(id='cycle_sweeper', func=sweep_cycles, trigger=CronTrigger(hour=0),
+                                     replace_existing=True)
+
+
+def schedule_habits():
+    """
+    Database utility function to switch back to the per-habit mode: the sweeper job is removed and every habit
+    without a job gets one at the start of its next cycle, as in Habit().
+    """
+
+    from apscheduler.jobstores.base import JobLookupError
+    from apscheduler.triggers.interval import IntervalTrigger
+
+    try:
+        imports.update_scheduler.remove_job('cycle_sweeper')
+    except JobLookupError:
+        pass
+
+    with unit_of_work() as session:
+        habits = session.execute(select(Habit.habit_id, Habit.periodicity, Habit.next_cycle_start_time).where(
+            Habit.update_job_id.is_(None))).fetchall()
+
+        mappings = []
+        for habit in habits:
+            mapping = {'habit_id': habit.habit_id, 'update_job_id': uuid4().hex}
+            imports.update_scheduler.add_job(id=mapping['update_job_id'], func=new_cycle, args=(habit.habit_id,),
+                                             trigger=IntervalTrigger(days=habit.periodicity.value),
+                                             next_run_time=habit.next_cycle_start_time, replace_existing=True)
+            mappings.append(mapping)
+        session.bulk_update_mappings(Habit, mappings)
+
+    snapshot_cache.invalidate(Habit)
+
+
+def migrate_scheduler(mode=None):
+    """
+    Database utility function to switch the jobs of an existing database to a scheduler mode in place, see
+    schedule_sweeper() and schedule_habits(). The scheduler has to be started (it may be paused), the jobs of a
+    stopped scheduler are only stored when it starts.
+
+    :param mode: 'per_habit' or 'sweeper', imports.scheduler_mode if None
+    """
+
+    mode = imports.scheduler_mode if mode is None else mode
+    if mode == 'sweeper':
+        schedule_sweeper()
+    elif mode == 'per_habit':
+        schedule_habits()
+    else:
+        raise ValueError('Invalid scheduler mode: {0}'.format(mode))
+
+
+def activity_query(user_id, habit_id=None, start=None, end=None, categories=None, page_size=500):
+    """
+    Database utility function to build the query of the first page of activities for iter_activity().
+
+    :param user_id: user id
+    :param habit_id: habit id, all activities of the user if None
+    :param start: earliest timestamp (inclusive)
+    :param end: latest timestamp (exclusive)
+    :param categories: list of activity categories, all categories if None
+    :param page_size: number of activities per page
+    :return query: query of the first page
+    """
+
+    query = select(Activity.timestamp, Activity.activity_id, Activity.category, Activity.description).where(
+        Activity.user_id == user_id)
+    if habit_id is not None:
+        query = query.where(Activity.habit_id == habit_id)
+    if start is not None:
+        query = query.where(Activity.timestamp >= start)
+    if end is not None:
+        query = query.where(Activity.timestamp < end)
+    if categories is not None:
+        query = query.where(Activity.category.in_(categories))
+
+    return query.order_by(Activity.timestamp, Activity.activity_id).limit(page_size)
+
+
+def next_page_query(query, page):
+    """
+    Database utility function to build the query of the page following 'page' (keyset pagination).
+
+    :param query: query of the first page (see activity_query())
+    :param page: rows of the current page
+    :return query: query continuing after the last activity of the page
+    """
+
+    return query.where(tuple_(Activity.timestamp, Activity.activity_id) > (page[-1].timestamp, page[-1].activity_id))
+
+
+def iter_activity(user_id, habit_id=None, start=None, end=None, categories=None, page_size=500):
+    """
+    Database utility function to read the activity of a user, optionally on a habit, page by page in chronological
+    order. The pages are read with keyset pagination on (timestamp, activity_id) from the activity indexes, each page
+    in a short query of its own, so that the history is never held in memory as a whole.
+
+    :param user_id: user id
+    :param habit_id: habit id, all activities of the user if None
+    :param start: earliest timestamp (inclusive)
+    :param end: latest timestamp (exclusive)
+    :param categories: list of activity categories, all categories if None
+    :param page_size: number of activities per page
+    :return: generator of pages, lists of rows with timestamp, activity_id, category and description
+    """
+
+    # write pending activities first to read the complete history
+    activity_logger.flush()
+
+    query = activity_query(user_id, habit_id=habit_id, start=start, end=end, categories=categories,
+                           page_size=page_size)
+
+    page = None
+    while page is None or len(page) == page_size:
+        with unit_of_work(read_only=True) as session:
+            # continue after the last activity of the previous page
+            page = session.execute(query if page is None else next_page_query(query, page)).fetchall()
+
+        if len(page) != 0:
+            yield page
+
+
+def write_activity(pages, file=None):
+    """
+    Database utility function to write activity descriptions page by page as they are read.
+
+    :param pages: pages of activity rows (see iter_activity())
+    :param file: text stream to write to, stdout if None
+    :return count: number of written activities
+    """
+
+    file = sys.stdout if file is None else file
+
+    count = 0
+    for page in pages:
+        file.write(''.join(row.description + '\n' for row in page))
+        file.flush()
+        count += len(page)
+
+    return count
+
+
+def display_activity(user_id, start=None, end=None, categories=None, page_size=500, file=None):
     """
     Database utility function to fetch and display user activity.
 
     :param user_id: user id
+    :param start: earliest timestamp (inclusive)
+    :param end: latest timestamp (exclusive)
+    :param categories: list of activity categories, all categories if None
+    :param page_size: number of activities read and written at once
+    :param file: text stream to write to, stdout if None
     """
 
-    session = Session(autoflush=True, expire_on_commit=True)
+    # stream user activity descriptions ordered by timestamp
+    print()
+    count = write_activity(iter_activity(user_id, start=start, end=end, categories=categories, page_size=page_size),
+                           file=file)
+    if count == 0:
+        print('This user has no recorded activity!')
 
-    try:
-        # fetch user activity description ordered by timestamp
-        results = session.execute(
-            select(Activity.description).where(Activity.user_id == user_id).order_by(Activity.timestamp)).fetchall()
+    # create related activity and insert into database table 'Activity'
+    activity = Activity(category=Category.displayed_activity, user_id=user_id)
+    log_activity(activity)
 
-        # create related activity
-        activity = Activity(category=Category.displayed_activity, user_id=user_id)
 
-        if len(results) != 0:
-            # print the results in a tabular form
-            print()
-            print(tabulate(results, tablefmt='simple'))
-        else:
-            print('\nThis user has no recorded activity!')
+def compact_activity(vacuum=False):
+    """
+    Database utility function to migrate the activity log to compact storage. Stored descriptions that are identical
+    to the ones rendered from the structured columns are removed, others (e.g. of activities logged before the
+    periodicity was stored) are kept.
 
-        # insert activity into database table 'Activity'
-        dbutil.insert_into_db(activity)
+    :param vacuum: if True, the freed space is returned to the file system (rewrites the whole database)
+    :return count: number of stripped descriptions
+    """
 
-    # except:
-    #     # safely exit the app in case of other exceptions
-    #     print('\nERROR: Something went wrong!.')
-    #     exit()
+    # include the pending activities
+    activity_logger.flush()
 
-    finally:
-        session.close()
+    with unit_of_work() as session:
+        count = session.execute(update(Activity).where(Activity._description == Activity.rendered_description()).values(
+            {Activity._description: None}).execution_options(synchronize_session=False)).rowcount
+
+    if vacuum:
+        with engine.connect() as connection:
+            connection.execution_options(isolation_level='AUTOCOMMIT').execute(text('VACUUM'))
+
+    return count
 
 
 def delete_activity(user_id):
@@ -218,24 +1101,23 @@ def delete_activity(user_id):
     :param user_id: user id
     """
 
-    session = Session(autoflush=True, expire_on_commit=True)
+    # write pending activities first so that none of them survives the deletion
+    activity_logger.flush()
 
-    try:
-        # delete user activity
+    with unit_of_work() as session:
+        # delete user activity, including the rolled up and archived activity
         session.execute(delete(Activity).where(Activity.user_id == user_id))
-        session.commit()
+        session.execute(delete(ActivityRollup).where(ActivityRollup.user_id == user_id))
+        session.execute(delete(ActivityArchive).where(ActivityArchive.user_id == user_id))
 
         print('\nThis user has no recorded activity!')
 
         # create related activity and insert into database table 'Activity' (to record that there was activity but it
         # is deleted)
         activity = Activity(category=Category.deleted_activity, user_id=user_id)
-        dbutil.insert_into_db(activity)
+        log_activity(activity)
 
-    # except:
-    #     # safely exit the app in case of other exceptions
-    #     print('\nERROR: Something went wrong!.')
-    #     exit()
 
-    finally:
-        session.close()
+# fill the statistics of a database created before they were maintained
+if missing_stats:
+    rebuild_stats()
@@ -0,0 +1,345 @@
+"""
+    Columnar export of users, habits and activities
+
+    The 'User', 'Habit' and 'Activity' tables (archived activities included) are streamed in chunks to Parquet or
+    Arrow IPC files for offline analysis (e.g. with pandas, DuckDB or Spark). Each chunk is read with keyset
+    pagination in a short read transaction of its own, so an export neither holds more than one chunk in memory nor
+    keeps a long-running reader on the database. The descriptions of activities stored without one (compact storage,
+    see imports.activity_storage) are rendered.
+
+    Habits and activities are partitioned by user or by month in directories named '<column>=<value>'. Users and
+    habits are exported as a whole on every run, activities are exported incrementally: a watermark file records the
+    end of the exported time range and the next incremental run starts there. Requires pyarrow.
+
+    The other processes (CLI, batch runs, HTTP service) write their activities behind (see dbutil.ActivityLogger), an
+    activity can be stored a while after its timestamp. The exported time range therefore ends 'settle' seconds
+    before the export. Activities stored later than that, e.g. imported history or activities of a process that
+    couldn't flush its buffer in time, are missed by incremental runs and only exported by a full run.
+
+    Usage: python export.py <directory> [--format parquet|arrow] [--partition-by user|month] [--incremental]
+"""
+
+import argparse
+import json
+import os
+from datetime import datetime, timedelta
+from itertools import groupby
+
+import pyarrow
+import pyarrow.ipc
+import pyarrow.parquet
+from sqlalchemy import func, select, tuple_, type_coerce, union_all, Enum, String
+
+import dbutil
+from activity import Activity, ActivityArchive
+from habit import Habit
+from user import User
+
+# file extensions of the supported formats
+extensions = {'parquet': '.parquet', 'arrow': '.arrow'}
+
+# exported columns per table: (name, arrow type). enums are exported by name, passwords not at all
+tables = {
+    'users': [
+        ('user_id', pyarrow.int64()),
+        ('name', pyarrow.string()),
+        ('email', pyarrow.string()),
+    ],
+    'habits': [
+        ('habit_id', pyarrow.int64()),
+        ('user_id', pyarrow.int64()),
+        ('name', pyarrow.string()),
+        ('description', pyarrow.string()),
+        ('periodicity', pyarrow.string()),
+        ('time_of_creation', pyarrow.timestamp('us')),
+        ('is_completed', pyarrow.bool_()),
+        ('time_of_completion', pyarrow.timestamp('us')),
+        ('next_cycle_start_time', pyarrow.timestamp('us')),
+        ('current_streak', pyarrow.int64()),
+        ('longest_streak', pyarrow.int64()),
+    ],
+    'activity': [
+        ('activity_id', pyarrow.int64()),
+        ('user_id', pyarrow.int64()),
+        ('habit_id', pyarrow.int64()),
+        ('category', pyarrow.string()),
+        ('periodicity', pyarrow.string()),
+        ('timestamp', pyarrow.timestamp('us')),
+        ('description', pyarrow.string()),
+    ],
+}
+
+# database tables per exported table, the activities include the archived ones
+sources = {
+    'users': [User.__table__],
+    'habits': [Habit.__table__],
+    'activity': [Activity.__table__, ActivityArchive.__table__],
+}
+
+# order of the rows per table and partitioning, the rows of a partition are adjacent so that each partition is
+# written to one file. the keys are served by the primary keys and the indexes on (user_id, timestamp) and (timestamp)
+# of both activity tables
+keys = {
+    'users': {None: ['user_id'], 'user': ['user_id'], 'month': ['user_id']},
+    'habits': {None: ['habit_id'], 'user': ['user_id', 'habit_id'], 'month': ['time_of_creation', 'habit_id']},
+    'activity': {None: ['timestamp', 'activity_id'], 'user': ['user_id', 'timestamp', 'activity_id'],
+                 'month': ['timestamp', 'activity_id']},
+}
+
+# partition directory of a row per table and partitioning, the users are not partitioned (one file per user would
+# only hold one row)
+partitions = {
+    'users': {},
+    'habits': {'user': lambda row: 'user_id={0}'.format(row.user_id),
+               'month': lambda row: 'month={0:%Y-%m}'.format(row.time_of_creation)},
+    'activity': {'user': lambda row: 'user_id={0}'.format(row.user_id),
+                 'month': lambda row: 'month={0:%Y-%m}'.format(row.timestamp)},
+}
+
+
+def page_source(table, key_names, start=None, end=None, after=None, chunk_size=10000):
+    """
+    Export function to build the rows of a table a page is read from. The activities are the union of the pages of
+    'Activity' and 'ActivityArchive', each read in key order from its own index. An activity is archived with its id
+    and timestamp, so the keyset pagination sees it once even if it is archived during the export. Missing
+    descriptions are rendered (see Activity.rendered_description()).
+
+    :param table: name of the table in 'tables'
+    :param key_names: names of the key columns
+    :param start: activities after this point in time (exclusive), all if None
+    :param end: activities up to this point in time (inclusive), all if None
+    :param after: key of the last row of the previous page, None for the first page
+    :param chunk_size: number of rows per page
+    :return: table or subquery with the exported columns
+    """
+
+    if len(sources[table]) == 1:
+        return sources[table][0]
+
+    pages = []
+    for source in sources[table]:
+        page = select(*[func.coalesce(source.c.description, Activity.rendered_description(source.c)).label(name)
+                        if name == 'description' else source.c[name] for name, _ in tables[table]])
+        if start is not None:
+            page = page.where(source.c.timestamp > start)
+        if end is not None:
+            page = page.where(source.c.timestamp <= end)
+        key = [source.c[name] for name in key_names]
+        if after is not None:
+            page = page.where(tuple_(*key) > after)
+        pages.append(select(page.order_by(*key).limit(chunk_size).subquery()))
+    return union_all(*pages).subquery(table)
+
+
+def read_chunks(table, partition_by=None, start=None, end=None, chunk_size=10000):
+    """
+    Export function to read the rows of a table chunk by chunk, each chunk in its own read transaction.
+
+    :param table: name of the table in 'tables'
+    :param partition_by: 'user', 'month' or None, defines the order of the rows
+    :param start: activities after this point in time (exclusive), all if None
+    :param end: activities up to this point in time (inclusive), all if None
+    :param chunk_size: number of rows per chunk
+    :return: generator of lists of rows
+    """
+
+    key_names = keys[table][partition_by]
+
+    after = None
+    while True:
+        source = page_source(table, key_names, start=start, end=end, after=after, chunk_size=chunk_size)
+        query = select(*[(type_coerce(source.c[name], String) if isinstance(source.c[name].type, Enum)
+                          else source.c[name]).label(name) for name, _ in tables[table]])
+        key = [source.c[name] for name in key_names]
+        if after is not None:
+            # keyset pagination, continue after the last row of the previous chunk
+            query = query.where(tuple_(*key) > after)
+        query = query.order_by(*key).limit(chunk_size)
+
+        with dbutil.unit_of_work(read_only=True) as session:
+            rows = session.execute(query).fetchall()
+        if len(rows) != 0:
+            yield rows
+        if len(rows) < chunk_size:
+            break
+        after = tuple(getattr(rows[-1], name) for name in key_names)
+
+
+def export_table(table, directory, file_format='parquet', partition_by=None, start=None, end=None, chunk_size=10000,
+                 run=None):
+    """
+    Export function to write a table to files. One file per partition is written, named 'part-<run>'. The files are
+    written under temporary names, see commit_files().
+
+    :param table: name of the table in 'tables'
+    :param directory: export directory, the files are written to the subdirectory of the table
+    :param file_format: 'parquet' or 'arrow'
+    :param partition_by: 'user', 'month' or None
+    :param start: activities after this point in time (exclusive), all if None
+    :param end: activities up to this point in time (inclusive), all if None
+    :param chunk_size: number of rows per chunk
+    :param run: name of the export run in the file names
+    :return count, paths: number of exported rows, temporary paths of the written files
+    """
+
+    # the partition column is stored in the directory names only, as readers of partitioned datasets expect
+    partition = partitions[table].get(partition_by)
+    stored = [(name, arrow_type) for name, arrow_type in tables[table]
+              if partition is None or partition_by != 'user' or name != 'user_id']
+    schema = pyarrow.schema(stored)
+    partition = partition or (lambda row: '')
+    file_name = 'part-{0}{1}'.format(run or 0, extensions[file_format])
+
+    count, paths, writer, current = 0, [], None, None
+    try:
+        for rows in read_chunks(table, partition_by=partition_by, start=start, end=end, chunk_size=chunk_size):
+            for value, partition_rows in groupby(rows, key=partition):
+                # the rows are ordered by partition, a new partition closes the file of the previous one
+                if writer is None or value != current:
+                    if writer is not None:
+                        writer.close()
+                    current = value
+                    path = os.path.join(directory, table, value, file_name) + '.tmp'
+                    os.makedirs(os.path.dirname(path), exist_ok=True)
+                    if file_format == 'parquet':
+                        writer = pyarrow.parquet.ParquetWriter(path, schema)
+                    else:
+                        writer = pyarrow.ipc.new_file(path, schema)
+                    paths.append(path)
+
+                # transpose the rows into columns
+                partition_rows = list(partition_rows)
+                columns = dict(zip(partition_rows[0]._fields, zip(*partition_rows)))
+                writer.write_table(pyarrow.Table.from_arrays(
+                    [pyarrow.array(columns[field.name], type=field.type) for field in schema], schema=schema))
+                count += len(partition_rows)
+    finally:
+        if writer is not None:
+            writer.close()
+
+    return count, paths
+
+
+def commit_files(paths):
+    """
+    Export function to give the written files their final names once all tables are exported, so that an interrupted
+    run doesn't leave partial files behind (only temporary ones).
+
+    :param paths: temporary paths of the written files
+    """
+
+    for path in paths:
+        os.replace(path, path[:-len('.tmp')])
+
+
+def read_watermark(directory):
+    """
+    Export function to read the end of the time range of the last export to a directory.
+
+    :param directory: export directory
+    :return watermark: point in time, None if nothing was exported yet
+    """
+
+    try:
+        with open(os.path.join(directory, '_watermark.json')) as file:
+            return datetime.fromisoformat(json.load(file)['timestamp'])
+    except FileNotFoundError:
+        return None
+
+
+def write_watermark(directory, watermark):
+    """
+    Export function to record the end of the exported time range, replacing the file atomically.
+
+    :param directory: export directory
+    :param watermark: point in time
+    """
+
+    path = os.path.join(directory, '_watermark.json')
+    with open(path + '.tmp', 'w') as file:
+        json.dump({'timestamp': watermark.isoformat()}, file)
+    os.replace(path + '.tmp', path)
+
+
+def export(directory, file_format='parquet', partition_by=None, incremental=False, chunk_size=10000, now=None,
+           settle=None):
+    """
+    Export function to write the users, habits and activities to a directory:
+        - <directory>/users, <directory>/habits: the current users and habits, replaced on every run
+        - <directory>/activity: the activities up to 'settle' seconds before 'now', archived ones included, an
+          incremental run adds the activities since the watermark of the previous run in new files
+        - <directory>/_watermark.json: end of the exported time range
+
+    Activities that are stored after the watermark passed their timestamp (see the module documentation) are only
+    exported by a full run.
+
+    :param directory: export directory
+    :param file_format: 'parquet' or 'arrow'
+    :param partition_by: 'user', 'month' or None
+    :param incremental: if True, only the activities since the last export are added, otherwise the activities are
+        exported as a whole
+    :param chunk_size: number of rows read and written at once
+    :param now: time of the export
+    :param settle: time in seconds the other processes take to store their activities, the exported time range ends
+        that long before 'now'. twice the flush interval of the activity logger if None
+    :return counts: number of exported rows per table
+    """
+
+    if file_format not in extensions:
+        raise ValueError('Invalid format: {0}'.format(file_format))
+    if partition_by not in (None, 'user', 'month'):
+        raise ValueError('Invalid partitioning: {0}'.format(partition_by))
+
+    now = datetime.now() if now is None else now
+    settle = 2 * dbutil.activity_logger.flush_interval if settle is None else settle
+    end = now - timedelta(seconds=settle)
+    start = read_watermark(directory) if incremental else None
+    run = now.strftime('%Y%m%dT%H%M%S%f')
+
+    # include the pending activities
+    dbutil.activity_logger.flush()
+
+    counts, paths = {}, []
+    for table in tables:
+        counts[table], table_paths = export_table(table, directory, file_format=file_format,
+                                                  partition_by=partition_by, start=start, end=end,
+                                                  chunk_size=chunk_size, run=run)
+        paths.extend(table_paths)
+
+    # replace the users and habits of the previous run, and the activities unless they are added to
+    for table in tables:
+        if table != 'activity' or start is None:
+            for root, _, files in os.walk(os.path.join(directory, table)):
+                for file_name in files:
+                    if not file_name.endswith('.tmp'):
+                        os.remove(os.path.join(root, file_name))
+    commit_files(paths)
+    write_watermark(directory, end)
+
+    return counts
+
+
+def main(argv=None):
+    """
+    Function to run an export from the command line.
+
+    :param argv: command line arguments, sys.argv if None
+    """
+
+    parser = argparse.ArgumentParser(description='Export users, habits and activities to Parquet or Arrow files.')
+    parser.add_argument('directory', help='export directory')
+    parser.add_argument('--format', choices=tuple(extensions), default='parquet', help='file format')
+    parser.add_argument('--partition-by', choices=('user', 'month'), default=None, help='partitioning of the files')
+    parser.add_argument('--incremental', action='store_true', help='only add the activities since the last export')
+    parser.add_argument('--chunk-size', type=int, default=10000, help='rows read and written at once')
+    parser.add_argument('--settle', type=float, default=None,
+                        help='seconds the other processes take to store their activities')
+    args = parser.parse_args(argv)
+
+    counts = export(args.directory, file_format=args.format, partition_by=args.partition_by,
+                    incremental=args.incremental, chunk_size=args.chunk_size, settle=args.settle)
+    print('Exported {users} users, {habits} habits and {activity} activities.'.format(**counts))
+
+
+if __name__ == '__main__':
+    main()
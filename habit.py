@@ -1,16 +1,16 @@
-import pandas
 from datetime import datetime, timedelta
 from tabulate import tabulate
 from enum import Enum
 from uuid import uuid4
-from apscheduler.triggers.interval import IntervalTrigger
-from sqlalchemy.orm import relationship
-from sqlalchemy import Column, Integer, String, ForeignKey, DateTime, Boolean
+from sqlalchemy.ext.hybrid import hybrid_property
+from sqlalchemy.orm import relationship, object_session
+from sqlalchemy import Column, Integer, String, ForeignKey, DateTime, Boolean, Index, Float, case, cast, event, insert
 from sqlalchemy import Enum as SqlEnum
 
 import dbutil
+import imports
 from activity import Activity, Category
-from imports import Base, update_scheduler
+from imports import Base, scheduler_mode
 
 
 class Periodicity(Enum):
@@ -55,6 +55,14 @@ class Habit(Base):
     update_job_id = Column(String)
     user_id = Column(Integer, ForeignKey("User.user_id", ondelete='cascade'))
     activities = relationship("Activity", cascade="all, delete")
+    stats = relationship("HabitStats", uselist=False, cascade="all, delete-orphan")
+
+    # habits are listed per user, optionally filtered by periodicity, ranked by their longest streak per user and
+    # globally, and swept by the start of their next cycle
+    __table_args__ = (Index('ix_habit_user_id_periodicity', 'user_id', 'periodicity'),
+                      Index('ix_habit_user_id_longest_streak', 'user_id', 'longest_streak'),
+                      Index('ix_habit_longest_streak', 'longest_streak'),
+                      Index('ix_habit_next_cycle_start_time', 'next_cycle_start_time'))
 
     def __init__(self, user_id, periodicity, name, description=None, time_of_creation=None, next_cycle_start_time=None):
         """
@@ -84,15 +92,21 @@ class Habit(Base):
         calculated_start_time = datetime.combine(self.time_of_creation.date(), datetime.min.time()) + timedelta(days=self.periodicity.value)
         self.next_cycle_start_time = calculated_start_time if next_cycle_start_time is None else next_cycle_start_time
 
-        # create and configure a job to schedule periodic updates to track the habit
-        self.update_job_id = uuid4().hex
-        trigger = IntervalTrigger(days=self.periodicity.value)
-        update_scheduler.add_job(id=self.update_job_id, func=dbutil.new_cycle, args=(self.habit_id,), trigger=trigger, replace_existing=True)
-        update_scheduler.get_job(job_id=self.update_job_id).modify(next_run_time=self.next_cycle_start_time)
+        # create and configure a job to schedule periodic updates to track the habit (in sweeper mode the cycle sweeper
+        # job updates all habits instead)
+        self.update_job_id = None
+        if scheduler_mode == 'per_habit':
+            from apscheduler.triggers.interval import IntervalTrigger
+
+            self.update_job_id = uuid4().hex
+            trigger = IntervalTrigger(days=self.periodicity.value)
+            imports.update_scheduler.add_job(id=self.update_job_id, func=dbutil.new_cycle, args=(self.habit_id,),
+                                             trigger=trigger, next_run_time=self.next_cycle_start_time,
+                                             replace_existing=True)
 
         # create related activity and insert into database table 'Activity'
         activity = Activity(category=Category.created_habit, user_id=self.user_id, habit_id=self.habit_id, timestamp=self.time_of_creation)
-        dbutil.insert_into_db(activity)
+        dbutil.log_activity(activity)
 
     def display(self):
         """
@@ -101,13 +115,12 @@ class Habit(Base):
 
         print('\nHabit Info: ')
         # collect and display relevant attributes for the habit
-        variables = {key: value for key, value in vars(self).items() if key not in ('_sa_instance_state', 'user_id', 'update_job_id')}
-        df = pandas.DataFrame.from_records([variables])
-        print(tabulate(df.T, tablefmt='simple'))
+        variables = {key: value for key, value in vars(self).items() if key not in ('_sa_instance_state', 'user_id', 'update_job_id', 'stats')}
+        print(tabulate(variables.items(), tablefmt='simple'))
 
         # create related activity and insert into database table 'Activity'
         activity = Activity(category=Category.displayed_habit, user_id=self.user_id, habit_id=self.habit_id)
-        dbutil.insert_into_db(activity)
+        dbutil.log_activity(activity)
 
     def edit(self, name=None, desc=None, periodicity=None):
         """
@@ -123,14 +136,14 @@ class Habit(Base):
             self.name = name
             # create related activity and insert into database table 'Activity'
             activity = Activity(category=Category.changed_the_name_of_habit, user_id=self.user_id, habit_id=self.habit_id)
-            dbutil.insert_into_db(activity)
+            dbutil.log_activity(activity)
 
         if desc not in (self.description, '', None):
             self.description = desc
             # create related activity and insert into database table 'Activity'
             activity = Activity(category=Category.changed_the_description_of_habit, user_id=self.user_id,
                                 habit_id=self.habit_id)
-            dbutil.insert_into_db(activity)
+            dbutil.log_activity(activity)
         try:
             periodicity = Periodicity.from_string(periodicity)
             if periodicity not in (self.periodicity, '', None):
@@ -140,7 +153,7 @@ class Habit(Base):
                 # create related activity and insert into database table 'Activity'
                 activity = Activity(category=Category.changed_the_periodicity_of_habit, user_id=self.user_id,
                                     habit_id=self.habit_id)
-                dbutil.insert_into_db(activity)
+                dbutil.log_activity(activity)
         except ValueError:
             print('\nWARNING: Invalid periodicity. No change will be applied to periodicity!')
 
@@ -152,21 +165,69 @@ class Habit(Base):
         """
 
         # update the relevant attributes when the habit is completed
+        was_completed = self.is_completed
         self.time_of_completion = datetime.now() if time_of_completion is None else time_of_completion
-        if not self.is_completed and self.time_of_completion.timestamp() < self.next_cycle_start_time.timestamp():
-            self.is_completed = True
-            self.current_streak += 1
-            self.longest_streak = self.current_streak if self.current_streak > self.longest_streak else self.longest_streak
+        self.is_completed, self.current_streak, self.longest_streak = Habit.completion_state(
+            self.is_completed, self.current_streak, self.longest_streak, self.next_cycle_start_time,
+            self.time_of_completion)
+
+        # update the statistics in the same transaction
+        stats = self.session_stats()
+        if stats is not None:
+            stats.total_completions += 1
+            stats.last_completion = max(stats.last_completion or datetime.min, self.time_of_completion)
+            stats.completed_periods += int(self.is_completed and not was_completed)
 
         # create related activity and insert into database table 'Activity'
         activity = Activity(category=Category.completed_habit, user_id=self.user_id, habit_id=self.habit_id, timestamp=self.time_of_completion)
-        dbutil.insert_into_db(activity)
+        dbutil.log_activity(activity)
+
+    def session_stats(self):
+        """
+        Habit class method to get the statistics of the habit in its session. They are loaded without flushing the
+        pending changes first, a flush would lock the database until the session is committed.
+
+        :return stats: HabitStats object, None if the habit is not stored in a session (or has no statistics)
+        """
+
+        session = object_session(self)
+        if session is None:
+            return None
+        with session.no_autoflush:
+            return self.stats
+
+    @staticmethod
+    def completion_state(is_completed, current_streak, longest_streak, next_cycle_start_time, time_of_completion):
+        """
+        Helper function for the state transition of a completion, shared by complete() and dbutil.complete_many(). A
+        habit counts as completed once per cycle, if it is completed before the next cycle starts.
+
+        :param is_completed: whether the habit is already completed in the current cycle
+        :param current_streak: current streak of the habit
+        :param longest_streak: longest streak of the habit
+        :param next_cycle_start_time: start of the next cycle
+        :param time_of_completion: when the habit is completed
+        :return: new values of is_completed, current_streak and longest_streak
+        """
+
+        if not is_completed and time_of_completion.timestamp() < next_cycle_start_time.timestamp():
+            is_completed = True
+            current_streak += 1
+            longest_streak = current_streak if current_streak > longest_streak else longest_streak
+
+        return is_completed, current_streak, longest_streak
 
     def update(self):
         """
         Habit class method to update the tracking attributes of a habit.
         """
 
+        # count the ending period in the statistics
+        stats = self.session_stats()
+        if stats is not None:
+            stats.periods += 1
+            stats.missed_periods += int(not self.is_completed)
+
         # update the relevant attributes in the next cycle and reschedule the job
         self.current_streak = self.current_streak if self.is_completed else 0
         self.longest_streak = self.current_streak if self.current_streak > self.longest_streak else self.longest_streak
@@ -180,8 +241,60 @@ class Habit(Base):
         :param trigger: custom trigger for the background job scheduler
         """
 
-        # reschedule the job for the next cycle
+        from apscheduler.triggers.interval import IntervalTrigger
+
+        # calculate the start of the next cycle, the first run of the trigger from now on aligned to midnight
         trigger = IntervalTrigger(days=self.periodicity.value) if trigger is None else trigger
-        update_scheduler.get_job(job_id=self.update_job_id).reschedule(trigger)
-        self.next_cycle_start_time = datetime.combine(update_scheduler.get_job(job_id=self.update_job_id).next_run_time.date(), datetime.min.time())
-        update_scheduler.get_job(job_id=self.update_job_id).modify(next_run_time=self.next_cycle_start_time)
+        next_run_time = trigger.get_next_fire_time(None, datetime.now(imports.update_scheduler.timezone))
+        self.next_cycle_start_time = datetime.combine(next_run_time.date(), datetime.min.time())
+
+        # reschedule the job for the next cycle with a single job store round trip
+        if self.update_job_id is not None:
+            imports.update_scheduler.modify_job(self.update_job_id, trigger=trigger, next_run_time=self.next_cycle_start_time)
+
+
+class HabitStats(Base):
+    """
+    SQL Alchemy ORM model for 'HabitStats' objects, the statistics of a habit maintained incrementally by
+    Habit.complete() and Habit.update() so that they are read without scanning the activities (see
+    dbutil.rebuild_stats() to derive them from the activities)
+    """
+
+    __tablename__ = "HabitStats"
+    habit_id = Column(Integer, ForeignKey("Habit.habit_id", ondelete='cascade'), primary_key=True)
+    user_id = Column(Integer, nullable=False)
+    total_completions = Column(Integer, nullable=False, default=0)
+    last_completion = Column(DateTime)
+    periods = Column(Integer, nullable=False, default=1)  # including the current one
+    completed_periods = Column(Integer, nullable=False, default=0)
+    missed_periods = Column(Integer, nullable=False, default=0)  # past periods without a completion
+
+    __table_args__ = (Index('ix_habitstats_user_id', 'user_id'),)
+
+    @hybrid_property
+    def adherence_rate(self):
+        """
+        Share of the completed periods among the past periods and the current one if it is completed.
+        """
+
+        return self.completed_periods / max(self.completed_periods + self.missed_periods, 1)
+
+    @adherence_rate.expression
+    def adherence_rate(cls):
+        return cast(cls.completed_periods, Float) / case(
+            (cls.completed_periods + cls.missed_periods > 0, cls.completed_periods + cls.missed_periods), else_=1)
+
+
+@event.listens_for(Habit, 'after_insert')
+def insert_stats(mapper, connection, target):
+    """
+    Event handler to create the statistics of a new habit in the transaction of its insert.
+
+    :param mapper: mapper of 'Habit'
+    :param connection: connection of the flush
+    :param target: the inserted habit
+    """
+
+    connection.execute(insert(HabitStats).values(habit_id=target.habit_id, user_id=target.user_id,
+                                                 total_completions=0, periods=1, completed_periods=0,
+                                                 missed_periods=0))
@@ -21,12 +21,7 @@ def habit_module(user_id):
             name = input('Name: ')
             periodicity = input('Periodicity: [daily/weekly] ')
             try:
-                habit = Habit(user_id=user_id, name=name, periodicity=Periodicity.from_string(periodicity))
-                habit_id = habit.habit_id
-                dbutil.insert_into_db(habit)
-                # delete object to avoid detached instance
-                if habit is not None:
-                    del habit
+                habit_id = create_habit(user_id=user_id, name=name, periodicity=periodicity)
 
                 print("\nHabit is successfully created!")
                 dbutil.fetch_from_db(habit_id, Habit)
@@ -76,16 +71,7 @@ def habit_module(user_id):
             confirmation = input("\nAre you sure that you wish to delete this habit? [yes/no] ")
             if confirmation == 'yes':
                 try:
-                    # delete habit from the database
-                    dbutil.delete_from_db(habit_id, Habit)
-
-                    # TODO: check if it causes database integrity issues
-                    # create related activity and insert into database table 'Activity'
-                    activity = Activity(category=Category.deleted_habit, user_id=user_id, habit_id=habit_id)
-                    dbutil.insert_into_db(activity)
-                    # delete object to avoid detached instance
-                    if activity is not None:
-                        del activity
+                    delete_habit(user_id=user_id, habit_id=habit_id)
 
                     print("\nHabit is successfully deleted!")
 
@@ -106,6 +92,42 @@ def habit_module(user_id):
     return action
 
 
+def create_habit(user_id, name, periodicity, description=None):
+    """
+    Function to create a habit together with its activity in one transaction.
+
+    :param user_id: the current user
+    :param name: name of the habit
+    :param periodicity: periodicity of the habit as string [daily/weekly]
+    :param description: description of the habit
+    :return habit_id: id of the new habit
+    """
+
+    with dbutil.unit_of_work():
+        habit = Habit(user_id=user_id, name=name, description=description,
+                      periodicity=Periodicity.from_string(periodicity))
+        dbutil.insert_into_db(habit)
+        return habit.habit_id
+
+
+def delete_habit(user_id, habit_id):
+    """
+    Function to delete a habit and record the deletion in one transaction.
+
+    :param user_id: the current user
+    :param habit_id: id of the habit
+    """
+
+    with dbutil.unit_of_work():
+        # delete habit from the database
+        dbutil.delete_from_db(habit_id, Habit)
+
+        # TODO: check if it causes database integrity issues
+        # create related activity and insert into database table 'Activity'
+        activity = Activity(category=Category.deleted_habit, user_id=user_id, habit_id=habit_id)
+        dbutil.log_activity(activity)
+
+
 def list_habit_commands():
     """
     Function to list available habit module commands.
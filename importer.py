@@ -0,0 +1,269 @@
+"""
+    Bulk import of completion histories, e.g. from other habit trackers
+
+    The input holds one completion per JSON line or CSV row with the columns 'email', 'habit', 'periodicity' and
+    'timestamp' (ISO format), JSON lines may also list several completions as 'timestamps'. The file is streamed in
+    chunks: missing users and habits are created and the 'completed_habit' activities are written with bulk inserts,
+    one transaction per chunk. Afterwards the streaks, the next cycle and the statistics of the affected habits are
+    derived from their whole history (see streak.compute_streaks() and dbutil.rebuild_stats()) instead of replaying
+    complete() and update() for every period.
+
+    A habit tracks from its earliest completion on, so imported history before the creation of an existing habit moves
+    its creation back. The import is not idempotent, importing a file twice records its completions twice. An invalid
+    record stops the import, the chunks before it stay imported and are backfilled.
+
+    Usage: python importer.py <file> --password <password of new users> [--format jsonl|csv] [--chunk-size 10000]
+"""
+
+import argparse
+import csv
+import json
+import sys
+from datetime import datetime
+from itertools import islice
+from uuid import uuid4
+
+from sqlalchemy import func, insert, select, update
+
+import dbutil
+import imports
+from activity import Activity, ActivityArchive, Category, describe
+from habit import Habit, Periodicity
+from streak import compute_streaks
+from user import User, hash_password
+
+
+def read_records(stream, input_format='jsonl'):
+    """
+    Import function to parse the completions of a stream lazily.
+
+    :param stream: text stream with one record per JSON line or CSV row (with header)
+    :param input_format: 'jsonl' or 'csv'
+    :return: generator of (email, habit name, periodicity, time of completion)
+    """
+
+    if input_format == 'csv':
+        records = enumerate(csv.DictReader(stream), start=2)
+    else:
+        records = ((line_number, line) for line_number, line in enumerate(stream, start=1) if line.strip() != '')
+
+    for line_number, record in records:
+        try:
+            if input_format != 'csv':
+                record = json.loads(record)
+            periodicity = Periodicity.from_string(record['periodicity'])
+            timestamps = record['timestamps'] if 'timestamps' in record else [record['timestamp']]
+            for timestamp in timestamps:
+                yield record['email'], record['habit'], periodicity, datetime.fromisoformat(timestamp)
+        except (KeyError, TypeError, ValueError) as error:
+            raise ValueError('Invalid record in line {0}: {1!r}'.format(line_number, error))
+
+
+def lookup(session, query, column, values, chunk_size=500):
+    """
+    Import function to run a query for many values of a column, in chunks below the SQLite limit of bound parameters.
+
+    :param session: session of the unit of work
+    :param query: select query
+    :param column: column matched against the values
+    :param values: list of values
+    :param chunk_size: number of values per query
+    :return: list of rows
+    """
+
+    rows = []
+    for i in range(0, len(values), chunk_size):
+        rows.extend(session.execute(query.where(column.in_(values[i:i + chunk_size]))).fetchall())
+    return rows
+
+
+def import_chunk(records, password, touched, now):
+    """
+    Import function to write a chunk of completions in one transaction, creating the missing users and habits.
+
+    :param records: list of (email, habit name, periodicity, time of completion)
+    :param password: password hash of the new users
+    :param touched: set of the ids of the affected habits, the habits of the chunk are added
+    :param now: time of the registration of the new users
+    :return users, habits: number of created users and habits
+    """
+
+    with dbutil.unit_of_work() as session:
+        # existing users and their habits
+        emails = list({email for email, _, _, _ in records})
+        user_ids = {row.email: row.user_id for row in lookup(session, select(User.user_id, User.email), User.email,
+                                                            emails)}
+        new_users = [{'user_id': uuid4().int >> 96, 'email': email, 'password': password}
+                     for email in emails if email not in user_ids]
+        user_ids.update((row['email'], row['user_id']) for row in new_users)
+        habit_ids = {(row.user_id, row.name): row.habit_id for row in lookup(
+            session, select(Habit.habit_id, Habit.user_id, Habit.name), Habit.user_id, list(user_ids.values()))}
+
+        # new habits start with their earliest completion, the cycle is set with the streaks (see backfill())
+        new_habits, activities = {}, []
+        for email, name, periodicity, timestamp in records:
+            user_id = user_ids[email]
+            habit_id = habit_ids.get((user_id, name))
+            if habit_id is None:
+                habit_id = habit_ids[user_id, name] = uuid4().int >> 96
+                new_habits[habit_id] = {
+                    'habit_id': habit_id, 'user_id': user_id, 'name': name, 'description': '',
+                    'periodicity': periodicity, 'time_of_creation': timestamp, 'is_completed': False,
+                    'time_of_completion': datetime.min, 'next_cycle_start_time': timestamp, 'current_streak': 0,
+                    'longest_streak': 0, 'update_job_id': None}
+            elif habit_id in new_habits:
+                new_habits[habit_id]['time_of_creation'] = min(new_habits[habit_id]['time_of_creation'], timestamp)
+            touched.add(habit_id)
+            activities.append({'activity_id': uuid4().int >> 96, 'category': Category.completed_habit,
+                               'user_id': user_id, 'habit_id': habit_id, 'periodicity': None, 'timestamp': timestamp,
+                               'description': describe(Category.completed_habit, user_id, habit_id, timestamp)})
+
+        # the registrations and creations are recorded as well
+        activities.extend({'activity_id': uuid4().int >> 96, 'category': Category.user_registered,
+                           'user_id': row['user_id'], 'habit_id': None, 'periodicity': None, 'timestamp': now,
+                           'description': describe(Category.user_registered, row['user_id'], None, now)}
+                          for row in new_users)
+        activities.extend({'activity_id': uuid4().int >> 96, 'category': Category.created_habit,
+                           'user_id': row['user_id'], 'habit_id': row['habit_id'], 'periodicity': None,
+                           'timestamp': row['time_of_creation'],
+                           'description': describe(Category.created_habit, row['user_id'], row['habit_id'],
+                                                   row['time_of_creation'])}
+                          for row in new_habits.values())
+
+        if new_users:
+            session.execute(insert(User), new_users)
+        if new_habits:
+            session.execute(insert(Habit), list(new_habits.values()))
+        session.execute(insert(Activity), activities)
+
+    return len(new_users), len(new_habits)
+
+
+def backfill(habit_ids, now):
+    """
+    Import function to derive the state of habits from their completion history: the creation moves back to the
+    earliest completion, the streaks and the start of the next cycle are computed from the periods (see
+    streak.compute_streaks()) and the statistics are rebuilt. The scheduled jobs of the habits are (re)scheduled
+    for the next cycle.
+
+    :param habit_ids: list of habit ids
+    :param now: point in time defining the current period
+    """
+
+    # earliest completion, archived ones included (the multi-argument min() of SQLite is NULL if an argument is)
+    active, archived = [select(func.min(model.timestamp)).where(
+        model.habit_id == Habit.habit_id, model.category == Category.completed_habit).scalar_subquery()
+        for model in (Activity, ActivityArchive)]
+    completed = func.min(func.coalesce(active, archived), func.coalesce(archived, active))
+    with dbutil.unit_of_work() as session:
+        session.execute(update(Habit).where(Habit.habit_id.in_(habit_ids), completed < Habit.time_of_creation).values(
+            time_of_creation=completed).execution_options(synchronize_session=False))
+
+    streaks = compute_streaks(habit_ids=habit_ids, now=now)
+
+    with dbutil.unit_of_work() as session:
+        habits = session.execute(select(
+            Habit.habit_id, Habit.periodicity, Habit.next_cycle_start_time, Habit.update_job_id,
+            select(func.max(Activity.timestamp)).where(
+                Activity.habit_id == Habit.habit_id, Activity.category == Category.completed_habit,
+                Activity.timestamp <= now).scalar_subquery().label('time_of_completion')).where(
+            Habit.habit_id.in_(habit_ids))).fetchall()
+
+        mappings = []
+        for habit in habits:
+            next_cycle_start_time = streaks.loc[habit.habit_id, 'next_cycle_start_time'].to_pydatetime()
+            mapping = {'habit_id': habit.habit_id, 'next_cycle_start_time': next_cycle_start_time,
+                       'time_of_completion': habit.time_of_completion or datetime.min,
+                       'current_streak': int(streaks.loc[habit.habit_id, 'current_streak']),
+                       'longest_streak': int(streaks.loc[habit.habit_id, 'longest_streak']),
+                       'is_completed': bool(streaks.loc[habit.habit_id, 'is_completed'])}
+
+            # new habits get their job as in Habit(), the jobs of existing ones follow a moved cycle
+            if imports.scheduler_mode == 'per_habit':
+                from apscheduler.triggers.interval import IntervalTrigger
+
+                if habit.update_job_id is None:
+                    mapping['update_job_id'] = uuid4().hex
+                    imports.update_scheduler.add_job(
+                        id=mapping['update_job_id'], func=dbutil.new_cycle, args=(habit.habit_id,),
+                        trigger=IntervalTrigger(days=habit.periodicity.value), next_run_time=next_cycle_start_time,
+                        replace_existing=True)
+                elif next_cycle_start_time != habit.next_cycle_start_time:
+                    imports.update_scheduler.modify_job(habit.update_job_id, next_run_time=next_cycle_start_time)
+            mappings.append(mapping)
+
+        session.bulk_update_mappings(Habit, mappings)
+
+    dbutil.rebuild_stats(habit_ids=habit_ids, now=now)
+
+
+def import_completions(records, password, chunk_size=10000, now=None):
+    """
+    Import function to import a stream of completions, see the module documentation.
+
+    :param records: iterable of (email, habit name, periodicity, time of completion), see read_records()
+    :param password: password of the new users, they should change it after the first login
+    :param chunk_size: number of completions per transaction
+    :param now: point in time defining the current period
+    :return counts: number of imported completions and created users and habits
+    """
+
+    now = datetime.now() if now is None else now
+    # the new users share one password hash, hashing per user would dominate the import time
+    password = hash_password(password)
+
+    counts = {'completions': 0, 'users': 0, 'habits': 0}
+    touched = set()
+    records = iter(records)
+    try:
+        chunk = list(islice(records, chunk_size))
+        while len(chunk) != 0:
+            users, habits = import_chunk(chunk, password, touched, now)
+            counts['completions'] += len(chunk)
+            counts['users'] += users
+            counts['habits'] += habits
+            chunk = list(islice(records, chunk_size))
+    finally:
+        # the committed chunks are backfilled even if a later record is invalid, the habit ids are bound as
+        # parameters, stay below the SQLite limit
+        touched = list(touched)
+        for i in range(0, len(touched), 500):
+            backfill(touched[i:i + 500], now)
+
+        dbutil.snapshot_cache.invalidate(Habit)
+
+    return counts
+
+
+def main(argv=None):
+    """
+    Function to run an import from the command line.
+
+    :param argv: command line arguments, sys.argv if None
+    :return: exit code, 1 if the input is invalid
+    """
+
+    parser = argparse.ArgumentParser(description='Import completion histories from CSV or JSON lines.')
+    parser.add_argument('file', nargs='?', help='input file, stdin if omitted')
+    parser.add_argument('--format', choices=('jsonl', 'csv'), default='jsonl', help='input format')
+    parser.add_argument('--password', required=True, help='initial password of the new users')
+    parser.add_argument('--chunk-size', type=int, default=10000, help='completions per transaction')
+    args = parser.parse_args(argv)
+
+    stream = sys.stdin if args.file is None else open(args.file, newline='')
+    try:
+        counts = import_completions(read_records(stream, input_format=args.format), args.password,
+                                    chunk_size=args.chunk_size)
+    except ValueError as error:
+        print('ERROR: {0}'.format(error), file=sys.stderr)
+        return 1
+    finally:
+        if stream is not sys.stdin:
+            stream.close()
+
+    print('Imported {completions} completions, created {users} users and {habits} habits.'.format(**counts))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
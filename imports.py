@@ -1,20 +1,138 @@
-from apscheduler.jobstores.sqlalchemy import SQLAlchemyJobStore
-from apscheduler.schedulers.background import BackgroundScheduler
-from sqlalchemy import create_engine
+import os
+import threading
+from sqlalchemy import create_engine, event
 from sqlalchemy.ext.declarative import declarative_base
+from sqlalchemy.pool import QueuePool
 
-# initialize db engine
-Base = declarative_base()
-engine = create_engine("sqlite:///Habit_Tracker.db")
+# database location, can be overridden e.g. to run against a separate SQLite file
+db_url = os.environ.get('HABIT_TRACKER_DB_URL', 'sqlite:///Habit_Tracker.db')
 
-# configure job scheduler
-job_stores = {
-    'default': SQLAlchemyJobStore(url='sqlite:///Habit_Tracker.db')
+# SQLite pragmas applied to every new connection. 'default' keeps the durability of the SQLite defaults (every commit
+# is synced). 'tuned' is opt-in: it uses write-ahead logging so that the background scheduler can write while the CLI
+# reads, and synchronous=NORMAL which only syncs at WAL checkpoints, the last commits can be lost on a power failure.
+# WAL mode is stored in the database file, it stays on after switching back to 'default'.
+engine_profiles = {
+    'default': {},
+    'tuned': {
+        'journal_mode': 'WAL',
+        'busy_timeout': 5000,  # ms
+        'synchronous': 'NORMAL',
+        'mmap_size': 268435456,  # bytes
+        'cache_size': -65536,  # KiB
+        'temp_store': 'MEMORY',
+    },
 }
+engine_profile = engine_profiles[os.environ.get('HABIT_TRACKER_DB_PROFILE', 'default')]
+
+# connections kept open in the pool and extra connections opened under load, raise them for the HTTP service
+# (service.py) whose request threads share the engine
+pool_size = int(os.environ.get('HABIT_TRACKER_POOL_SIZE', '5'))
+max_overflow = int(os.environ.get('HABIT_TRACKER_POOL_OVERFLOW', '10'))
+
+
+def apply_profile(tuned_engine, profile):
+    """
+    Function to apply the pragmas of an engine profile to every new connection of an engine, the synchronous engine
+    and the async one of adbutil.py share it.
+
+    :param tuned_engine: database engine (the sync_engine of an async engine)
+    :param profile: dictionary of SQLite pragmas and their values
+    """
+
+    @event.listens_for(tuned_engine, 'connect')
+    def set_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        for pragma, value in profile.items():
+            cursor.execute('PRAGMA {0} = {1}'.format(pragma, value))
+        cursor.close()
+
+
+def create_tuned_engine(url, profile):
+    """
+    Function to create a database engine which applies the pragmas of an engine profile on connect.
+
+    :param url: database url
+    :param profile: dictionary of SQLite pragmas and their values
+    :return engine: database engine
+    """
+
+    # keep connections open in a pool so that the pragmas are only paid once per connection
+    tuned_engine = create_engine(url, poolclass=QueuePool, pool_size=pool_size, max_overflow=max_overflow,
+                                 connect_args={'check_same_thread': False})
+    apply_profile(tuned_engine, profile)
+
+    return tuned_engine
+
+
+# initialize db engine
+Base = declarative_base()
+engine = create_tuned_engine(db_url, engine_profile)
 
 job_defaults = {
     'coalesce': True,
     'max_instances': 4,
 }
 
-update_scheduler = BackgroundScheduler(jobstores=job_stores, job_defaults=job_defaults)
\ No newline at end of file
+_scheduler_lock = threading.Lock()
+
+
+def __getattr__(name):
+    """
+    Module attribute hook to configure the job scheduler ('update_scheduler') and its job stores ('job_stores') on
+    first use, so that starting the CLI does not pay for importing and constructing APScheduler.
+
+    :param name: attribute name
+    :return: the attribute
+    """
+
+    if name not in ('job_stores', 'update_scheduler'):
+        raise AttributeError("module 'imports' has no attribute '{0}'".format(name))
+
+    from apscheduler.jobstores.sqlalchemy import SQLAlchemyJobStore
+    from apscheduler.schedulers.background import BackgroundScheduler
+
+    with _scheduler_lock:
+        if 'update_scheduler' not in globals():
+            # configure job scheduler (the job store shares the engine and therefore its profile)
+            stores = {'default': SQLAlchemyJobStore(engine=engine)}
+            globals()['job_stores'] = stores
+            globals()['update_scheduler'] = BackgroundScheduler(jobstores=stores, job_defaults=job_defaults)
+
+    return globals()[name]
+
+
+# 'per_habit': every habit has its own interval job calling dbutil.new_cycle, 'sweeper': a single job at midnight calls
+# dbutil.sweep_cycles which starts the next cycle of all due habits at once
+scheduler_mode = os.environ.get('HABIT_TRACKER_SCHEDULER', 'per_habit')
+
+# 'verbose': every activity stores its English description, 'compact': only the structured columns are stored and the
+# description is rendered from them when it is read (see Activity.description and dbutil.compact_activity)
+activity_storage = os.environ.get('HABIT_TRACKER_ACTIVITY_STORAGE', 'verbose')
+
+# audit policy of activity categories, e.g. 'read=coalesced,displayed_habit=off' (see dbutil.audit_activity), the
+# share of recorded activities with 'sampled' and the time window in seconds of 'coalesced'
+audit_policy = os.environ.get('HABIT_TRACKER_AUDIT_POLICY', '')
+audit_sample_rate = float(os.environ.get('HABIT_TRACKER_AUDIT_SAMPLE_RATE', '0.1'))
+audit_window = float(os.environ.get('HABIT_TRACKER_AUDIT_WINDOW', '300'))
+
+# in-process cache of Habit and User snapshots for dbutil.fetch_from_db, number of entries (0 disables the cache) and
+# seconds until an entry expires, which bounds the staleness of changes made by other processes
+cache_size = int(os.environ.get('HABIT_TRACKER_CACHE_SIZE', '1024'))
+cache_ttl = float(os.environ.get('HABIT_TRACKER_CACHE_TTL', '60'))
+
+# cost of the password hashes (PBKDF2-SHA256 iterations), stored hashes of a lower cost are upgraded at the next login
+kdf_iterations = int(os.environ.get('HABIT_TRACKER_KDF_ITERATIONS', '600000'))
+
+# number of threads verifying passwords (0: one per CPU), so that logins do not hold up the other requests, and how
+# long a verified password is remembered to skip the hash at the next login of the user (seconds)
+verifier_threads = int(os.environ.get('HABIT_TRACKER_VERIFIER_THREADS', '0'))
+verifier_ttl = float(os.environ.get('HABIT_TRACKER_VERIFIER_TTL', '3600'))
+
+# failed logins of an email accepted within the window (seconds) before further attempts are refused
+auth_max_failures = int(os.environ.get('HABIT_TRACKER_AUTH_MAX_FAILURES', '5'))
+auth_window = float(os.environ.get('HABIT_TRACKER_AUTH_WINDOW', '300'))
+
+# session tokens: file of the token store shared by the CLI and the HTTP service (it holds the signing key, keep it
+# private) and the lifetime of a token in seconds
+token_store_path = os.environ.get('HABIT_TRACKER_TOKEN_STORE', 'Habit_Tracker.tokens.json')
+token_ttl = float(os.environ.get('HABIT_TRACKER_TOKEN_TTL', str(7 * 24 * 3600)))
@@ -0,0 +1,123 @@
+"""
+    Synthetic load generator for performance tests, see 'python dbsetup.py --help' and bench_hotpaths.py
+"""
+
+import random
+from datetime import datetime, timedelta
+from sqlalchemy import func, insert, select
+
+from imports import engine
+from activity import Activity, Category, describe
+from habit import Habit, HabitStats, Periodicity
+from user import User, hash_password
+
+
+def simulate_habit(rng, user_id, habit_id, periodicity, weeks, adherence, now):
+    """
+    Load generator function to simulate the completion history of a habit. Every period since the creation of the
+    habit is completed with the probability 'adherence'. The streak attributes are left at their initial values, they
+    are derived from the inserted history by streak.repair_streaks().
+
+    :param rng: random number generator
+    :param user_id: id of the owner
+    :param habit_id: id of the habit
+    :param periodicity: periodicity of the habit
+    :param weeks: length of the history in weeks
+    :param adherence: probability of a period to be completed
+    :param now: end of the history
+    :return habit, stats, activities: row of the habit, row of its statistics and rows of its activities
+    """
+
+    first_day = datetime.combine((now - timedelta(weeks=weeks)).date(), datetime.min.time())
+    days = periodicity.value
+    current_period = (now - first_day).days // days
+
+    activities = [{'category': Category.created_habit, 'user_id': user_id, 'habit_id': habit_id,
+                   'timestamp': first_day,
+                   'description': describe(Category.created_habit, user_id, habit_id, first_day)}]
+
+    time_of_completion, completions, is_completed = None, 0, False
+    for period in range(current_period + 1):
+        is_completed = rng.random() < adherence
+        if is_completed:
+            time_of_completion = min(first_day + timedelta(days=period * days + rng.randrange(days),
+                                                           seconds=rng.randrange(86400)), now)
+            activities.append({'category': Category.completed_habit, 'user_id': user_id, 'habit_id': habit_id,
+                               'timestamp': time_of_completion,
+                               'description': describe(Category.completed_habit, user_id, habit_id,
+                                                       time_of_completion)})
+            completions += 1
+
+    habit = {'habit_id': habit_id, 'user_id': user_id, 'name': '{0} habit {1}'.format(periodicity.name, habit_id),
+             'description': 'synthetic habit', 'periodicity': periodicity, 'time_of_creation': first_day,
+             'is_completed': False, 'time_of_completion': time_of_completion,
+             'next_cycle_start_time': first_day + timedelta(days=(current_period + 1) * days),
+             'current_streak': 0, 'longest_streak': 0, 'update_job_id': None}
+
+    # one completion per completed period, the current period is not missed yet
+    stats = {'habit_id': habit_id, 'user_id': user_id, 'total_completions': completions,
+             'last_completion': time_of_completion, 'periods': current_period + 1, 'completed_periods': completions,
+             'missed_periods': current_period + int(is_completed) - completions}
+
+    return habit, stats, activities
+
+
+def generate_load(users=100, habits_per_user=5, weeks=12, adherence=0.8, weekly_share=0.4, seed=None, now=None):
+    """
+    Load generator function to insert synthetic users with habits and their completion history. The rows are written
+    with bulk inserts, one transaction per user, without scheduled jobs (the habits are rolled over by the sweeper,
+    see HABIT_TRACKER_SCHEDULER). The streaks are derived from the history afterwards, see streak.repair_streaks().
+
+    :param users: number of users
+    :param habits_per_user: number of habits of each user
+    :param weeks: length of the completion history in weeks
+    :param adherence: probability of a period to be completed
+    :param weekly_share: share of weekly habits, the others are daily
+    :param seed: seed of the random number generator for reproducible data
+    :param now: end of the history
+    :return user_ids, activity_count: ids of the new users and number of inserted activities
+    """
+
+    rng = random.Random(seed)
+    now = datetime.now() if now is None else now
+    # the synthetic users share one password hash, hashing per user would dominate the generation time
+    password = hash_password('password')
+
+    with engine.connect() as connection:
+        # continue after the existing ids so that the generator can be run repeatedly
+        next_user_id = (connection.execute(select(func.max(User.user_id))).scalar() or 0) + 1
+        next_habit_id = (connection.execute(select(func.max(Habit.habit_id))).scalar() or 0) + 1
+
+    # pandas is only imported for the streaks of generated habits
+    from streak import repair_streaks
+
+    first_habit_id = next_habit_id
+    user_ids, activity_count = [], 0
+    for user_id in range(next_user_id, next_user_id + users):
+        habits, stats, activities = [], [], []
+        for habit_id in range(next_habit_id, next_habit_id + habits_per_user):
+            periodicity = Periodicity.weekly if rng.random() < weekly_share else Periodicity.daily
+            habit, habit_stats, habit_activities = simulate_habit(rng, user_id, habit_id, periodicity, weeks,
+                                                                  adherence, now)
+            habits.append(habit)
+            stats.append(habit_stats)
+            activities.extend(habit_activities)
+        next_habit_id += habits_per_user
+
+        with engine.begin() as connection:
+            connection.execute(insert(User), [{'user_id': user_id, 'name': 'user {0}'.format(user_id),
+                                               'email': 'user{0}@example.com'.format(user_id),
+                                               'password': password}])
+            connection.execute(insert(Habit), habits)
+            connection.execute(insert(HabitStats), stats)
+            connection.execute(insert(Activity), activities)
+
+        user_ids.append(user_id)
+        activity_count += len(activities)
+
+    # the habit ids are bound as parameters, stay below the SQLite limit
+    habit_ids = list(range(first_habit_id, next_habit_id))
+    for i in range(0, len(habit_ids), 500):
+        repair_streaks(habit_ids=habit_ids[i:i + 500], now=now)
+
+    return user_ids, activity_count
@@ -3,20 +3,30 @@
 """
 
 import authutil
+import dbutil
 from analysis_module import analysis_module
 from habit_module import habit_module
 from user_module import user_module
 
 print("\nWelcome to the Habit Tracker App!")
-print("\nType 'login' if you already have an account, 'register' to create an account or 'exit' to exit the "
-      "application.")
 
-# authorize user
-ret = authutil.access()
-while ret[0] == 1:
-    ret[0] = authutil.access()
+# start the periods that elapsed while the app wasn't running
+dbutil.catch_up_cycles()
+
+# resume the session of the last login, otherwise authorize user
+user_id = authutil.resume_session()
+if user_id is None:
+    print("\nType 'login' if you already have an account, 'register' to create an account or 'exit' to exit the "
+          "application.")
+
+    ret = authutil.access()
+    while ret[0] == 1:
+        ret[0] = authutil.access()
+
+    user_id = ret[1]
+else:
+    print("\nWelcome back! Type 'logout' in the user module to end your session.")
 
-user_id = ret[1]
 print('Access granted. User ID:', user_id, '\nHave fun!')
 
 # display available modules after successful access. each module can be thought of as a different screen.
@@ -0,0 +1,39 @@
+"""
+    Switch the scheduled jobs of an existing database to another scheduler mode
+
+    The mode is configured with HABIT_TRACKER_SCHEDULER (see imports.scheduler_mode). 'python dbsetup.py' applies it
+    to a new database only, run this script after changing the mode of an existing one. The habits, their streaks and
+    the activity log are kept.
+
+    Usage: python migrate_scheduler.py [--mode per_habit|sweeper]
+"""
+
+import argparse
+
+import imports
+from dbutil import migrate_scheduler
+
+
+def main(argv=None):
+    """
+    Function to switch the scheduler mode of the database.
+
+    :param argv: command line arguments, sys.argv if None
+    """
+
+    parser = argparse.ArgumentParser(description='Switch the scheduled jobs to another scheduler mode.')
+    parser.add_argument('--mode', choices=('per_habit', 'sweeper'), default=imports.scheduler_mode,
+                        help='scheduler mode, HABIT_TRACKER_SCHEDULER if omitted')
+    args = parser.parse_args(argv)
+
+    # the jobs are stored by a started scheduler, paused so that none of them runs here
+    imports.update_scheduler.start(paused=True)
+    try:
+        migrate_scheduler(mode=args.mode)
+    finally:
+        imports.update_scheduler.shutdown()
+    print('Switched the scheduled jobs to the {0} mode.'.format(args.mode))
+
+
+if __name__ == '__main__':
+    main()
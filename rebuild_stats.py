@@ -0,0 +1,31 @@
+"""
+    Recompute the habit statistics (HabitStats) from the activity log
+
+    The statistics are maintained with every completion and period rollover. Rebuild them after the activities were
+    changed outside of the application, e.g. by bulk imports, or to repair them.
+
+    Usage: python rebuild_stats.py [--user-id 1234567890]
+"""
+
+import argparse
+
+from dbutil import rebuild_stats
+
+
+def main(argv=None):
+    """
+    Function to rebuild the statistics of one user or of all users.
+
+    :param argv: command line arguments, sys.argv if None
+    """
+
+    parser = argparse.ArgumentParser(description='Recompute the habit statistics from the activity log.')
+    parser.add_argument('--user-id', type=int, default=None, help='rebuild the habits of this user only')
+    args = parser.parse_args(argv)
+
+    count = rebuild_stats(user_id=args.user_id)
+    print('Rebuilt the statistics of {0} habits.'.format(count))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,117 @@
+from datetime import datetime, timedelta
+from sqlalchemy import select, delete, and_, func
+from sqlalchemy.dialects.sqlite import insert
+
+import dbutil
+import imports
+from activity import Activity, ActivityArchive, ActivityRollup, read_categories
+
+# default retention policy
+rollup_after = timedelta(days=30)
+archive_after = timedelta(days=365)
+batch_size = 5000
+
+
+def _chunks(condition, size):
+    """
+    Retention helper to split the activities matching a condition into chunks of about 'size' activities in
+    chronological order, each processed in a transaction of its own so that the job never blocks the app for long.
+
+    :param condition: SQL condition on 'Activity'
+    :param size: number of activities per chunk
+    :return: generator of (session, condition of the chunk), the last chunk covers the remaining activities
+    """
+
+    last = False
+    while not last:
+        with dbutil.unit_of_work() as session:
+            # timestamp of the last activity of the chunk, activities with the same timestamp go in the same chunk
+            boundary = session.execute(select(Activity.timestamp).where(condition).order_by(
+                Activity.timestamp).offset(size - 1).limit(1)).scalar()
+            last = boundary is None
+            yield session, condition if last else and_(condition, Activity.timestamp <= boundary)
+
+
+def rollup_activity(now=None, older_than=rollup_after, size=batch_size):
+    """
+    Retention function to replace the read-type activities older than 'older_than' with daily counts per user and
+    category in 'ActivityRollup'.
+
+    :param now: point in time the age is measured from
+    :param older_than: age of the activities to roll up
+    :param size: number of activities per transaction
+    :return count: number of rolled up activities
+    """
+
+    # include the pending activities
+    dbutil.activity_logger.flush()
+
+    now = datetime.now() if now is None else now
+    condition = and_(Activity.category.in_(read_categories), Activity.timestamp < now - older_than)
+
+    count = 0
+    for session, chunk in _chunks(condition, size):
+        day = func.date(Activity.timestamp)
+        counts = insert(ActivityRollup).from_select(
+            ['user_id', 'day', 'category', 'count'],
+            select(Activity.user_id, day, Activity.category, func.count()).where(chunk).group_by(
+                Activity.user_id, day, Activity.category))
+        session.execute(counts.on_conflict_do_update(
+            index_elements=['user_id', 'day', 'category'],
+            set_={'count': ActivityRollup.count + counts.excluded['count']}))
+
+        count += session.execute(delete(Activity).where(chunk).execution_options(synchronize_session=False)).rowcount
+
+    return count
+
+
+def archive_activity(now=None, older_than=archive_after, size=batch_size):
+    """
+    Retention function to move the activities older than 'older_than' to 'ActivityArchive'.
+
+    :param now: point in time the age is measured from
+    :param older_than: age of the activities to archive
+    :param size: number of activities per transaction
+    :return count: number of archived activities
+    """
+
+    # include the pending activities
+    dbutil.activity_logger.flush()
+
+    now = datetime.now() if now is None else now
+    condition = Activity.timestamp < now - older_than
+
+    columns = ['activity_id', 'category', 'description', 'timestamp', 'user_id', 'habit_id', 'periodicity']
+    count = 0
+    for session, chunk in _chunks(condition, size):
+        session.execute(insert(ActivityArchive).from_select(columns, select(
+            *[Activity.__table__.c[column] for column in columns]).where(chunk)))
+
+        count += session.execute(delete(Activity).where(chunk).execution_options(synchronize_session=False)).rowcount
+
+    return count
+
+
+def run_retention(now=None):
+    """
+    Retention function to apply the retention policy, called by the scheduled job (see schedule_retention()).
+
+    :param now: point in time the age is measured from
+    :return: numbers of rolled up and archived activities
+    """
+
+    return rollup_activity(now=now), archive_activity(now=now)
+
+
+def schedule_retention(hours=1):
+    """
+    Retention function to schedule the retention policy as a job of the background scheduler. Each run only processes
+    the activities that aged since the last one.
+
+    :param hours: interval of the job
+    """
+
+    from apscheduler.triggers.interval import IntervalTrigger
+
+    imports.update_scheduler.add_job(id='activity_retention', func=run_retention, trigger=IntervalTrigger(hours=hours),
+                                     replace_existing=True)
@@ -0,0 +1,405 @@
+"""
+    Local HTTP/JSON service
+
+    Serves the user, habit and analysis operations to many clients from one long-running process. Every request runs
+    in a thread of its own and the threads share the pooled database engine, the snapshot cache and the background
+    scheduler. Requests and responses are JSON, clients register or log in once and pass the returned token (see
+    tokenutil.py) as 'Authorization: Bearer <token>', e.g.
+
+        curl -X POST localhost:8000/login -d '{"email": "email", "password": "pass"}'
+        curl -H 'Authorization: Bearer <token>' localhost:8000/habits
+
+    Usage: python service.py [--host HOST] [--port PORT] [--verbose]
+"""
+
+import argparse
+import json
+import re
+from collections import namedtuple
+from datetime import datetime
+from enum import Enum
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit, parse_qsl
+from sqlalchemy import exc
+
+import authutil
+import dbutil
+import imports
+import retention
+import tokenutil
+from activity import Activity, Category
+from batch import run_command
+from habit import Habit
+from user import User
+
+# keyset pagination cursor of the activity pages, the last activity of the previous page
+Cursor = namedtuple('Cursor', ['timestamp', 'activity_id'])
+
+# routes: (method, path pattern, handler name), the groups of the pattern are passed as integer arguments
+routes = [
+    ('POST', r'/register', 'register'),
+    ('POST', r'/login', 'login'),
+    ('POST', r'/logout', 'logout'),
+    ('GET', r'/user', 'get_user'),
+    ('PATCH', r'/user', 'edit_user'),
+    ('DELETE', r'/user', 'delete_user'),
+    ('GET', r'/user/activity', 'get_activity'),
+    ('GET', r'/habits', 'list_habits'),
+    ('POST', r'/habits', 'create_habit'),
+    ('GET', r'/habits/(\d+)', 'get_habit'),
+    ('PATCH', r'/habits/(\d+)', 'edit_habit'),
+    ('DELETE', r'/habits/(\d+)', 'delete_habit'),
+    ('POST', r'/habits/(\d+)/complete', 'complete_habit'),
+    ('GET', r'/habits/(\d+)/activity', 'get_activity'),
+    ('GET', r'/habits/(\d+)/streak', 'get_streak'),
+    ('GET', r'/habits/(\d+)/stats', 'get_stats'),
+    ('GET', r'/stats', 'get_stats'),
+    ('GET', r'/streaks/longest', 'get_streak'),
+    ('GET', r'/streaks/leaderboard', 'get_leaderboard'),
+]
+
+
+def to_json(value):
+    """
+    Function to serialize the values JSON does not support, enums (categories, periodicities) by their names.
+
+    :param value: value
+    :return: serializable value
+    """
+
+    return value.name if isinstance(value, Enum) else str(value)
+
+
+class HTTPError(Exception):
+    """
+    Exception to answer a request with an HTTP error status.
+    """
+
+    def __init__(self, status, message):
+        """
+        Constructor for 'HTTPError' class.
+
+        :param status: HTTP status code
+        :param message: error message of the response
+        """
+
+        super().__init__(message)
+        self.status = status
+
+
+class HabitTrackerHandler(BaseHTTPRequestHandler):
+    """
+    Request handler of the Habit Tracker service, one instance per request.
+    """
+
+    protocol_version = 'HTTP/1.1'  # keep-alive, clients reuse their connection
+
+    def do_GET(self):
+        self.dispatch('GET')
+
+    def do_POST(self):
+        self.dispatch('POST')
+
+    def do_PATCH(self):
+        self.dispatch('PATCH')
+
+    def do_DELETE(self):
+        self.dispatch('DELETE')
+
+    def dispatch(self, method):
+        """
+        HabitTrackerHandler class method to route a request to its handler and write the JSON response.
+
+        :param method: HTTP method
+        """
+
+        url = urlsplit(self.path)
+        self.query = dict(parse_qsl(url.query))
+
+        try:
+            for route_method, pattern, name in routes:
+                match = re.fullmatch(pattern, url.path)
+                if match is not None and route_method == method:
+                    body = self.read_body()
+                    status, result = getattr(self, name)(*[int(group) for group in match.groups()], **body)
+                    break
+            else:
+                # skip the body, the next request on the keep-alive connection starts after it
+                self.rfile.read(int(self.headers.get('Content-Length', 0)))
+                raise HTTPError(404, 'Not found: {0} {1}'.format(method, url.path))
+
+        except HTTPError as error:
+            status, result = error.status, {'error': str(error)}
+
+        except exc.IntegrityError:
+            status, result = 409, {'error': 'This entity already exist in the database.'}
+
+        except (KeyError, TypeError, ValueError) as error:
+            # missing or invalid arguments
+            status, result = 400, {'error': repr(error)}
+
+        except Exception as error:
+            status, result = 500, {'error': repr(error)}
+
+        self.write_json(status, result)
+
+    def read_body(self):
+        """
+        HabitTrackerHandler class method to parse the JSON body of the request.
+
+        :return body: dictionary of arguments, empty if there is no body
+        """
+
+        length = int(self.headers.get('Content-Length', 0))
+        if length == 0:
+            return {}
+
+        body = json.loads(self.rfile.read(length))
+        if not isinstance(body, dict):
+            raise ValueError('The request body must be a JSON object')
+        return body
+
+    def write_json(self, status, result):
+        """
+        HabitTrackerHandler class method to write a JSON response.
+
+        :param status: HTTP status code
+        :param result: JSON serializable result
+        """
+
+        data = json.dumps(result, default=to_json).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            super().log_message(format, *args)
+
+    def current_user(self):
+        """
+        HabitTrackerHandler class method to authenticate the request by its session token.
+
+        :return user_id: the current user
+        """
+
+        authorization = self.headers.get('Authorization', '')
+        user_id = None
+        if authorization.startswith('Bearer '):
+            user_id = self.server.tokens.verify(authorization[len('Bearer '):])
+        if user_id is None:
+            raise HTTPError(401, 'Log in first and pass the token as "Authorization: Bearer <token>"')
+        return user_id
+
+    def own_habit(self, user_id, habit_id):
+        """
+        HabitTrackerHandler class method to check that a habit exists and belongs to the current user.
+
+        :param user_id: the current user
+        :param habit_id: habit id
+        """
+
+        with dbutil.unit_of_work(read_only=True) as session:
+            owner = session.query(Habit.user_id).filter(Habit.habit_id == habit_id).scalar()
+        if owner != user_id:
+            raise HTTPError(404, 'This Habit ID does not exist!')
+
+    # user operations
+
+    def register(self, email, password, name=None):
+        with dbutil.unit_of_work():
+            user = User(email=email, password=password, name=name)
+            dbutil.insert_into_db(user)
+            user_id = user.user_id
+            dbutil.log_activity(Activity(category=Category.user_registered, user_id=user_id))
+
+        return 201, {'user_id': user_id, 'token': self.server.tokens.issue(user_id)}
+
+    def login(self, email, password):
+        try:
+            user_id = authutil.authenticate(email, password)
+        except authutil.TooManyAttempts:
+            raise HTTPError(429, 'Too many failed logins, try again later.')
+        if user_id is None:
+            raise HTTPError(401, 'Either email or password is wrong.')
+
+        dbutil.log_activity(Activity(category=Category.logged_in, user_id=user_id[0]))
+        return 200, {'user_id': user_id[0], 'token': self.server.tokens.issue(user_id[0])}
+
+    def logout(self):
+        self.current_user()
+        self.server.tokens.revoke(token=self.headers['Authorization'][len('Bearer '):])
+        return 200, {}
+
+    def get_user(self):
+        user_id = self.current_user()
+        with dbutil.unit_of_work(read_only=True) as session:
+            user = session.get(User, user_id)
+            result = {'user_id': user.user_id, 'name': user.name, 'email': user.email}
+        dbutil.log_activity(Activity(category=Category.displayed_user_info, user_id=user_id))
+        return 200, result
+
+    def edit_user(self, name=None, email=None, password=None):
+        user_id = self.current_user()
+        dbutil.update_in_db(user_id, User, (name, email, password))
+        if password in ('', None):
+            return 200, {'user_id': user_id}
+
+        # a new password revokes the tokens of the user, continue with a new one
+        return 200, {'user_id': user_id, 'token': self.server.tokens.issue(user_id)}
+
+    def delete_user(self):
+        user_id = self.current_user()
+        # delete user from the database (all associated entities are removed as well), its tokens are revoked
+        dbutil.delete_from_db(user_id, User)
+        return 200, {'user_id': user_id}
+
+    def get_activity(self, habit_id=None):
+        """
+        HabitTrackerHandler class method to answer one page of the activity of the current user, optionally on a
+        habit. The response holds the cursor of the next page ('next', pass it as query parameter 'after'), None on
+        the last page.
+
+        :param habit_id: habit id, all activities of the user if None
+        :return: status and result
+        """
+
+        user_id = self.current_user()
+        if habit_id is not None:
+            self.own_habit(user_id, habit_id)
+
+        page_size = min(int(self.query.get('page_size', 500)), 5000)
+        categories = self.query.get('categories')
+        query = dbutil.activity_query(
+            user_id, habit_id=habit_id, page_size=page_size,
+            start=None if 'start' not in self.query else datetime.fromisoformat(self.query['start']),
+            end=None if 'end' not in self.query else datetime.fromisoformat(self.query['end']),
+            categories=None if categories is None else [Category.from_string(category)
+                                                        for category in categories.split(',')])
+
+        after = self.query.get('after')
+        if after is None:
+            # write pending activities first to read the complete history, the display is recorded once per listing
+            dbutil.activity_logger.flush()
+            dbutil.log_activity(Activity(category=Category.displayed_activity if habit_id is None else
+                                         Category.displayed_activity_on_habit, user_id=user_id, habit_id=habit_id))
+        else:
+            timestamp, activity_id = after.rsplit(',', 1)
+            query = dbutil.next_page_query(query, [Cursor(datetime.fromisoformat(timestamp), int(activity_id))])
+
+        with dbutil.unit_of_work(read_only=True) as session:
+            page = session.execute(query).fetchall()
+
+        cursor = None
+        if len(page) == page_size:
+            cursor = '{0},{1}'.format(page[-1].timestamp.isoformat(), page[-1].activity_id)
+        return 200, {'activities': [dict(row._mapping) for row in page], 'next': cursor}
+
+    # habit and analysis operations, executed with the logic of the batch mode
+
+    def list_habits(self):
+        user_id = self.current_user()
+        if 'periodicity' in self.query:
+            return 200, run_command(user_id, 'list_my_habits_with_periodicity', self.query)
+        return 200, run_command(user_id, 'list_my_habits', {})
+
+    def create_habit(self, name, periodicity, description=None):
+        args = {'name': name, 'periodicity': periodicity, 'description': description}
+        return 201, run_command(self.current_user(), 'create_habit', args)
+
+    def get_habit(self, habit_id):
+        user_id = self.current_user()
+        self.own_habit(user_id, habit_id)
+        with dbutil.unit_of_work(read_only=True) as session:
+            habit = session.get(Habit, habit_id)
+            result = {column.key: getattr(habit, column.key) for column in Habit.__table__.columns}
+        dbutil.log_activity(Activity(category=Category.displayed_habit, user_id=user_id, habit_id=habit_id))
+        return 200, result
+
+    def edit_habit(self, habit_id, name=None, description=None, periodicity=''):
+        user_id = self.current_user()
+        self.own_habit(user_id, habit_id)
+        args = {'habit_id': habit_id, 'name': name, 'description': description, 'periodicity': periodicity}
+        return 200, run_command(user_id, 'edit_habit', args)
+
+    def delete_habit(self, habit_id):
+        user_id = self.current_user()
+        self.own_habit(user_id, habit_id)
+        return 200, run_command(user_id, 'delete_habit', {'habit_id': habit_id})
+
+    def complete_habit(self, habit_id):
+        user_id = self.current_user()
+        self.own_habit(user_id, habit_id)
+        return 200, run_command(user_id, 'complete_habit', {'habit_id': habit_id})
+
+    def get_streak(self, habit_id=None):
+        user_id = self.current_user()
+        if habit_id is None:
+            return 200, run_command(user_id, 'get_the_habit_with_the_longest_streak', {})
+        self.own_habit(user_id, habit_id)
+        return 200, run_command(user_id, 'get_the_longest_streak_of_a_habit', {'habit_id': habit_id})
+
+    def get_stats(self, habit_id=None):
+        user_id = self.current_user()
+        if habit_id is None:
+            return 200, run_command(user_id, 'get_my_habit_stats', {})
+        self.own_habit(user_id, habit_id)
+        return 200, run_command(user_id, 'get_my_habit_stats', {'habit_id': habit_id})
+
+    def get_leaderboard(self):
+        return 200, run_command(self.current_user(), 'get_my_streak_leaderboard', self.query)
+
+
+def make_server(host='127.0.0.1', port=8000, verbose=False):
+    """
+    Function to create the HTTP server of the service, port 0 picks a free port.
+
+    :param host: interface to listen on
+    :param port: port to listen on
+    :param verbose: if True, every request is logged to stderr
+    :return server: the HTTP server, call serve_forever() to run it
+    """
+
+    server = ThreadingHTTPServer((host, port), HabitTrackerHandler)
+    server.daemon_threads = True
+    server.tokens = tokenutil.token_store
+    server.verbose = verbose
+    return server
+
+
+def main(argv=None):
+    """
+    Entry point of the HTTP service.
+
+    :param argv: command line arguments
+    """
+
+    parser = argparse.ArgumentParser(description='Serve the Habit Tracker over HTTP/JSON.')
+    parser.add_argument('--host', default='127.0.0.1', help='interface to listen on')
+    parser.add_argument('--port', type=int, default=8000, help='port to listen on')
+    parser.add_argument('--verbose', action='store_true', help='log every request')
+    args = parser.parse_args(argv)
+
+    server = make_server(args.host, args.port, args.verbose)
+    # the service runs the period rollover of the habits and the retention policy. the periods missed while no
+    # scheduler ran are caught up before the jobs resume
+    imports.update_scheduler.start(paused=True)
+    retention.schedule_retention()
+    dbutil.catch_up_cycles()
+    imports.update_scheduler.resume()
+    print('Serving the Habit Tracker on http://{0}:{1}'.format(*server.server_address))
+
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        imports.update_scheduler.shutdown()
+        dbutil.activity_logger.flush()
+
+
+if __name__ == '__main__':
+    main()
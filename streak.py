@@ -0,0 +1,119 @@
+import pandas
+from datetime import datetime
+from sqlalchemy import select, union_all
+
+import dbutil
+import imports
+from activity import Activity, ActivityArchive, Category
+from habit import Habit
+
+
+def compute_streaks(user_id=None, habit_ids=None, now=None):
+    """
+    Streak function to derive the streaks of habits from their 'completed_habit' activities, archived ones included,
+    instead of the counters maintained by Habit.complete() and Habit.update(). The completions are bucketed into
+    periods of the habit periodicity counted from the day the habit was created, and the streaks of all habits are
+    computed at once with vectorized operations.
+
+    :param user_id: id of the user whose habits are evaluated, all users if None
+    :param habit_ids: ids of the habits to evaluate, all habits (of the user) if None
+    :param now: point in time defining the current period
+    :return streaks: data frame indexed by habit_id with the columns 'current_streak', 'longest_streak',
+        'is_completed' and 'next_cycle_start_time' (start of the period after the current one)
+    """
+
+    now = datetime.now() if now is None else now
+
+    with dbutil.unit_of_work(read_only=True) as session:
+        habit_query = select(Habit.habit_id, Habit.periodicity, Habit.time_of_creation)
+        if user_id is not None:
+            habit_query = habit_query.where(Habit.user_id == user_id)
+        if habit_ids is not None:
+            habit_query = habit_query.where(Habit.habit_id.in_(habit_ids))
+        completion_queries = []
+        for model in (Activity, ActivityArchive):
+            completion_query = select(model.habit_id, model.timestamp).join(
+                Habit, Habit.habit_id == model.habit_id).where(model.category == Category.completed_habit)
+            if user_id is not None:
+                completion_query = completion_query.where(Habit.user_id == user_id)
+            if habit_ids is not None:
+                completion_query = completion_query.where(Habit.habit_id.in_(habit_ids))
+            completion_queries.append(completion_query)
+
+        habits = pandas.DataFrame(session.execute(habit_query).fetchall(),
+                                  columns=['habit_id', 'periodicity', 'time_of_creation'])
+        completions = pandas.DataFrame(session.execute(union_all(*completion_queries)).fetchall(),
+                                       columns=['habit_id', 'timestamp'])
+
+    habits = habits.set_index('habit_id')
+    habits['days'] = habits['periodicity'].map(lambda periodicity: periodicity.value).astype('int64')
+    habits['first_day'] = pandas.to_datetime(habits['time_of_creation']).dt.normalize()
+    habits['current_period'] = (pandas.Timestamp(now).normalize() - habits['first_day']).dt.days // habits['days']
+
+    # period index of every completion, several completions in the same period count once
+    completions = completions.join(habits[['days', 'first_day', 'current_period']], on='habit_id')
+    completions['period'] = (pandas.to_datetime(completions['timestamp']).dt.normalize() -
+                             completions['first_day']).dt.days // completions['days']
+    periods = completions.loc[completions['period'] <= completions['current_period'], ['habit_id', 'period']]
+    periods = periods.drop_duplicates().sort_values(['habit_id', 'period'])
+
+    # consecutive periods of the same habit form a run, a gap or another habit starts a new one
+    new_run = (periods['habit_id'] != periods['habit_id'].shift()) | \
+              (periods['period'] != periods['period'].shift() + 1)
+    runs = periods.groupby(new_run.cumsum()).agg(habit_id=('habit_id', 'first'), last_period=('period', 'max'),
+                                                   length=('period', 'size'))
+    last_runs = runs.groupby('habit_id').tail(1).set_index('habit_id')
+
+    # the last run is still alive if it reaches the current or the previous period
+    current_period = habits['current_period'].reindex(last_runs.index)
+    is_completed = last_runs['last_period'] == current_period
+    current_streak = last_runs['length'].where(last_runs['last_period'] >= current_period - 1, 0)
+
+    streaks = pandas.DataFrame(index=habits.index)
+    streaks['current_streak'] = current_streak.reindex(habits.index, fill_value=0).astype('int64')
+    streaks['longest_streak'] = runs.groupby('habit_id')['length'].max().reindex(habits.index,
+                                                                                 fill_value=0).astype('int64')
+    streaks['is_completed'] = is_completed.reindex(habits.index, fill_value=False).astype(bool)
+    streaks['next_cycle_start_time'] = habits['first_day'] + pandas.to_timedelta(
+        (habits['current_period'] + 1) * habits['days'], unit='D')
+
+    return streaks
+
+
+def repair_streaks(user_id=None, habit_ids=None, now=None):
+    """
+    Streak function to overwrite the streak counters and the start of the next cycle of habits with the values
+    derived from their completion history. The scheduled jobs of habits whose next cycle moves are moved with it. Note
+    that the history of a user is gone after 'delete_my_activity', the streaks would be reset then.
+
+    :param user_id: id of the user whose habits are repaired, all users if None
+    :param habit_ids: ids of the habits to repair, all habits (of the user) if None
+    :param now: point in time defining the current period
+    :return streaks: the written streaks (see compute_streaks())
+    """
+
+    streaks = compute_streaks(user_id=user_id, habit_ids=habit_ids, now=now)
+
+    next_cycles = dict(zip(streaks.index.tolist(), streaks['next_cycle_start_time'].dt.to_pydatetime().tolist()))
+
+    with dbutil.unit_of_work() as session:
+        # the jobs of the habits whose next cycle moves
+        moved = [(job_id, next_cycles[habit_id]) for habit_id, job_id, next_cycle_start_time in session.execute(
+            select(Habit.habit_id, Habit.update_job_id, Habit.next_cycle_start_time).where(
+                Habit.habit_id.in_(list(next_cycles)))).fetchall()
+                 if job_id is not None and next_cycle_start_time != next_cycles[habit_id]]
+
+        session.bulk_update_mappings(Habit, [
+            {'habit_id': habit_id, 'current_streak': current, 'longest_streak': longest, 'is_completed': completed,
+             'next_cycle_start_time': next_cycles[habit_id]}
+            for habit_id, current, longest, completed in zip(streaks.index.tolist(),
+                                                             streaks['current_streak'].tolist(),
+                                                             streaks['longest_streak'].tolist(),
+                                                             streaks['is_completed'].tolist())])
+
+    dbutil.snapshot_cache.invalidate(Habit)
+
+    if imports.scheduler_mode == 'per_habit' and len(moved) != 0:
+        dbutil.move_jobs(moved)
+
+    return streaks
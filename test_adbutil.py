@@ -0,0 +1,154 @@
+import asyncio
+import io
+import subprocess
+
+import pytest
+
+pytest.importorskip('aiosqlite')
+
+from sqlalchemy import select
+
+from activity import Activity, Category
+from adbutil import authenticate, insert_into_db, fetch_from_db, update_in_db, complete_in_db, delete_from_db, display_activity, \
+    iter_activity, unit_of_work
+from dbutil import Session, activity_logger
+from habit import Habit, Periodicity
+from user import User
+
+"""
+
+Test suite for adbutil functions, the counterparts of the cases in test_dbutil.py
+
+WARNING: Run the test suite instead of individual test cases as the cases depend on each other.
+
+"""
+
+user = User(name='async_user', email='async_email@domain.com', password='async_password')
+user_dict = {key: value for key, value in vars(user).items() if key != '_sa_instance_state'}
+habit = Habit(user_id=user.user_id, name='async_habit', description='async_description',
+              periodicity=Periodicity.from_string('daily'))
+habit_dict = {key: value for key, value in vars(habit).items() if key != '_sa_instance_state'}
+
+
+def db_dict(obj_type, obj_id):
+    session = Session(autoflush=True, expire_on_commit=True)
+    db_obj = session.get(obj_type, obj_id)
+    result = None if db_obj is None else {key: value for key, value in vars(db_obj).items() if
+                                          key not in ('_sa_instance_state', 'activities', 'habits')}
+    session.close()
+    return result
+
+
+@pytest.mark.parametrize('obj, obj_dict', [(user, user_dict), (habit, habit_dict)])
+def test_insert_into_db(obj, obj_dict):
+    try:
+        asyncio.run(insert_into_db(obj))
+
+        assert db_dict(type(obj), obj_dict[next(iter(obj_dict))]) == obj_dict
+    except:
+        assert False
+
+
+@pytest.mark.parametrize('obj, obj_dict', [(user, user_dict), (habit, habit_dict)])
+def test_fetch_from_db(obj, obj_dict, capsys):
+    try:
+        asyncio.run(fetch_from_db(obj_dict[next(iter(obj_dict))], type(obj)))
+
+        assert obj_dict['name'] in capsys.readouterr().out
+    except:
+        assert False
+
+
+@pytest.mark.parametrize('obj, obj_dict, values',
+                         [(user, user_dict, ('new_async_user', 'new_async_email@domain.com', 'new_async_password')),
+                          (habit, habit_dict, ('new_async_habit', 'new_async_description', 'weekly'))])
+def test_update_in_db(obj, obj_dict, values):
+    try:
+        obj_id = obj_dict[next(iter(obj_dict))]
+        asyncio.run(update_in_db(obj_id, type(obj), values))
+
+        assert db_dict(type(obj), obj_id)['name'] == values[0]
+    except:
+        assert False
+
+
+def test_authenticate():
+    try:
+        assert asyncio.run(authenticate('new_async_email@domain.com', 'new_async_password')) == (user_dict['user_id'],)
+        assert asyncio.run(authenticate('new_async_email@domain.com', 'async_password')) is None
+    except:
+        assert False
+
+
+def test_complete_in_db():
+    try:
+        habit_id = habit_dict['habit_id']
+        asyncio.run(complete_in_db(habit_id, Habit))
+
+        assert db_dict(Habit, habit_id)['is_completed'] == True
+
+        # the activity is committed with the action, not buffered
+        session = Session(autoflush=True, expire_on_commit=True)
+        assert session.execute(select(Activity.category).where(Activity.habit_id == habit_id).order_by(
+            Activity.timestamp.desc())).scalars().first() == Category.completed_habit
+        session.close()
+    except:
+        assert False
+
+
+def test_concurrent_users():
+    async def run():
+        # many fetches of the same habit served from one event loop, each in its own session
+        await asyncio.gather(*[fetch_from_db(habit_dict['habit_id'], Habit) for _ in range(20)])
+        await asyncio.gather(*[complete_in_db(habit_dict['habit_id'], Habit) for _ in range(5)])
+
+    try:
+        asyncio.run(run())
+    except:
+        assert False
+
+
+def test_unit_of_work():
+    async def run():
+        async with unit_of_work():
+            await update_in_db(habit_dict['habit_id'], Habit, ('rolled_back_habit', None, None))
+            raise ValueError()
+
+    try:
+        with pytest.raises(ValueError):
+            asyncio.run(run())
+
+        assert db_dict(Habit, habit_dict['habit_id'])['name'] == 'new_async_habit'
+    except:
+        assert False
+
+
+def test_display_activity():
+    try:
+        output = io.StringIO()
+        asyncio.run(display_activity(user_dict['user_id'], file=output, page_size=2))
+
+        async def pages():
+            return [page async for page in iter_activity(user_dict['user_id'], page_size=2)]
+
+        rows = [row for page in asyncio.run(pages()) for row in page]
+        assert output.getvalue().splitlines() == [row.description for row in rows[:-1]]
+        assert rows[-1].category == Category.displayed_activity
+    except:
+        assert False
+
+
+@pytest.mark.parametrize('obj, obj_dict', [(habit, habit_dict), (user, user_dict)])
+def test_delete_from_db(obj, obj_dict):
+    try:
+        obj_id = obj_dict[next(iter(obj_dict))]
+        asyncio.run(delete_from_db(obj_id, type(obj)))
+
+        assert db_dict(type(obj), obj_id) is None
+    except:
+        assert False
+
+
+def teardown_module():
+    activity_logger.flush()  # write pending activities before the database is recreated
+    subprocess.call('python dbsetup.py', shell=True)
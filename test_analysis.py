@@ -1,8 +1,8 @@
 import subprocess
 
-from analysis import list_habits, get_longest_streak, display_activity_on_habit
-from dbutil import Session
-from habit import Habit
+from analysis import list_habits, get_longest_streak, streak_leaderboard, display_activity_on_habit
+from dbutil import Session, activity_logger, insert_into_db, delete_from_db
+from habit import Habit, Periodicity
 from user import User
 
 
@@ -47,6 +47,45 @@ def test_get_longest_streak():
         assert False
 
 
+def test_get_longest_streak_per_user():
+    try:
+        session = Session(autoflush=True, expire_on_commit=True)
+        user = session.query(User).where(User.email == 'email').one_or_none()
+        other_user = session.query(User).where(User.email == 'email@domain.com').one_or_none()
+        session.close()
+
+        # another user holds the global maximum
+        other_habit = Habit(user_id=other_user.user_id, name='other habit', periodicity=Periodicity.daily)
+        other_habit.longest_streak = 100
+        other_habit_id = other_habit.habit_id
+        insert_into_db(other_habit)
+
+        results = get_longest_streak(user_id=user.user_id, display=False)
+        delete_from_db(other_habit_id, Habit)
+
+        assert [tuple(row) for row in results] == [('daily walk', 9)]
+    except:
+        assert False
+
+
+def test_streak_leaderboard():
+    try:
+        session = Session(autoflush=True, expire_on_commit=True)
+        user = session.query(User).where(User.email == 'email').one_or_none()
+        session.close()
+        print('\n')
+        results = streak_leaderboard(user_id=user.user_id, limit=4)
+
+        assert [(row.rank, row.name, row.longest_streak) for row in results][:2] == [(1, 'daily walk', 9),
+                                                                                      (2, 'drink water', 7)]
+        assert [row.rank for row in results][2:] == [3, 3]  # expected: 'do yoga' and 'date night' tie with 5
+
+        results = streak_leaderboard(limit=1, display=False)
+        assert [(row.user_id, row.longest_streak) for row in results] == [(user.user_id, 9)]
+    except:
+        assert False
+
+
 def test_get_longest_streak_of_habit():
     try:
         session = Session(autoflush=True, expire_on_commit=True)
@@ -76,4 +115,5 @@ def test_display_activity_on_habit():
 
 
 def teardown_module():
+    activity_logger.flush()  # write pending activities before the database is recreated
     subprocess.call('python dbsetup.py', shell=True)
\ No newline at end of file
@@ -0,0 +1,100 @@
+import subprocess
+from datetime import datetime, timedelta
+
+import pytest
+
+from activity import Activity, Category
+from analytics import habit_adherence, completion_heatmap, completion_trend
+from dbutil import activity_logger, insert_into_db, unit_of_work
+from habit import Habit, Periodicity
+from user import User
+
+# a user with two habits created on a Monday four weeks before 'now' and a completion history with gaps (the history of
+# test_streak.py)
+created = datetime(2022, 1, 3)
+now = created + timedelta(days=28, hours=12)
+user = User(name='analytics_user', email='analytics_email@domain.com', password='analytics_password')
+user_id = user.user_id
+daily = Habit(user_id=user_id, name='daily_analytics_habit', periodicity=Periodicity.daily, time_of_creation=created)
+weekly = Habit(user_id=user_id, name='weekly_analytics_habit', periodicity=Periodicity.weekly,
+               time_of_creation=created)
+daily_id, weekly_id = daily.habit_id, weekly.habit_id
+
+
+def setup_module():
+    with unit_of_work() as session:
+        insert_into_db(user)
+        insert_into_db(daily)
+        insert_into_db(weekly)
+
+        # daily: days 0-4, day 10, days 26-28 (including today)
+        for day in list(range(0, 5)) + [10, 26, 27, 28]:
+            session.add(Activity(category=Category.completed_habit, user_id=user_id, habit_id=daily_id,
+                                 timestamp=created + timedelta(days=day, hours=9)))
+
+        # weekly: weeks 0 and 1 twice each, week 3 (previous week), nothing in the current week
+        for day in (1, 2, 8, 9, 22):
+            session.add(Activity(category=Category.completed_habit, user_id=user_id, habit_id=weekly_id,
+                                 timestamp=created + timedelta(days=day, hours=9)))
+
+
+def test_habit_adherence():
+    try:
+        stats = habit_adherence(user_id=user_id, now=now)
+
+        assert stats.loc[daily_id, 'completions'] == 9
+        assert stats.loc[daily_id, 'periods'] == 29
+        assert stats.loc[daily_id, 'missed_periods'] == 20
+        assert stats.loc[daily_id, 'adherence_rate'] == pytest.approx(9 / 29)
+        assert stats.loc[daily_id, 'ratio_7d'] == pytest.approx(3 / 7)
+        assert stats.loc[daily_id, 'ratio_30d'] == pytest.approx(9 / 29)
+        assert stats.loc[daily_id, 'last_completion'] == created + timedelta(days=28, hours=9)
+
+        # the current week is not completed yet and not missed either
+        assert stats.loc[weekly_id, 'completions'] == 5
+        assert stats.loc[weekly_id, 'periods'] == 5
+        assert stats.loc[weekly_id, 'missed_periods'] == 1
+        assert stats.loc[weekly_id, 'adherence_rate'] == pytest.approx(3 / 4)
+        assert stats.loc[weekly_id, 'ratio_7d'] == pytest.approx(6 / 7)
+        assert stats.loc[weekly_id, 'ratio_30d'] == pytest.approx(21 / 29)
+    except:
+        assert False
+
+
+def test_completion_heatmap():
+    try:
+        heatmap = completion_heatmap(user_id=user_id, now=now)
+
+        assert heatmap.shape == (7, 24)
+        assert heatmap[9].sum() == 14
+        assert heatmap.sum().sum() == 14
+        assert heatmap.loc['Monday', 9] == 2
+        assert heatmap.loc['Tuesday', 9] == 4
+    except:
+        assert False
+
+
+def test_completion_trend():
+    try:
+        trend = completion_trend(user_id=user_id, days=7, now=now)
+
+        assert len(trend) == 7
+        assert trend.index[-1] == datetime(2022, 1, 31)
+        # covered days of both habits in the last week over the days the habits existed
+        assert trend['ratio_7d'].iloc[-1] == pytest.approx((3 + 6) / 14)
+        assert trend['ratio_30d'].iloc[-1] == pytest.approx((9 + 21) / 58)
+    except:
+        assert False
+
+
+def test_all_users():
+    try:
+        stats = habit_adherence(display=False, now=now)
+        assert {daily_id, weekly_id} <= set(stats.index)
+    except:
+        assert False
+
+
+def teardown_module():
+    activity_logger.flush()  # write pending activities before the database is recreated
+    subprocess.call('python dbsetup.py', shell=True)
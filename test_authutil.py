@@ -0,0 +1,135 @@
+import hashlib
+import subprocess
+import threading
+
+import pytest
+from sqlalchemy import insert, select
+
+import authutil
+import imports
+import tokenutil
+from authutil import authenticate, register, TooManyAttempts
+from dbutil import Session, activity_logger, insert_into_db, delete_from_db, unit_of_work, update_in_db
+from imports import engine
+from user import User, needs_rehash
+
+user = User(name='auth_user', email='auth_email@domain.com', password='auth_password')
+user_id = user.user_id
+legacy_user_id = user_id + 1
+
+
+def setup_module():
+    insert_into_db(user)
+
+    # a user whose password was stored in plain text by an earlier version
+    with engine.begin() as connection:
+        connection.execute(insert(User), [{'user_id': legacy_user_id, 'email': 'legacy_email@domain.com',
+                                           'password': 'legacy_password'}])
+
+
+def stored_password(obj_id):
+    session = Session(autoflush=True, expire_on_commit=True)
+    password = session.get(User, obj_id).password
+    session.close()
+    return password
+
+
+def test_authenticate():
+    try:
+        assert authenticate('auth_email@domain.com', 'auth_password') == (user_id,)
+        assert authenticate('auth_email@domain.com', 'wrong_password') is None
+        assert authenticate('unknown_email@domain.com', 'auth_password') is None
+
+        # the repeat login is verified by the cache
+        hits = authutil.verifier_cache.stats()['hits']
+        assert authenticate('auth_email@domain.com', 'auth_password') == (user_id,)
+        assert authutil.verifier_cache.stats()['hits'] == hits + 1
+    except:
+        assert False
+
+
+def test_rehash():
+    try:
+        assert authenticate('legacy_email@domain.com', 'legacy_password') == (legacy_user_id,)
+
+        # the plain text password is replaced by a hash on the first login
+        assert not needs_rehash(stored_password(legacy_user_id))
+        assert authenticate('legacy_email@domain.com', 'legacy_password') == (legacy_user_id,)
+        assert authenticate('legacy_email@domain.com', 'wrong_password') is None
+    except:
+        assert False
+
+
+def test_too_many_attempts():
+    try:
+        # a successful login resets the failed logins
+        assert authenticate('legacy_email@domain.com', 'legacy_password') == (legacy_user_id,)
+
+        for _ in range(imports.auth_max_failures):
+            assert authenticate('legacy_email@domain.com', 'wrong_password') is None
+
+        # even the right password is refused until the window has passed
+        with pytest.raises(TooManyAttempts):
+            authenticate('legacy_email@domain.com', 'legacy_password')
+
+        # other users are not affected
+        assert authenticate('auth_email@domain.com', 'auth_password') == (user_id,)
+    except:
+        assert False
+
+
+def test_register(monkeypatch):
+    try:
+        monkeypatch.setattr('builtins.input', lambda prompt: 'register_email@domain.com')
+        monkeypatch.setattr(authutil, 'getpass', lambda: 'register_password')
+
+        # the password is hashed once
+        hashes = []
+        pbkdf2_hmac = hashlib.pbkdf2_hmac
+        monkeypatch.setattr(hashlib, 'pbkdf2_hmac', lambda *args: hashes.append(args) or pbkdf2_hmac(*args))
+
+        registered_id = register()
+        assert len(hashes) == 1
+
+        session = Session(autoflush=True, expire_on_commit=True)
+        assert session.execute(select(User.user_id).where(User.email == 'register_email@domain.com')).scalar() == \
+            registered_id
+        session.close()
+
+        tokenutil.token_store.revoke(user_id=registered_id)
+        delete_from_db(registered_id, User)
+    except:
+        assert False
+
+
+def test_change_password(monkeypatch):
+    try:
+        token = tokenutil.token_store.issue(user_id)
+
+        # the password is verified and hashed in the verifier pool
+        threads = []
+        pbkdf2_hmac = hashlib.pbkdf2_hmac
+        monkeypatch.setattr(hashlib, 'pbkdf2_hmac',
+                            lambda *args: threads.append(threading.current_thread().name) or pbkdf2_hmac(*args))
+
+        # a rolled back change keeps the sessions
+        with pytest.raises(RuntimeError):
+            with unit_of_work():
+                update_in_db(user_id, User, (None, None, 'changed_password'))
+                raise RuntimeError
+        assert tokenutil.token_store.verify(token) == user_id
+        assert authenticate('auth_email@domain.com', 'auth_password') == (user_id,)
+
+        # a committed one closes them
+        update_in_db(user_id, User, (None, None, 'changed_password'))
+        assert tokenutil.token_store.verify(token) is None
+        assert len(threads) >= 4 and all(name.startswith('verifier') for name in threads)
+        assert authenticate('auth_email@domain.com', 'changed_password') == (user_id,)
+    except:
+        assert False
+
+def teardown_module():
+    delete_from_db(user_id, User)
+    delete_from_db(legacy_user_id, User)
+    activity_logger.flush()  # write pending activities before the database is recreated
+    subprocess.call('python dbsetup.py', shell=True)
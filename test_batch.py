@@ -0,0 +1,138 @@
+import io
+import json
+import subprocess
+
+from sqlalchemy import exc
+
+import batch
+from batch import read_commands, run_batch
+from dbutil import Session, activity_logger, insert_into_db
+from habit import Habit, Periodicity
+from user import User
+
+# a habit of another user
+other_user = User(name='other_batch_user', email='other_batch_email@domain.com', password='other_batch_password')
+other_user_id = other_user.user_id
+other_habit = Habit(user_id=other_user_id, name='other_batch_habit', periodicity=Periodicity.daily)
+other_habit_id = other_habit.habit_id
+
+
+def setup_module():
+    insert_into_db(other_user)
+    insert_into_db(other_habit)
+
+
+def run(lines, input_format='jsonl', batch_size=100):
+    session = Session(autoflush=True, expire_on_commit=True)
+    user = session.query(User).where(User.email == 'email').one_or_none()
+    session.close()
+
+    output = io.StringIO()
+    failed = run_batch(read_commands(io.StringIO('\n'.join(lines) + '\n'), input_format), user_id=user.user_id,
+                       batch_size=batch_size, output=output)
+    return failed, [json.loads(line) for line in output.getvalue().splitlines()]
+
+
+def test_run_batch():
+    try:
+        failed, results = run(['{"command": "create_habit", "name": "batch_habit", "periodicity": "daily"}',
+                               '{"command": "create_habit", "name": "bad_habit", "periodicity": "hourly"}',
+                               'not json',
+                               '{"command": "list_my_habits_with_periodicity", "periodicity": "daily"}'], batch_size=2)
+
+        assert failed == 2
+        assert [result['line'] for result in results] == [1, 2, 3, 4]
+        assert [result['status'] for result in results] == ['ok', 'error', 'error', 'ok']
+        habit_id = results[0]['result']['habit_id']
+        assert habit_id in [row['habit_id'] for row in results[3]['result']]
+
+        failed, results = run(['{"command": "complete_habit", "habit_id": %d}' % habit_id,
+                               '{"command": "display_my_activity_on_a_habit", "habit_id": %d}' % habit_id,
+                               '{"command": "delete_habit", "habit_id": %d}' % habit_id])
+
+        assert failed == 0
+        assert len(results[1]['result']) == 2  # expected: created_habit and completed_habit activities
+
+        session = Session(autoflush=True, expire_on_commit=True)
+        assert session.get(Habit, habit_id) is None
+        session.close()
+    except:
+        assert False
+
+
+def test_run_batch_csv():
+    try:
+        failed, results = run(['command,name,periodicity',
+                               'create_habit,csv_habit,weekly',
+                               'list_my_habits,,'], input_format='csv')
+
+        assert failed == 0
+        assert results[0]['line'] == 2
+        assert results[0]['result']['habit_id'] in [row['habit_id'] for row in results[1]['result']]
+    except:
+        assert False
+
+
+def test_other_users():
+    try:
+        # commands can't act as another user or on the habits of another user
+        failed, results = run(['{"command": "list_my_habits", "user_id": %d}' % other_user_id,
+                               '{"command": "complete_habit", "habit_id": %d}' % other_habit_id,
+                               '{"command": "delete_habit", "habit_id": %d}' % other_habit_id])
+
+        assert failed == 3
+        assert 'user_id' in results[0]['error']
+        assert 'does not exist' in results[1]['error']
+
+        session = Session(autoflush=True, expire_on_commit=True)
+        habit = session.get(Habit, other_habit_id)
+        assert habit is not None
+        assert habit.is_completed == False
+        session.close()
+    except:
+        assert False
+
+
+def test_failed_command_rolled_back(monkeypatch):
+    try:
+        failed, results = run(['{"command": "create_habit", "name": "savepoint_habit", "periodicity": "daily"}'])
+        habit_id = results[0]['result']['habit_id']
+
+        # the name is changed before the invalid periodicity fails the command, the change is rolled back
+        failed, results = run(['{"command": "edit_habit", "habit_id": %d, "name": "renamed", "periodicity": []}'
+                               % habit_id])
+        assert failed == 1
+
+        session = Session(autoflush=True, expire_on_commit=True)
+        assert session.get(Habit, habit_id).name == 'savepoint_habit'
+        session.close()
+
+        # a database error rolls back the batch, every command is reported
+        run_command = batch.run_command
+
+        def failing_run_command(user_id, command, args):
+            if command == 'list_my_habits':
+                raise exc.OperationalError('SELECT', {}, Exception('database is locked'))
+            return run_command(user_id, command, args)
+
+        monkeypatch.setattr(batch, 'run_command', failing_run_command)
+        failed, results = run(['{"command": "complete_habit", "habit_id": %d}' % habit_id,
+                               '{"command": "list_my_habits"}',
+                               '{"command": "delete_habit", "habit_id": %d}' % habit_id])
+
+        assert failed == 3
+        assert [result['line'] for result in results] == [1, 2, 3]
+        assert 'rolled back' in results[0]['error']
+        assert 'database is locked' in results[1]['error']
+        assert 'not executed' in results[2]['error']
+
+        session = Session(autoflush=True, expire_on_commit=True)
+        assert session.get(Habit, habit_id).is_completed == False
+        session.close()
+    except:
+        assert False
+
+
+def teardown_module():
+    activity_logger.flush()  # write pending activities before the database is recreated
+    subprocess.call('python dbsetup.py', shell=True)
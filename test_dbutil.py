@@ -1,14 +1,21 @@
+import io
 import subprocess
+import threading
 from datetime import datetime, timedelta
 
 import pytest
-from sqlalchemy import delete, select
+from apscheduler.jobstores.sqlalchemy import SQLAlchemyJobStore
+from apscheduler.schedulers.background import BackgroundScheduler
+from sqlalchemy import delete, exc, select, inspect, text
 
-from activity import Activity
+from activity import Activity, Category
 from dbutil import insert_into_db, Session, fetch_from_db, update_in_db, complete_in_db, delete_from_db, \
-    delete_activity, display_activity, new_cycle
-from habit import Habit, Periodicity
-from user import User
+    delete_activity, display_activity, new_cycle, activity_logger, log_activity, unit_of_work, migrate_indexes, \
+    sweep_cycles, complete_many, iter_activity, write_activity, compact_activity, migrate_columns, audit_activity, \
+    parse_audit_policies, snapshot_cache, SnapshotCache, catch_up_cycles, migrate_scheduler, ActivityLogger
+from habit import Habit, HabitStats, Periodicity
+from imports import engine
+from user import User, verify_password
 
 """
 
@@ -94,7 +101,7 @@ def test_update_in_db(obj, obj_dict, values, old_values):
         obj = session.get(type(obj), obj_dict.get(obj_id))
         obj.edit(*values)
         obj_dict = {key: value for key, value in vars(obj).items() if
-                    key not in ('_sa_instance_state', 'next_cycle_start_time')}
+                    key not in ('_sa_instance_state', 'next_cycle_start_time', 'password')}
         session.rollback()
         session.close()
 
@@ -105,9 +112,12 @@ def test_update_in_db(obj, obj_dict, values, old_values):
         session = Session(autoflush=True, expire_on_commit=True)
         db_obj = session.get(type(obj), obj_dict.get(obj_id))
         db_obj_dict = {key: value for key, value in vars(db_obj).items() if
-                       key not in ('_sa_instance_state', 'next_cycle_start_time', 'activities')}
+                       key not in ('_sa_instance_state', 'next_cycle_start_time', 'activities', 'password')}
 
         assert obj_dict == db_obj_dict
+        # passwords are hashed with a random salt, check the new password instead of the hash
+        if type(obj) is User:
+            assert verify_password(values[2], db_obj.password)
 
         session.rollback()
         session.close()
@@ -161,13 +171,20 @@ def test_new_cycle(obj, obj_dict):
 
         assert db_obj.next_cycle_start_time == datetime.combine(datetime.now().date(),
                                                                 datetime.min.time()) + timedelta(days=1)
+        next_cycle_start_time = db_obj.next_cycle_start_time
 
         session.rollback()
         session.close()
 
+        # the current cycle isn't over yet, the habit is left as it is
+        new_cycle(obj_dict.get(obj_id))
+        session = Session(autoflush=True, expire_on_commit=True)
+        assert session.get(type(obj), obj_dict.get(obj_id)).next_cycle_start_time == next_cycle_start_time
+        session.close()
+
         # next_cycle updates the next cycle start time by periodicity * days from the time point it is triggered
         # (updates other attrs as well w.r.t. the previous state)
-        new_cycle(obj_dict.get(obj_id))
+        new_cycle(obj_dict.get(obj_id), now=next_cycle_start_time)
 
         # after next_cycle
         session = Session(autoflush=True, expire_on_commit=True)
@@ -182,6 +199,321 @@ def test_new_cycle(obj, obj_dict):
         assert False
 
 
+@pytest.mark.parametrize('obj, obj_dict', [(user, user_dict), (habit, habit_dict)])
+def test_snapshot_cache(obj, obj_dict, capsys):
+    try:
+        obj_id = obj_dict.get(next(iter(obj_dict)))
+        snapshot_cache.invalidate(type(obj), obj_id)
+
+        # the second fetch is served from the cache and displays the same
+        before = snapshot_cache.stats()
+        fetch_from_db(obj_id, type(obj))
+        fetched = capsys.readouterr().out
+        fetch_from_db(str(obj_id), type(obj))
+        assert capsys.readouterr().out == fetched
+        after = snapshot_cache.stats()
+        assert after['misses'] == before['misses'] + 1
+        assert after['hits'] == before['hits'] + 1
+
+        # a change invalidates the snapshot
+        update_in_db(obj_id, type(obj), ('cached_name', None, None))
+        fetch_from_db(obj_id, type(obj))
+        assert 'cached_name' in capsys.readouterr().out
+        update_in_db(obj_id, type(obj), (obj_dict['name'], None, None))
+
+        # inside a unit of work the snapshot is removed after the commit, the one cached by a concurrent reader before
+        # the commit isn't kept
+        with unit_of_work():
+            update_in_db(obj_id, type(obj), ('uncommitted_name', None, None))
+            reader = threading.Thread(target=fetch_from_db, args=(obj_id, type(obj)))
+            reader.start()
+            reader.join()
+        capsys.readouterr()
+        fetch_from_db(obj_id, type(obj))
+        assert 'uncommitted_name' in capsys.readouterr().out
+        update_in_db(obj_id, type(obj), (obj_dict['name'], None, None))
+
+        # LRU eviction, expiry and snapshots read before an invalidation
+        cache = SnapshotCache(max_size=2, ttl=60.0)
+        for key in (1, 2, 3):
+            cache.put((type(obj), key), {'key': key}, cache.generation)
+        assert cache.get((type(obj), 1)) is None
+        assert cache.get((type(obj), 3)) == {'key': 3}
+        generation = cache.generation
+        cache.invalidate(type(obj), 2)
+        cache.put((type(obj), 2), {'key': 2}, generation)
+        assert cache.get((type(obj), 2)) is None
+        cache.ttl = 0.0
+        cache.put((type(obj), 4), {'key': 4}, cache.generation)
+        assert cache.get((type(obj), 4)) is None
+        assert cache.stats()['evictions'] == 1
+    except:
+        assert False
+
+
+# only available for user obj
+@pytest.mark.parametrize('obj_dict', [user_dict])
+def test_sweep_cycles(obj_dict):
+    try:
+        obj_id = next(iter(obj_dict))
+        a_week_ago = datetime.now() - timedelta(weeks=1)
+
+        # two identical habits completed in their first cycle, which is over
+        habits = [Habit(user_id=obj_dict.get(obj_id), name='sweep_habit', periodicity=Periodicity.from_string('daily'),
+                        time_of_creation=a_week_ago) for _ in range(2)]
+        for sweep_habit in habits:
+            sweep_habit.complete(time_of_completion=a_week_ago)
+        swept_id, replayed_id = [sweep_habit.habit_id for sweep_habit in habits]
+        with unit_of_work():
+            for sweep_habit in habits:
+                insert_into_db(sweep_habit)
+
+        # the sweep has the same effect as the job of a single habit
+        new_cycle(replayed_id)
+        sweep_cycles()
+
+        session = Session(autoflush=True, expire_on_commit=True)
+        swept, replayed = session.get(Habit, swept_id), session.get(Habit, replayed_id)
+
+        assert swept.current_streak == replayed.current_streak == 1
+        assert swept.longest_streak == replayed.longest_streak == 1
+        assert swept.is_completed == replayed.is_completed == False
+        assert swept.next_cycle_start_time == replayed.next_cycle_start_time
+
+        session.delete(swept)
+        session.delete(replayed)
+        session.commit()
+        session.close()
+    except:
+        assert False
+
+# only available for user obj
+@pytest.mark.parametrize('obj_dict', [user_dict])
+def test_catch_up_cycles(obj_dict):
+    try:
+        obj_id = next(iter(obj_dict))
+        ten_days_ago = datetime.now() - timedelta(days=10)
+
+        # a habit completed in its first cycle, ten more cycles started since then without a rollover
+        catch_up_habit = Habit(user_id=obj_dict.get(obj_id), name='catch_up_habit',
+                               periodicity=Periodicity.from_string('daily'), time_of_creation=ten_days_ago)
+        catch_up_habit.complete(time_of_completion=ten_days_ago)
+        catch_up_id = catch_up_habit.habit_id
+        insert_into_db(catch_up_habit)
+
+        assert catch_up_cycles() >= 1
+        # nothing is due after the catch-up
+        assert catch_up_cycles() == 0
+
+        # the streak of the completed period ends with the missed ones, the next cycle starts tomorrow
+        session = Session(autoflush=True, expire_on_commit=True)
+        caught_up = session.get(Habit, catch_up_id)
+        assert (caught_up.current_streak, caught_up.longest_streak, caught_up.is_completed) == (0, 1, False)
+        assert caught_up.next_cycle_start_time == datetime.combine(datetime.now().date() + timedelta(days=1),
+                                                                   datetime.min.time())
+
+        # all elapsed periods are counted, the first one was completed
+        stats = session.get(HabitStats, catch_up_id)
+        assert (stats.periods, stats.missed_periods) == (11, 9)
+
+        session.delete(caught_up)
+        session.commit()
+        session.close()
+    except:
+        assert False
+
+# only available for user obj
+@pytest.mark.parametrize('obj_dict', [user_dict])
+def test_complete_many(obj_dict):
+    try:
+        obj_id = next(iter(obj_dict))
+        now = datetime.now()
+
+        # two identical habits, one completed one by one, the other in bulk
+        habits = [Habit(user_id=obj_dict.get(obj_id), name='bulk_habit', periodicity=Periodicity.from_string('daily'))
+                  for _ in range(2)]
+        completed_id, bulk_id = [bulk_habit.habit_id for bulk_habit in habits]
+        with unit_of_work():
+            for bulk_habit in habits:
+                insert_into_db(bulk_habit)
+
+        complete_in_db(completed_id, Habit)
+        complete_in_db(completed_id, Habit)
+        unknown = complete_many([(bulk_id, now), (0, now), (bulk_id, now - timedelta(minutes=1))])
+        activity_logger.flush()
+
+        session = Session(autoflush=True, expire_on_commit=True)
+        completed, bulk = session.get(Habit, completed_id), session.get(Habit, bulk_id)
+
+        assert unknown == [0]
+        assert bulk.time_of_completion == now  # expected: the latest completion
+        assert completed.current_streak == bulk.current_streak == 1
+        assert completed.longest_streak == bulk.longest_streak == 1
+        assert completed.is_completed == bulk.is_completed == True
+        assert session.query(Activity).where(Activity.habit_id == bulk_id,
+                                             Activity.category == Category.completed_habit).count() == 2
+
+        session.delete(completed)
+        session.delete(bulk)
+        session.commit()
+        session.close()
+    except:
+        assert False
+
+
+# only available for user obj
+@pytest.mark.parametrize('obj_dict', [user_dict])
+def test_unit_of_work(obj_dict):
+    try:
+        obj_id = next(iter(obj_dict))
+
+        # an error inside the unit of work rolls back the habit together with its activities
+        activity_logger.flush()
+        try:
+            with unit_of_work():
+                rolled_back = Habit(user_id=obj_dict.get(obj_id), name='rolled_back_habit',
+                                    periodicity=Periodicity.from_string('daily'))
+                rolled_back_id = rolled_back.habit_id
+                insert_into_db(rolled_back)
+                raise RuntimeError()
+        except RuntimeError:
+            pass
+
+        activity_logger.flush()
+        session = Session(autoflush=True, expire_on_commit=True)
+
+        assert session.get(Habit, rolled_back_id) is None
+        assert session.query(Activity).where(Activity.habit_id == rolled_back_id).count() == 0
+
+        session.close()
+    except:
+        assert False
+
+
+# only available for user obj
+@pytest.mark.parametrize('obj_dict', [user_dict])
+def test_flush_integrity_error(obj_dict):
+    try:
+        obj_id = next(iter(obj_dict))
+
+        # an activity with the id of a stored one is dropped, the other activities of the batch are written
+        activity_logger.flush()
+        stored = Activity(category=Category.displayed_user_info, user_id=obj_dict.get(obj_id))
+        log_activity(stored)
+        activity_logger.flush()
+        duplicate = Activity(category=Category.logged_in, user_id=obj_dict.get(obj_id))
+        duplicate.activity_id = stored.activity_id
+        valid = Activity(category=Category.logged_out, user_id=obj_dict.get(obj_id))
+        log_activity(duplicate)
+        log_activity(valid)
+        activity_logger.flush()
+
+        # the buffer is empty, later flushes don't fail
+        log_activity(Activity(category=Category.displayed_user_info, user_id=obj_dict.get(obj_id)))
+        activity_logger.flush()
+        assert activity_logger._buffer == []
+
+        session = Session(autoflush=True, expire_on_commit=True)
+        assert session.get(Activity, valid.activity_id) is not None
+        assert session.get(Activity, stored.activity_id).category == Category.displayed_user_info
+        session.close()
+    except:
+        assert False
+
+
+# only available for user obj
+@pytest.mark.parametrize('obj_dict', [user_dict])
+def test_flush_full_buffer(obj_dict):
+    try:
+        obj_id = next(iter(obj_dict))
+        full_logger = ActivityLogger(max_batch_size=2, flush_interval=60.0)
+
+        # the full buffer is flushed in the background, a locked database doesn't fail the logging action
+        attempted = threading.Event()
+
+        def locked_flush():
+            attempted.set()
+            raise exc.OperationalError('INSERT INTO "Activity"', {}, Exception('database is locked'))
+
+        full_logger.flush = locked_flush
+        activities = [Activity(category=Category.displayed_user_info, user_id=obj_dict.get(obj_id)) for _ in range(2)]
+        for activity in activities:
+            full_logger.log(activity)
+        assert attempted.wait(5.0)
+        assert full_logger._buffer == activities
+
+        # the activities are kept for the next flush
+        del full_logger.flush
+        full_logger.close()
+        session = Session(autoflush=True, expire_on_commit=True)
+        assert all(session.get(Activity, activity.activity_id) is not None for activity in activities)
+        session.close()
+    except:
+        assert False
+
+# only available for user obj
+@pytest.mark.parametrize('obj_dict', [user_dict])
+def test_log_activity(obj_dict):
+    try:
+        obj_id = next(iter(obj_dict))
+        a_minute_ago = datetime.now() - timedelta(minutes=1)
+
+        # log two activities out of order, they are only buffered
+        activity_logger.flush()
+        log_activity(Activity(category=Category.displayed_user_info, user_id=obj_dict.get(obj_id)))
+        log_activity(Activity(category=Category.logged_in, user_id=obj_dict.get(obj_id), timestamp=a_minute_ago))
+
+        session = Session(autoflush=True, expire_on_commit=True)
+        count = session.query(Activity).where(Activity.user_id == obj_dict.get(obj_id)).count()
+        session.close()
+
+        # flush the buffer synchronously
+        activity_logger.flush()
+
+        session = Session(autoflush=True, expire_on_commit=True)
+        results = session.execute(
+            select(Activity.category).where(Activity.user_id == obj_dict.get(obj_id)).order_by(
+                Activity.timestamp)).fetchall()
+
+        assert len(results) == count + 2
+        assert results[-1][0] == Category.displayed_user_info  # expected: ordered by timestamp
+
+        session.close()
+    except:
+        assert False
+
+
+# only available for user obj
+@pytest.mark.parametrize('obj_dict', [user_dict])
+def test_audit_activity(obj_dict, monkeypatch):
+    try:
+        obj_id = next(iter(obj_dict))
+        user_id = obj_dict.get(obj_id)
+        now = datetime.now()
+
+        monkeypatch.setattr('dbutil.audit_policies', parse_audit_policies('read=coalesced, displayed_habit=off'))
+        monkeypatch.setattr('dbutil.audit_sample_rate', 0.0)
+
+        # coalesced: one activity per user, habit and category in a window of five minutes
+        assert audit_activity(Activity(category=Category.displayed_habits, user_id=user_id, timestamp=now))
+        assert not audit_activity(Activity(category=Category.displayed_habits, user_id=user_id,
+                                           timestamp=now + timedelta(minutes=1)))
+        assert audit_activity(Activity(category=Category.displayed_activity_on_habit, user_id=user_id, habit_id=1,
+                                       timestamp=now + timedelta(minutes=1)))
+        assert audit_activity(Activity(category=Category.displayed_habits, user_id=user_id,
+                                       timestamp=now + timedelta(minutes=6)))
+
+        # off, sampled and write categories
+        assert not audit_activity(Activity(category=Category.displayed_habit, user_id=user_id, habit_id=1))
+        monkeypatch.setattr('dbutil.audit_policies', parse_audit_policies('displayed_user_info=sampled'))
+        assert not audit_activity(Activity(category=Category.displayed_user_info, user_id=user_id))
+        assert audit_activity(Activity(category=Category.completed_habit, user_id=user_id, habit_id=1))
+        with pytest.raises(ValueError):
+            parse_audit_policies('completed_habit=off')
+    except:
+        assert False
+
+
 # only available for user obj
 @pytest.mark.parametrize('obj_dict', [user_dict])
 def test_display_activity(obj_dict):
@@ -195,6 +527,38 @@ def test_display_activity(obj_dict):
         assert False
 
 
+# only available for user obj
+@pytest.mark.parametrize('obj_dict', [user_dict])
+def test_iter_activity(obj_dict):
+    try:
+        obj_id = next(iter(obj_dict))
+        user_id = obj_dict.get(obj_id)
+
+        # activities with equal timestamps must not be skipped or repeated at page boundaries
+        timestamp = datetime(2020, 1, 1)
+        with unit_of_work():
+            for category in (Category.logged_in, Category.displayed_user_info, Category.logged_in):
+                log_activity(Activity(category=category, user_id=user_id, timestamp=timestamp))
+
+        rows = [row for page in iter_activity(user_id) for row in page]
+        pages = list(iter_activity(user_id, page_size=2))
+        assert [len(page) for page in pages][:-1] == [2] * (len(pages) - 1)
+        assert [row for page in pages for row in page] == rows
+        assert rows == sorted(rows, key=lambda row: (row.timestamp, row.activity_id))
+
+        # filters
+        pages = iter_activity(user_id, start=timestamp, end=timestamp + timedelta(days=1), categories=[Category.logged_in],
+                              page_size=1)
+        assert [len(page) for page in pages] == [1, 1]
+
+        # rendering
+        output = io.StringIO()
+        assert write_activity(iter_activity(user_id, page_size=2), file=output) == len(rows)
+        assert output.getvalue().splitlines() == [row.description for row in rows]
+    except:
+        assert False
+
+
 # only available for user obj
 @pytest.mark.parametrize('obj_dict', [user_dict])
 def test_delete_activity(obj_dict):
@@ -214,6 +578,7 @@ def test_delete_activity(obj_dict):
 
         # delete user activity (removes all previous activity but adds an activity to db for deletion)
         delete_activity(obj_dict.get(obj_id))
+        activity_logger.flush()  # activities are written behind, flush to make the new one visible
 
         # after delete_activity
         session = Session(autoflush=True, expire_on_commit=True)
@@ -263,5 +628,118 @@ def test_delete_from_db(obj, obj_dict):
         assert False
 
 
+def test_migrate_indexes():
+    try:
+        # simulate a database created before the indexes were declared
+        with engine.begin() as connection:
+            connection.execute(text('DROP INDEX IF EXISTS ix_activity_user_id_timestamp'))
+
+        migrate_indexes()
+
+        index_names = [index['name'] for index in inspect(engine).get_indexes('Activity')]
+        assert 'ix_activity_user_id_timestamp' in index_names
+
+        # the activity of a user is read in timestamp order from the index (no full scan, no sort). EXPLAIN doesn't
+        # check the schema version, a pooled connection might plan with the schema from before the index was created.
+        # the first statement makes SQLite reload the schema
+        with engine.connect() as connection:
+            connection.execute(text('SELECT 1 FROM Activity LIMIT 0')).fetchall()
+            plan = connection.execute(text('EXPLAIN QUERY PLAN SELECT description FROM Activity WHERE user_id = 1 '
+                                           'ORDER BY timestamp')).fetchall()
+        assert 'ix_activity_user_id_timestamp' in str(plan)
+        assert 'TEMP B-TREE' not in str(plan)
+    except:
+        assert False
+
+
+# only available for user obj
+@pytest.mark.parametrize('obj_dict', [user_dict])
+def test_compact_activity(obj_dict, monkeypatch):
+    try:
+        obj_id = next(iter(obj_dict))
+        user_id = obj_dict.get(obj_id)
+
+        log_activity(Activity(category=Category.displayed_habits_with_periodicity, user_id=user_id, periodicity='daily',
+                              timestamp=datetime(2020, 1, 1)))
+        activity_logger.flush()
+        descriptions = [row.description for page in iter_activity(user_id) for row in page]
+
+        # stored descriptions are stripped and rendered on read
+        assert compact_activity() > 0
+        session = Session(autoflush=True, expire_on_commit=True)
+        assert session.execute(select(Activity._description).where(Activity.user_id == user_id)).scalars().all() == \
+               [None] * len(descriptions)
+        session.close()
+        assert [row.description for page in iter_activity(user_id) for row in page] == descriptions
+
+        # compact storage does not store descriptions of new activities
+        monkeypatch.setattr('activity.activity_storage', 'compact')
+        activity = Activity(category=Category.user_registered, user_id=user_id, timestamp=datetime(2020, 1, 1))
+        assert activity._description is None
+        assert activity.description == 'A new user registered in the database with id {0} at 2020-01-01 00:00:00'.format(
+            user_id)
+    except:
+        assert False
+
+
+def test_migrate_columns():
+    try:
+        # simulate a database created before the periodicity of activities was stored
+        with engine.begin() as connection:
+            connection.execute(text('ALTER TABLE Activity DROP COLUMN periodicity'))
+        engine.dispose()
+
+        migrate_columns()
+
+        assert 'periodicity' in [column['name'] for column in inspect(engine).get_columns('Activity')]
+        engine.dispose()
+    except:
+        assert False
+
+
+def get_schedule(habit_id):
+    with unit_of_work(read_only=True) as session:
+        return session.execute(select(Habit.update_job_id, Habit.next_cycle_start_time).where(
+            Habit.habit_id == habit_id)).one()
+
+
+def test_migrate_scheduler(monkeypatch):
+    try:
+        scheduler_user = User(name='scheduler_user', email='scheduler_email@domain.com', password='scheduler_password')
+        scheduler_habit = Habit(user_id=scheduler_user.user_id, name='scheduler_habit',
+                                periodicity=Periodicity.from_string('daily'))
+        habit_id, job_id = scheduler_habit.habit_id, scheduler_habit.update_job_id
+        insert_into_db(scheduler_user)
+        insert_into_db(scheduler_habit)
+
+        # the jobs are stored by a started scheduler, as in migrate_scheduler.py. a scheduler of its own on the same
+        # table keeps the one of the test session stopped
+        stores = {'default': SQLAlchemyJobStore(engine=engine)}
+        scheduler = BackgroundScheduler(jobstores=stores)
+        monkeypatch.setattr('imports.job_stores', stores)
+        monkeypatch.setattr('imports.update_scheduler', scheduler)
+        if job_id is not None:
+            scheduler.add_job(id=job_id, func=new_cycle, args=(habit_id,), trigger='interval', days=1,
+                              next_run_time=datetime.now() + timedelta(days=1))
+        scheduler.start(paused=True)
+        try:
+            # the habit jobs are replaced by the sweeper
+            migrate_scheduler('sweeper')
+            assert job_id is None or scheduler.get_job(job_id) is None
+            assert get_schedule(habit_id).update_job_id is None
+            assert scheduler.get_job('cycle_sweeper') is not None
+
+            # and back, the habit runs its own job at the start of its next cycle
+            migrate_scheduler('per_habit')
+            assert scheduler.get_job('cycle_sweeper') is None
+            migrated = get_schedule(habit_id)
+            assert scheduler.get_job(migrated.update_job_id).next_run_time.replace(tzinfo=None) == \
+                migrated.next_cycle_start_time
+        finally:
+            scheduler.shutdown()
+    except:
+        assert False
+
 def teardown_module():
+    activity_logger.flush()  # write pending activities before the database is recreated
     subprocess.call('python dbsetup.py', shell=True)
@@ -0,0 +1,125 @@
+import os
+import subprocess
+import tempfile
+from datetime import datetime, timedelta
+
+import pytest
+
+pyarrow = pytest.importorskip('pyarrow')
+import pyarrow.dataset
+
+from activity import Activity, ActivityArchive, Category
+from dbutil import activity_logger, insert_into_db, unit_of_work
+from export import export, read_watermark
+from habit import Habit, Periodicity
+from user import User
+
+user = User(name='export_user', email='export_email@domain.com', password='export_password')
+user_id = user.user_id
+habit = Habit(user_id=user_id, name='export_habit', periodicity=Periodicity.daily, time_of_creation=datetime(2022, 1, 3))
+habit_id = habit.habit_id
+
+# completions in January and February 2022, the first two are archived
+timestamps = [datetime(2022, 1, 3) + timedelta(days=day, hours=9) for day in range(0, 50, 7)]
+archived = 2
+
+
+def setup_module():
+    with unit_of_work() as session:
+        insert_into_db(user)
+        insert_into_db(habit)
+        for i, timestamp in enumerate(timestamps):
+            model = ActivityArchive if i < archived else Activity
+            session.add(model(category=Category.completed_habit, user_id=user_id, habit_id=habit_id,
+                              timestamp=timestamp))
+
+
+def read(directory, table, file_format='parquet'):
+    # user ids don't fit the 32 bit integers inferred from the directory names
+    partitioning = pyarrow.dataset.partitioning(pyarrow.schema([('user_id', pyarrow.int64()),
+                                                                ('month', pyarrow.string())]), flavor='hive')
+    return pyarrow.dataset.dataset(os.path.join(directory, table), format=file_format,
+                                   partitioning=partitioning).to_table().to_pandas()
+
+
+def completions(activity):
+    return activity[(activity['user_id'] == user_id) & (activity['category'] == 'completed_habit')]
+
+
+def test_export_by_user():
+    try:
+        directory = tempfile.mkdtemp()
+        counts = export(directory, partition_by='user', chunk_size=3, now=datetime(2022, 2, 1))
+
+        # the partition of the user holds its completions up to 'now', archived ones included, read in chunks
+        assert os.path.isdir(os.path.join(directory, 'activity', 'user_id={0}'.format(user_id)))
+        activity = completions(read(directory, 'activity'))
+        assert list(activity['timestamp']) == [timestamp for timestamp in timestamps
+                                               if timestamp <= datetime(2022, 2, 1)]
+        assert counts['activity'] >= len(activity)
+
+        habits = read(directory, 'habits')
+        assert habits.loc[habits['habit_id'] == habit_id, 'periodicity'].tolist() == ['daily']
+
+        # passwords are not exported
+        users = read(directory, 'users')
+        assert user_id in set(users['user_id'])
+        assert 'password' not in users.columns
+    except:
+        assert False
+
+
+def test_incremental_export():
+    try:
+        directory = tempfile.mkdtemp()
+        export(directory, partition_by='month', now=datetime(2022, 2, 1), settle=0)
+        assert read_watermark(directory) == datetime(2022, 2, 1)
+
+        # the second run only adds the activities since the watermark. the time range ends before the export, so that
+        # the other processes have stored their activities
+        counts = export(directory, partition_by='month', incremental=True, now=datetime(2022, 3, 1))
+        assert counts['activity'] == len([timestamp for timestamp in timestamps if timestamp > datetime(2022, 2, 1)])
+        assert read_watermark(directory) == datetime(2022, 3, 1) - timedelta(seconds=10)
+        assert len(os.listdir(os.path.join(directory, 'activity', 'month=2022-01'))) == 1
+        assert len(os.listdir(os.path.join(directory, 'activity', 'month=2022-02'))) == 1
+
+        assert sorted(completions(read(directory, 'activity'))['timestamp']) == timestamps
+
+        # users and habits are replaced, not added to
+        assert (read(directory, 'habits')['habit_id'] == habit_id).sum() == 1
+    except:
+        assert False
+
+
+def test_arrow_format():
+    try:
+        directory = tempfile.mkdtemp()
+        export(directory, file_format='arrow', now=datetime(2022, 3, 1))
+
+        assert len(completions(read(directory, 'activity', file_format='arrow'))) == len(timestamps)
+        assert not any(file_name.endswith('.tmp') for _, _, files in os.walk(directory) for file_name in files)
+    except:
+        assert False
+
+
+def test_compact_storage(monkeypatch):
+    try:
+        # activities stored without description, live and archived, are exported with the rendered one
+        monkeypatch.setattr('activity.activity_storage', 'compact')
+        with unit_of_work() as session:
+            session.add(Activity(category=Category.logged_in, user_id=user_id, timestamp=datetime(2022, 1, 4)))
+            session.add(ActivityArchive(category=Category.logged_out, user_id=user_id, timestamp=datetime(2022, 1, 5)))
+
+        directory = tempfile.mkdtemp()
+        export(directory, now=datetime(2022, 3, 1))
+
+        activity = read(directory, 'activity')
+        activity = activity[(activity['user_id'] == user_id) & activity['category'].isin(['logged_in', 'logged_out'])]
+        assert activity['description'].tolist() == ['User {0} logged in at 2022-01-04 00:00:00'.format(user_id),
+                                                    'User {0} logged out at 2022-01-05 00:00:00'.format(user_id)]
+    except:
+        assert False
+
+def teardown_module():
+    activity_logger.flush()  # write pending activities before the database is recreated
+    subprocess.call('python dbsetup.py', shell=True)
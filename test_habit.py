@@ -2,6 +2,7 @@ import subprocess
 import time
 from datetime import datetime, timedelta
 
+from dbutil import activity_logger
 from habit import Habit, Periodicity
 
 
@@ -110,4 +111,5 @@ def test_reschedule_update():
 
 
 def teardown_module():
+    activity_logger.flush()  # write pending activities before the database is recreated
     subprocess.call('python dbsetup.py', shell=True)
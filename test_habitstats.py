@@ -0,0 +1,139 @@
+import subprocess
+from datetime import datetime, timedelta
+
+import pytest
+from sqlalchemy import select
+
+from activity import Activity, Category
+from analysis import habit_stats
+from dbutil import activity_logger, insert_into_db, complete_in_db, complete_many, new_cycle, \
+    sweep_cycles, delete_from_db, rebuild_stats, unit_of_work
+from habit import Habit, HabitStats, Periodicity
+from user import User
+
+user = User(name='stats_user', email='stats_email@domain.com', password='stats_password')
+user_id = user.user_id
+habit = Habit(user_id=user_id, name='stats_habit', periodicity=Periodicity.daily)
+habit_id = habit.habit_id
+
+# the completion history of test_analytics.py
+created = datetime(2022, 1, 3)
+now = created + timedelta(days=28, hours=12)
+other_user = User(name='rebuild_user', email='rebuild_email@domain.com', password='rebuild_password')
+other_user_id = other_user.user_id
+daily = Habit(user_id=other_user_id, name='daily_rebuild_habit', periodicity=Periodicity.daily,
+              time_of_creation=created)
+weekly = Habit(user_id=other_user_id, name='weekly_rebuild_habit', periodicity=Periodicity.weekly,
+               time_of_creation=created)
+daily_id, weekly_id = daily.habit_id, weekly.habit_id
+
+
+def setup_module():
+    with unit_of_work() as session:
+        insert_into_db(user)
+        insert_into_db(habit)
+        insert_into_db(other_user)
+        insert_into_db(daily)
+        insert_into_db(weekly)
+
+        for day in list(range(0, 5)) + [10, 26, 27, 28]:
+            session.add(Activity(category=Category.completed_habit, user_id=other_user_id, habit_id=daily_id,
+                                 timestamp=created + timedelta(days=day, hours=9)))
+        for day in (1, 2, 8, 9, 22):
+            session.add(Activity(category=Category.completed_habit, user_id=other_user_id, habit_id=weekly_id,
+                                 timestamp=created + timedelta(days=day, hours=9)))
+
+
+def get_stats(obj_id):
+    with unit_of_work(read_only=True) as session:
+        stats = session.get(HabitStats, obj_id)
+        return None if stats is None else (stats.total_completions, stats.periods, stats.completed_periods,
+                                           stats.missed_periods)
+
+
+def test_insert():
+    try:
+        # a new habit starts in its first period
+        assert get_stats(habit_id) == (0, 1, 0, 0)
+    except:
+        assert False
+
+
+def test_incremental_updates():
+    try:
+        # a second completion in the same period only counts as a completion
+        complete_in_db(habit_id, Habit)
+        complete_in_db(habit_id, Habit)
+        assert get_stats(habit_id) == (2, 1, 1, 0)
+
+        # the rollovers run as if the current cycle were over
+        tomorrow = datetime.now() + timedelta(days=1)
+        new_cycle(habit_id, now=tomorrow)
+        assert get_stats(habit_id) == (2, 2, 1, 0)
+        new_cycle(habit_id, now=tomorrow)
+        assert get_stats(habit_id) == (2, 3, 1, 1)
+
+        complete_many([(habit_id, datetime.now())])
+        assert get_stats(habit_id) == (3, 3, 2, 1)
+
+        # the sweeper rolls over the completed period, then the missed one
+        with unit_of_work(read_only=True) as session:
+            next_cycle_start_time = session.get(Habit, habit_id).next_cycle_start_time
+        sweep_cycles(now=next_cycle_start_time)
+        assert get_stats(habit_id) == (3, 4, 2, 1)
+        sweep_cycles(now=next_cycle_start_time + timedelta(days=1))
+        assert get_stats(habit_id) == (3, 5, 2, 2)
+
+        with unit_of_work(read_only=True) as session:
+            stats = session.get(HabitStats, habit_id)
+            assert stats.adherence_rate == pytest.approx(2 / 4)
+            assert session.execute(select(HabitStats.adherence_rate).where(
+                HabitStats.habit_id == habit_id)).scalar() == pytest.approx(2 / 4)
+    except:
+        assert False
+
+
+def test_rebuild_stats():
+    try:
+        # the same figures as analytics.habit_adherence() computes from the activities
+        assert rebuild_stats(user_id=other_user_id, now=now) == 2
+        assert get_stats(daily_id) == (9, 29, 9, 20)
+        assert get_stats(weekly_id) == (5, 5, 3, 1)
+
+        # the statistics of the other users are kept
+        assert get_stats(habit_id) == (3, 5, 2, 2)
+    except:
+        assert False
+
+
+def test_habit_stats():
+    try:
+        results = habit_stats(user_id=other_user_id, display=False)
+        assert [(row.habit_id, row.total_completions) for row in results] == sorted([(daily_id, 9), (weekly_id, 5)])
+        assert {row.habit_id: row.adherence_rate for row in results} == pytest.approx({daily_id: 9 / 29,
+                                                                                       weekly_id: 3 / 4})
+
+        results = habit_stats(user_id=other_user_id, habit_id=weekly_id)
+        assert [row.last_completion for row in results] == [created + timedelta(days=22, hours=9)]
+
+        # habits of other users are not listed
+        assert habit_stats(user_id=user_id, habit_id=weekly_id, display=False) == []
+    except:
+        assert False
+
+
+def test_delete():
+    try:
+        delete_from_db(habit_id, Habit)
+        assert get_stats(habit_id) is None
+
+        delete_from_db(other_user_id, User)
+        assert get_stats(daily_id) is None
+        assert get_stats(weekly_id) is None
+    except:
+        assert False
+
+
+def teardown_module():
+    activity_logger.flush()  # write pending activities before the database is recreated
+    subprocess.call('python dbsetup.py', shell=True)
@@ -0,0 +1,126 @@
+import io
+import json
+import subprocess
+from datetime import datetime, timedelta
+
+from sqlalchemy import select, func
+
+from activity import Activity, Category
+from dbutil import activity_logger, insert_into_db, unit_of_work
+from habit import Habit, HabitStats, Periodicity
+from importer import read_records, import_completions
+from imports import scheduler_mode, update_scheduler
+from user import User, verify_password
+
+# the completion history of test_streak.py: daily days 0-4, day 10 and days 26-28, weekly days 1, 2, 8, 9 and 22
+now = datetime(2022, 1, 31, 12)
+first_day = datetime(2022, 1, 3)
+daily_days = list(range(0, 5)) + [10, 26, 27, 28]
+weekly_days = (1, 2, 8, 9, 22)
+
+# an existing user with a habit created after the start of the imported history
+user = User(name='import_user', email='import_email@domain.com', password='import_password')
+user_id = user.user_id
+habit = Habit(user_id=user_id, name='weekly', periodicity=Periodicity.weekly, time_of_creation=first_day +
+              timedelta(days=21))
+habit_id = habit.habit_id
+
+
+def setup_module():
+    insert_into_db(user)
+    insert_into_db(habit)
+
+
+def get_habit(user_email, name):
+    with unit_of_work(read_only=True) as session:
+        return session.execute(select(Habit, HabitStats).join(HabitStats, HabitStats.habit_id == Habit.habit_id).join(
+            User, User.user_id == Habit.user_id).where(User.email == user_email, Habit.name == name)).one()
+
+
+def test_read_records():
+    try:
+        stream = io.StringIO('email,habit,periodicity,timestamp\n'
+                             'a@domain.com,read,daily,2022-01-03T09:00:00\n')
+        assert list(read_records(stream, input_format='csv')) == [
+            ('a@domain.com', 'read', Periodicity.daily, datetime(2022, 1, 3, 9))]
+
+        stream = io.StringIO(json.dumps({'email': 'a@domain.com', 'habit': 'read', 'periodicity': 'weekly',
+                                         'timestamps': ['2022-01-03', '2022-01-10']}) + '\n\n')
+        assert [record[3] for record in read_records(stream)] == [datetime(2022, 1, 3), datetime(2022, 1, 10)]
+
+        # invalid records are reported with their line
+        stream = io.StringIO('{"email": "a@domain.com", "habit": "read", "periodicity": "yearly", "timestamp": ""}\n')
+        try:
+            list(read_records(stream))
+            assert False
+        except ValueError as error:
+            assert 'line 1' in str(error)
+    except:
+        assert False
+
+
+def test_import_completions():
+    try:
+        # shuffled completions, imported in chunks of 4
+        records = [('new_import_email@domain.com', 'daily', Periodicity.daily, first_day + timedelta(days=day, hours=9))
+                   for day in daily_days]
+        records += [('import_email@domain.com', 'weekly', Periodicity.weekly, first_day + timedelta(days=day, hours=9))
+                    for day in weekly_days]
+        records = records[::2] + records[1::2]
+
+        counts = import_completions(records, 'new_password', chunk_size=4, now=now)
+        assert counts == {'completions': 14, 'users': 1, 'habits': 1}
+
+        # the new user and habit, the streaks as in test_streak.py
+        daily, stats = get_habit('new_import_email@domain.com', 'daily')
+        assert daily.time_of_creation == first_day + timedelta(hours=9)
+        assert (daily.current_streak, daily.longest_streak, daily.is_completed) == (3, 5, True)
+        assert daily.time_of_completion == first_day + timedelta(days=28, hours=9)
+        assert daily.next_cycle_start_time == datetime(2022, 2, 1)
+        assert (stats.total_completions, stats.periods, stats.missed_periods) == (9, 29, 20)
+        if scheduler_mode == 'per_habit':
+            assert update_scheduler.get_job(daily.update_job_id).next_run_time.replace(tzinfo=None) == \
+                datetime(2022, 2, 1)
+
+        # the existing habit tracks from the earliest imported completion, its weeks start on Tuesdays now and the
+        # completion on day 22 falls into the current week
+        weekly, stats = get_habit('import_email@domain.com', 'weekly')
+        assert weekly.habit_id == habit_id
+        assert weekly.time_of_creation == first_day + timedelta(days=1, hours=9)
+        assert (weekly.current_streak, weekly.longest_streak, weekly.is_completed) == (1, 2, True)
+        assert weekly.next_cycle_start_time == datetime(2022, 2, 1)
+        assert (stats.total_completions, stats.periods, stats.missed_periods) == (5, 4, 1)
+
+        with unit_of_work(read_only=True) as session:
+            new_user = session.execute(select(User).where(User.email == 'new_import_email@domain.com')).scalar_one()
+            assert verify_password('new_password', new_user.password)
+            assert session.execute(select(func.count()).where(
+                Activity.user_id == new_user.user_id, Activity.category == Category.completed_habit)).scalar() == 9
+    except:
+        assert False
+
+
+def test_invalid_record():
+    try:
+        # the first chunk is committed before the invalid second line is read
+        stream = io.StringIO(json.dumps({'email': 'partial_import_email@domain.com', 'habit': 'partial',
+                                         'periodicity': 'daily', 'timestamp': '2022-01-30T09:00:00'}) + '\n' +
+                             json.dumps({'email': 'partial_import_email@domain.com', 'habit': 'partial',
+                                         'periodicity': 'yearly', 'timestamp': '2022-01-31T09:00:00'}) + '\n')
+        try:
+            import_completions(read_records(stream), 'new_password', chunk_size=1, now=now)
+            assert False
+        except ValueError as error:
+            assert 'line 2' in str(error)
+
+        # the imported habit is backfilled nevertheless
+        partial, stats = get_habit('partial_import_email@domain.com', 'partial')
+        assert (partial.current_streak, partial.longest_streak, partial.is_completed) == (1, 1, False)
+        assert partial.next_cycle_start_time == datetime(2022, 2, 1)
+        assert (stats.total_completions, stats.periods, stats.missed_periods) == (1, 2, 0)
+    except:
+        assert False
+
+def teardown_module():
+    activity_logger.flush()  # write pending activities before the database is recreated
+    subprocess.call('python dbsetup.py', shell=True)
@@ -0,0 +1,75 @@
+import subprocess
+from datetime import datetime, timedelta
+
+from sqlalchemy import select, func
+
+from activity import Activity, Category
+from dbutil import activity_logger, rebuild_stats, unit_of_work
+from habit import Habit, HabitStats
+from loadgen import generate_load
+from streak import compute_streaks
+
+now = datetime.combine(datetime.now().date(), datetime.min.time()) + timedelta(hours=12)
+
+
+def get_habits(user_ids):
+    with unit_of_work(read_only=True) as session:
+        return session.execute(select(Habit).where(Habit.user_id.in_(user_ids))).scalars().all()
+
+
+def test_generate_load():
+    try:
+        user_ids, activity_count = generate_load(users=3, habits_per_user=4, weeks=4, adherence=0.6, seed=1, now=now)
+        habits = get_habits(user_ids)
+        habit_ids = [habit.habit_id for habit in habits]
+
+        assert len(user_ids) == 3
+        assert len(habits) == 12
+        with unit_of_work(read_only=True) as session:
+            assert session.execute(select(func.count()).where(Activity.user_id.in_(user_ids))).scalar() == \
+                activity_count
+            assert session.execute(select(func.count()).where(Activity.user_id.in_(user_ids),
+                                                              Activity.category == Category.created_habit)).scalar() \
+                == 12
+
+        # the stored streaks are the ones derived from the history
+        streaks = compute_streaks(habit_ids=habit_ids, now=now)
+        for habit in habits:
+            assert habit.current_streak == streaks.loc[habit.habit_id, 'current_streak']
+            assert habit.longest_streak == streaks.loc[habit.habit_id, 'longest_streak']
+            assert habit.is_completed == streaks.loc[habit.habit_id, 'is_completed']
+            assert habit.next_cycle_start_time == streaks.loc[habit.habit_id, 'next_cycle_start_time']
+        assert any(habit.longest_streak > 0 for habit in habits)
+
+        # the generated statistics match the ones rebuilt from the history
+        with unit_of_work(read_only=True) as session:
+            generated = {stats.habit_id: (stats.total_completions, stats.periods, stats.completed_periods,
+                                          stats.missed_periods)
+                         for stats in session.execute(select(HabitStats).where(
+                             HabitStats.habit_id.in_(habit_ids))).scalars()}
+        rebuild_stats(habit_ids=habit_ids, now=now)
+        with unit_of_work(read_only=True) as session:
+            rebuilt = {stats.habit_id: (stats.total_completions, stats.periods, stats.completed_periods,
+                                        stats.missed_periods)
+                       for stats in session.execute(select(HabitStats).where(
+                           HabitStats.habit_id.in_(habit_ids))).scalars()}
+        assert generated == rebuilt
+    except:
+        assert False
+
+
+def test_full_adherence():
+    try:
+        # every day of four weeks is completed, the streak covers the whole history
+        user_ids, _ = generate_load(users=1, habits_per_user=2, weeks=4, adherence=1.0, weekly_share=0.0, seed=2,
+                                    now=now)
+
+        for habit in get_habits(user_ids):
+            assert (habit.current_streak, habit.longest_streak, habit.is_completed) == (29, 29, True)
+    except:
+        assert False
+
+
+def teardown_module():
+    activity_logger.flush()  # write pending activities before the database is recreated
+    subprocess.call('python dbsetup.py', shell=True)
@@ -0,0 +1,87 @@
+import subprocess
+from datetime import datetime, timedelta
+
+from sqlalchemy import select, func
+
+from activity import Activity, ActivityArchive, ActivityRollup, Category
+from dbutil import Session, activity_logger, insert_into_db, unit_of_work, delete_activity
+from retention import rollup_activity, archive_activity
+from user import User
+
+# a user with two years of activity: a read-type and a completion activity every 10 days, two read-type activities
+# on the same day
+now = datetime(2022, 6, 1, 12)
+user = User(name='retention_user', email='retention_email@domain.com', password='retention_password')
+user_id = user.user_id
+timestamps = [now - timedelta(days=days) for days in range(0, 730, 10)]
+
+
+def setup_module():
+    with unit_of_work() as session:
+        insert_into_db(user)
+        for timestamp in timestamps:
+            session.add(Activity(category=Category.displayed_habits, user_id=user_id, timestamp=timestamp))
+            session.add(Activity(category=Category.completed_habit, user_id=user_id, habit_id=1, timestamp=timestamp))
+        session.add(Activity(category=Category.displayed_habits, user_id=user_id,
+                             timestamp=timestamps[-1] + timedelta(hours=1)))
+
+
+def count(model, *conditions):
+    session = Session(autoflush=True, expire_on_commit=True)
+    result = session.execute(select(func.count()).select_from(model).where(model.user_id == user_id, *conditions)).scalar()
+    session.close()
+    return result
+
+
+def test_rollup_activity():
+    try:
+        old = [timestamp for timestamp in timestamps if timestamp < now - timedelta(days=30)]
+
+        # small chunks to run several transactions
+        assert rollup_activity(now=now, size=7) == len(old) + 1
+
+        assert count(Activity, Activity.category == Category.displayed_habits) == len(timestamps) - len(old)
+        assert count(Activity, Activity.category == Category.completed_habit) == len(timestamps)
+        assert count(ActivityRollup) == len(old)
+
+        session = Session(autoflush=True, expire_on_commit=True)
+        first_day = session.get(ActivityRollup, (user_id, timestamps[-1].date(), Category.displayed_habits))
+        assert first_day.count == 2
+        assert session.execute(select(func.sum(ActivityRollup.count)).where(
+            ActivityRollup.user_id == user_id)).scalar() == len(old) + 1
+        session.close()
+
+        # nothing left to do in the next run
+        assert rollup_activity(now=now) == 0
+    except:
+        assert False
+
+
+def test_archive_activity():
+    try:
+        before = count(Activity)
+        old = [timestamp for timestamp in timestamps if timestamp < now - timedelta(days=365)]
+
+        assert archive_activity(now=now, size=5) == len(old)
+
+        assert count(Activity) == before - len(old)
+        assert count(ActivityArchive) == len(old)
+        assert count(Activity, Activity.timestamp < now - timedelta(days=365)) == 0
+    except:
+        assert False
+
+
+def test_delete_activity():
+    try:
+        delete_activity(user_id)
+        activity_logger.flush()
+
+        assert count(ActivityRollup) == 0
+        assert count(ActivityArchive) == 0
+    except:
+        assert False
+
+
+def teardown_module():
+    activity_logger.flush()  # write pending activities before the database is recreated
+    subprocess.call('python dbsetup.py', shell=True)
@@ -0,0 +1,170 @@
+import json
+import subprocess
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from http.client import HTTPConnection
+from urllib.error import HTTPError
+from urllib.request import Request, urlopen
+
+from dbutil import activity_logger
+from service import make_server
+
+"""
+
+Test suite for the HTTP service, run against a server in a background thread
+
+WARNING: Run the test suite instead of individual test cases as the cases depend on each other.
+
+"""
+
+server = None
+state = {}
+
+
+def setup_module():
+    global server
+    server = make_server(port=0)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+
+def call(method, path, body=None, token=None):
+    request = Request('http://{0}:{1}{2}'.format(*server.server_address, path), method=method,
+                      data=None if body is None else json.dumps(body).encode())
+    if token is not None:
+        request.add_header('Authorization', 'Bearer ' + token)
+    try:
+        with urlopen(request) as response:
+            return response.status, json.loads(response.read())
+    except HTTPError as error:
+        return error.code, json.loads(error.read())
+
+
+def test_register_and_login():
+    try:
+        status, result = call('POST', '/register', {'email': 'service_email@domain.com', 'password': 'service_pass',
+                                                    'name': 'service_user'})
+        assert status == 201
+
+        # duplicate email
+        assert call('POST', '/register', {'email': 'service_email@domain.com', 'password': 'x'})[0] == 409
+
+        assert call('POST', '/login', {'email': 'service_email@domain.com', 'password': 'wrong'})[0] == 401
+        status, login = call('POST', '/login', {'email': 'service_email@domain.com', 'password': 'service_pass'})
+        assert status == 200
+        assert login['user_id'] == result['user_id']
+        state['token'] = login['token']
+
+        assert call('GET', '/habits')[0] == 401
+        assert call('GET', '/user', token=state['token'])[1]['name'] == 'service_user'
+    except:
+        assert False
+
+
+def test_habits():
+    try:
+        token = state['token']
+        status, result = call('POST', '/habits', {'name': 'service_habit', 'periodicity': 'daily'}, token=token)
+        assert status == 201
+        habit_id = state['habit_id'] = result['habit_id']
+
+        assert call('POST', '/habits', {'name': 'bad_habit', 'periodicity': 'hourly'}, token=token)[0] == 400
+
+        assert call('POST', '/habits/{0}/complete'.format(habit_id), token=token)[0] == 200
+        status, habit = call('GET', '/habits/{0}'.format(habit_id), token=token)
+        assert habit['is_completed'] == True
+        assert habit['current_streak'] == 1
+
+        assert call('PATCH', '/habits/{0}'.format(habit_id), {'name': 'new_service_habit'}, token=token)[0] == 200
+        habits = call('GET', '/habits?periodicity=daily', token=token)[1]
+        assert [habit['name'] for habit in habits] == ['new_service_habit']
+
+        assert call('GET', '/habits/{0}/streak'.format(habit_id), token=token)[1][0]['longest_streak'] == 1
+        assert call('GET', '/streaks/leaderboard?limit=1', token=token)[1][0]['habit_id'] == habit_id
+    except:
+        assert False
+
+
+def test_foreign_habit():
+    try:
+        status, other = call('POST', '/register', {'email': 'other_service_email@domain.com', 'password': 'pass'})
+
+        for method, path in [('GET', ''), ('POST', '/complete'), ('DELETE', ''), ('GET', '/activity')]:
+            assert call(method, '/habits/{0}{1}'.format(state['habit_id'], path), token=other['token'])[0] == 404
+
+        assert call('DELETE', '/user', token=other['token'])[0] == 200
+    except:
+        assert False
+
+
+def test_activity_pages():
+    try:
+        token = state['token']
+        activities = []
+        path = '/user/activity?page_size=2'
+        while path is not None:
+            status, page = call('GET', path, token=token)
+            assert status == 200
+            assert len(page['activities']) <= 2
+            activities += page['activities']
+            path = None if page['next'] is None else '/user/activity?page_size=2&after=' + page['next']
+
+        assert len(activities) > 2
+        assert len({activity['activity_id'] for activity in activities}) == len(activities)
+        assert activities == sorted(activities, key=lambda activity: (activity['timestamp'], activity['activity_id']))
+
+        page = call('GET', '/habits/{0}/activity?categories=completed_habit'.format(state['habit_id']), token=token)[1]
+        assert [activity['category'] for activity in page['activities']] == ['completed_habit']
+    except:
+        assert False
+
+
+def test_not_found_keep_alive():
+    try:
+        # the body of an unknown route is skipped, the connection serves the next request
+        connection = HTTPConnection(*server.server_address)
+        connection.request('POST', '/unknown', body=json.dumps({'name': 'x' * 100}),
+                           headers={'Content-Type': 'application/json'})
+        response = connection.getresponse()
+        assert response.status == 404
+        response.read()
+
+        connection.request('GET', '/user', headers={'Authorization': 'Bearer ' + state['token']})
+        response = connection.getresponse()
+        assert response.status == 200
+        assert json.loads(response.read())['name'] == 'service_user'
+        connection.close()
+    except:
+        assert False
+
+
+def test_concurrent_clients():
+    try:
+        token = state['token']
+        path = '/habits/{0}'.format(state['habit_id'])
+        with ThreadPoolExecutor(max_workers=32) as executor:
+            statuses = list(executor.map(lambda i: call('GET', path if i % 2 else '/habits', token=token)[0],
+                                         range(200)))
+
+        assert statuses == [200] * 200
+    except:
+        assert False
+
+
+def test_delete():
+    try:
+        token = state['token']
+        assert call('DELETE', '/habits/{0}'.format(state['habit_id']), token=token)[0] == 200
+        assert call('GET', '/habits/{0}'.format(state['habit_id']), token=token)[0] == 404
+
+        assert call('DELETE', '/user', token=token)[0] == 200
+        # the tokens of a deleted user are revoked
+        assert call('GET', '/user', token=token)[0] == 401
+    except:
+        assert False
+
+
+def teardown_module():
+    server.shutdown()
+    server.server_close()
+    activity_logger.flush()  # write pending activities before the database is recreated
+    subprocess.call('python dbsetup.py', shell=True)
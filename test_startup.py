@@ -0,0 +1,45 @@
+import subprocess
+import sys
+
+"""
+
+Start-up regression guard: the modules needed for the login prompt of main.py are imported in a fresh interpreter
+with '-X importtime' and the heavy dependencies must not show up.
+
+"""
+
+cli_modules = 'authutil, analysis_module, habit_module, user_module'
+lazy_modules = ('pandas', 'numpy', 'apscheduler')
+max_import_time = 2.0  # seconds, generous bound to catch regressions of the order of a heavy dependency
+
+
+def import_times():
+    output = subprocess.run([sys.executable, '-X', 'importtime', '-c', 'import ' + cli_modules],
+                            capture_output=True, text=True, check=True).stderr
+
+    # lines look like 'import time:  self [us] | cumulative | imported package'
+    times = {}
+    for line in output.splitlines():
+        if line.startswith('import time:') and not line.endswith('imported package'):
+            _, cumulative, module = line[len('import time:'):].split('|')
+            times[module.strip()] = int(cumulative) / 1e6
+    return times
+
+
+def test_lazy_imports():
+    try:
+        times = import_times()
+        assert 'authutil' in times
+        for module in times:
+            assert module.split('.')[0] not in lazy_modules
+    except:
+        assert False
+
+
+def test_import_time():
+    try:
+        times = import_times()
+        top_level = [seconds for module, seconds in times.items() if module in cli_modules.split(', ')]
+        assert sum(top_level) < max_import_time
+    except:
+        assert False
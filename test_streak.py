@@ -0,0 +1,90 @@
+import subprocess
+from datetime import datetime, timedelta
+
+from activity import Activity, ActivityArchive, Category
+from dbutil import Session, activity_logger, insert_into_db, unit_of_work
+from habit import Habit, Periodicity
+from imports import scheduler_mode, update_scheduler
+from streak import compute_streaks, repair_streaks
+from user import User
+
+# a user with two habits created four weeks ago and a completion history with gaps
+four_weeks_ago = datetime.combine(datetime.now().date(), datetime.min.time()) - timedelta(weeks=4)
+user = User(name='streak_user', email='streak_email@domain.com', password='streak_password')
+user_id = user.user_id
+daily = Habit(user_id=user_id, name='daily_streak_habit', periodicity=Periodicity.daily, time_of_creation=four_weeks_ago)
+weekly = Habit(user_id=user_id, name='weekly_streak_habit', periodicity=Periodicity.weekly,
+               time_of_creation=four_weeks_ago)
+daily_id, weekly_id = daily.habit_id, weekly.habit_id
+
+def setup_module():
+    with unit_of_work() as session:
+        insert_into_db(user)
+        insert_into_db(daily)
+        insert_into_db(weekly)
+
+        # daily: days 0-4 (5 in a row, archived), day 10, days 26-28 (3 in a row, including today)
+        for day in list(range(0, 5)):
+            session.add(ActivityArchive(category=Category.completed_habit, user_id=user_id, habit_id=daily_id,
+                                        timestamp=four_weeks_ago + timedelta(days=day, hours=9)))
+        for day in [10, 26, 27, 28]:
+            session.add(Activity(category=Category.completed_habit, user_id=user_id, habit_id=daily_id,
+                                 timestamp=four_weeks_ago + timedelta(days=day, hours=9)))
+
+        # weekly: weeks 0 and 1 twice each, week 3 (previous week), nothing in the current week
+        for day in (1, 2, 8, 9, 22):
+            session.add(Activity(category=Category.completed_habit, user_id=user_id, habit_id=weekly_id,
+                                 timestamp=four_weeks_ago + timedelta(days=day, hours=9)))
+
+
+def test_compute_streaks():
+    try:
+        streaks = compute_streaks(user_id=user_id)
+
+        assert sorted(streaks.index.tolist()) == sorted([daily_id, weekly_id])
+
+        assert streaks.loc[daily_id, 'current_streak'] == 3
+        assert streaks.loc[daily_id, 'longest_streak'] == 5
+        assert streaks.loc[daily_id, 'is_completed'] == True
+
+        assert streaks.loc[weekly_id, 'current_streak'] == 1  # expected: previous week completed, current week open
+        assert streaks.loc[weekly_id, 'longest_streak'] == 2  # expected: two completions in a week count once
+        assert streaks.loc[weekly_id, 'is_completed'] == False
+
+        # two weeks later both streaks are broken
+        streaks = compute_streaks(user_id=user_id, now=datetime.now() + timedelta(weeks=2))
+
+        assert streaks.loc[daily_id, 'current_streak'] == 0
+        assert streaks.loc[weekly_id, 'current_streak'] == 0
+        assert streaks.loc[daily_id, 'longest_streak'] == 5
+    except:
+        assert False
+
+
+def test_repair_streaks():
+    try:
+        repair_streaks(user_id=user_id)
+
+        session = Session(autoflush=True, expire_on_commit=True)
+        habit = session.get(Habit, daily_id)
+
+        assert habit.current_streak == 3
+        assert habit.longest_streak == 5
+        assert habit.is_completed == True
+        assert habit.next_cycle_start_time == four_weeks_ago + timedelta(days=29)
+
+        # the weekly habit was created four weeks ago, its next cycle starts in a week
+        weekly_habit = session.get(Habit, weekly_id)
+        assert weekly_habit.next_cycle_start_time == four_weeks_ago + timedelta(weeks=5)
+        if scheduler_mode == 'per_habit':
+            assert update_scheduler.get_job(weekly_habit.update_job_id).next_run_time.replace(tzinfo=None) == \
+                four_weeks_ago + timedelta(weeks=5)
+
+        session.close()
+    except:
+        assert False
+
+
+def teardown_module():
+    activity_logger.flush()  # write pending activities before the database is recreated
+    subprocess.call('python dbsetup.py', shell=True)
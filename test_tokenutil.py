@@ -0,0 +1,103 @@
+import os
+import subprocess
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from dbutil import activity_logger, insert_into_db, update_in_db, delete_from_db
+from tokenutil import TokenStore, token_store
+from user import User
+
+path = os.path.join(tempfile.mkdtemp(), 'tokens.json')
+user = User(name='token_user', email='token_email@domain.com', password='token_password')
+user_id = user.user_id
+
+
+def setup_module():
+    insert_into_db(user)
+
+
+def test_issue_and_verify():
+    try:
+        store = TokenStore(path, ttl=3600)
+        token = store.issue(42)
+        assert store.verify(token) == 42
+
+        # forged user id or signature
+        user_id, expiry, token_id, signature = token.split('.')
+        assert store.verify('.'.join(('43', expiry, token_id, signature))) is None
+        assert store.verify('.'.join((user_id, expiry, token_id, '0' * len(signature)))) is None
+        assert store.verify('not a token') is None
+
+        # the file is private to its owner
+        assert os.stat(path).st_mode & 0o077 == 0
+    except:
+        assert False
+
+
+def test_shared_store():
+    try:
+        store, other_store = TokenStore(path, ttl=3600), TokenStore(path, ttl=3600)
+        token = store.issue(42)
+        other_token = other_store.issue(42, session=True)
+
+        # tokens issued by another process are accepted, the CLI session is resumed
+        assert other_store.verify(token) == 42
+        assert store.session() == 42
+
+        # revocations by another process take effect
+        time.sleep(0.01)
+        other_store.revoke(token=token)
+        assert store.verify(token) is None
+        assert store.verify(other_token) == 42
+
+        store.end_session()
+        assert other_store.session() is None
+        assert other_store.verify(other_token) is None
+    except:
+        assert False
+
+
+def test_concurrent_changes():
+    try:
+        # stores of separate processes issue tokens at the same time, no token is lost
+        concurrent_path = os.path.join(tempfile.mkdtemp(), 'tokens.json')
+        stores = [TokenStore(concurrent_path, ttl=3600) for _ in range(4)]
+        with ThreadPoolExecutor(max_workers=4) as executor:
+            tokens = list(executor.map(lambda i: [stores[i % 4].issue(i) for _ in range(25)], range(4)))
+
+        store = TokenStore(concurrent_path, ttl=3600)
+        assert all(store.verify(token) == i for i in range(4) for token in tokens[i])
+    except:
+        assert False
+
+
+def test_expiry():
+    try:
+        store = TokenStore(path, ttl=-1)
+        assert store.verify(store.issue(42)) is None
+    except:
+        assert False
+
+
+def test_revocation():
+    try:
+        token = token_store.issue(user_id)
+        assert token_store.verify(token) == user_id
+
+        # a changed password closes the sessions of the user
+        update_in_db(user_id, User, (None, None, 'new_token_password'))
+        assert token_store.verify(token) is None
+
+        # so does the deletion of the account
+        token = token_store.issue(user_id, session=True)
+        delete_from_db(user_id, User)
+        assert token_store.verify(token) is None
+        assert token_store.session() is None
+    except:
+        assert False
+
+
+def teardown_module():
+    activity_logger.flush()  # write pending activities before the database is recreated
+    subprocess.call('python dbsetup.py', shell=True)
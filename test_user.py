@@ -1,6 +1,7 @@
 import subprocess
 
-from user import User
+from dbutil import activity_logger
+from user import User, verify_password
 
 
 def test_display():
@@ -19,10 +20,24 @@ def test_edit():
         user.edit(name='new_name', email='new_email@domain.com', password='new_password')
         assert user.name == 'new_name'
         assert user.email == 'new_email@domain.com'
-        assert user.password == 'new_password'
+        assert verify_password('new_password', user.password)
+    except:
+        assert False
+
+
+def test_password_hash():
+    try:
+        user = User(email='test_email@domain.com', password='test_password')
+        assert user.password.startswith('pbkdf2_sha256$')
+        assert verify_password('test_password', user.password)
+        assert not verify_password('wrong_password', user.password)
+
+        # passwords stored in plain text by earlier versions
+        assert verify_password('test_password', 'test_password')
     except:
         assert False
 
 
 def teardown_module():
+    activity_logger.flush()  # write pending activities before the database is recreated
     subprocess.call('python dbsetup.py', shell=True)
@@ -0,0 +1,220 @@
+"""
+    Session tokens
+
+    A token is '<user_id>.<expiry>.<token id>.<signature>', signed with HMAC-SHA256. Verifying a token checks the
+    signature, the expiry and that the token id is still in the token store, all in memory, so that a client holding a
+    token is authenticated without querying the 'User' table. The store is kept in a file shared by the processes on
+    the database (the CLI, batch runs and the HTTP service) and reloaded when another process changed it, so that a
+    revocation takes effect everywhere. Changes are made under a lock file, the store is reloaded and written while the
+    lock is held so that processes don't overwrite each other's changes.
+"""
+
+import base64
+import hashlib
+import hmac
+import json
+import os
+import secrets
+import threading
+import time
+from contextlib import contextmanager
+
+import imports
+
+try:
+    import fcntl
+except ImportError:
+    # not available on Windows, the store is only locked between the threads of a process there
+    fcntl = None
+
+
+class TokenStore:
+    """
+    In-memory and on-disk store of the issued session tokens and their signing key.
+    """
+
+    def __init__(self, path, ttl):
+        """
+        Constructor for 'TokenStore' class.
+
+        :param path: file of the store, created on first use
+        :param ttl: lifetime of a token in seconds
+        """
+
+        self.path = path
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._version = None  # modification time and size of the file when it was read
+        self._key = None
+        self._tokens = {}  # token id: [user id, expiry]
+        self._session = None  # token of the CLI session
+
+    @contextmanager
+    def _change(self):
+        """
+        TokenStore class method to change the store: the lock file is held across reloading, changing and writing the
+        store (call with the lock held).
+        """
+
+        descriptor = os.open(self.path + '.lock', os.O_RDWR | os.O_CREAT, 0o600)
+        try:
+            if fcntl is not None:
+                fcntl.flock(descriptor, fcntl.LOCK_EX)
+            # the modification time might not show a change of another process within its resolution
+            self._load(force=True)
+            yield
+        finally:
+            # closing the file releases the lock
+            os.close(descriptor)
+
+    def _load(self, force=False):
+        """
+        TokenStore class method to read the store file if it changed since it was read (call with the lock held).
+
+        :param force: if True, the file is read even if it looks unchanged
+        """
+
+        try:
+            stat = os.stat(self.path)
+        except FileNotFoundError:
+            stat = None
+
+        version = None if stat is None else (stat.st_mtime_ns, stat.st_size)
+        if version == self._version and self._key is not None and not force:
+            return
+
+        if stat is None:
+            data = {'key': base64.b64encode(secrets.token_bytes(32)).decode(), 'tokens': {}, 'session': None}
+        else:
+            with open(self.path) as file:
+                data = json.load(file)
+
+        self._key = base64.b64decode(data['key'])
+        self._tokens = data['tokens']
+        self._session = data.get('session')
+        self._version = version
+
+    def _save(self):
+        """
+        TokenStore class method to write the store file, dropping expired tokens (call within _change()). The file is
+        replaced atomically and only readable by its owner.
+        """
+
+        now = time.time()
+        self._tokens = {token_id: value for token_id, value in self._tokens.items() if value[1] > now}
+        if self._session is not None and self._parse(self._session) is None:
+            self._session = None
+
+        data = {'key': base64.b64encode(self._key).decode(), 'tokens': self._tokens, 'session': self._session}
+        temporary = '{0}.{1}.tmp'.format(self.path, os.getpid())
+        descriptor = os.open(temporary, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(descriptor, 'w') as file:
+            json.dump(data, file)
+        os.replace(temporary, self.path)
+
+        stat = os.stat(self.path)
+        self._version = (stat.st_mtime_ns, stat.st_size)
+
+    def _sign(self, payload):
+        return hmac.new(self._key, payload.encode(), hashlib.sha256).hexdigest()
+
+    def _parse(self, token):
+        """
+        TokenStore class method to check a token against the loaded store (call with the lock held).
+
+        :param token: session token
+        :return: user id, None if the token is invalid, expired or revoked
+        """
+
+        try:
+            payload, signature = token.rsplit('.', 1)
+            user_id, expiry, token_id = payload.split('.')
+            user_id, expiry = int(user_id), int(expiry)
+        except (AttributeError, ValueError):
+            return None
+
+        if not hmac.compare_digest(signature, self._sign(payload)) or expiry <= time.time():
+            return None
+        if self._tokens.get(token_id, [None])[0] != user_id:
+            return None
+        return user_id
+
+    def issue(self, user_id, session=False):
+        """
+        TokenStore class method to create a session token for a user.
+
+        :param user_id: user id
+        :param session: if True, the token is also kept as the CLI session (see session())
+        :return token: signed session token
+        """
+
+        with self._lock, self._change():
+            token_id = secrets.token_urlsafe(16)
+            expiry = int(time.time() + self.ttl)
+            payload = '{0}.{1}.{2}'.format(user_id, expiry, token_id)
+            token = '{0}.{1}'.format(payload, self._sign(payload))
+
+            self._tokens[token_id] = [user_id, expiry]
+            if session:
+                self._session = token
+            self._save()
+
+        return token
+
+    def verify(self, token):
+        """
+        TokenStore class method to look up the user of a session token.
+
+        :param token: session token
+        :return user_id: user id, None if the token is invalid, expired or revoked
+        """
+
+        with self._lock:
+            self._load()
+            return self._parse(token)
+
+    def session(self):
+        """
+        TokenStore class method to resume the CLI session of the last login.
+
+        :return user_id: user id, None if there is no valid session
+        """
+
+        with self._lock:
+            self._load()
+            return None if self._session is None else self._parse(self._session)
+
+    def end_session(self):
+        """
+        TokenStore class method to revoke the CLI session.
+        """
+
+        with self._lock, self._change():
+            if self._session is not None:
+                self._tokens.pop(self._session.split('.')[2], None)
+                self._session = None
+                self._save()
+
+    def revoke(self, token=None, user_id=None):
+        """
+        TokenStore class method to revoke a session token or all tokens of a user.
+
+        :param token: session token
+        :param user_id: user id
+        """
+
+        with self._lock, self._change():
+            tokens = dict(self._tokens)
+            if token is not None and token.count('.') == 3:
+                tokens.pop(token.split('.')[2], None)
+            if user_id is not None:
+                tokens = {key: value for key, value in tokens.items() if value[0] != user_id}
+
+            # write the store only if a token was revoked
+            if len(tokens) != len(self._tokens):
+                self._tokens = tokens
+                self._save()
+
+
+# token store of the application
+token_store = TokenStore(imports.token_store_path, imports.token_ttl)
@@ -1,13 +1,65 @@
-import pandas
+import base64
+import hashlib
+import hmac
+import os
 from tabulate import tabulate
 from uuid import uuid4
 from sqlalchemy import Column, Integer, String
 from sqlalchemy.orm import relationship
 
 import dbutil
+import imports
+import tokenutil
 from activity import Activity, Category
 from imports import Base
 
+# prefix of the stored password hashes, 'pbkdf2_sha256$<iterations>$<salt>$<hash>'
+hash_scheme = 'pbkdf2_sha256'
+
+
+def hash_password(password, iterations=None, salt=None):
+    """
+    Function to hash a password with PBKDF2-SHA256 and a random salt for storage in 'User.password'.
+
+    :param password: password
+    :param iterations: cost of the hash, imports.kdf_iterations if None
+    :param salt: salt, a random one if None
+    :return: encoded hash with the scheme, cost and salt
+    """
+
+    iterations = imports.kdf_iterations if iterations is None else iterations
+    salt = os.urandom(16) if salt is None else salt
+    digest = hashlib.pbkdf2_hmac('sha256', password.encode(), salt, iterations)
+    return '$'.join((hash_scheme, str(iterations), base64.b64encode(salt).decode(), base64.b64encode(digest).decode()))
+
+
+def verify_password(password, stored):
+    """
+    Function to check a password against a stored hash in constant time. Passwords stored in plain text by earlier
+    versions are compared as they are.
+
+    :param password: password
+    :param stored: value of 'User.password'
+    :return: True if the password matches
+    """
+
+    if not stored.startswith(hash_scheme + '$'):
+        return hmac.compare_digest(password.encode(), stored.encode())
+
+    _, iterations, salt, digest = stored.split('$')
+    return hmac.compare_digest(hash_password(password, int(iterations), base64.b64decode(salt)).split('$')[3], digest)
+
+
+def needs_rehash(stored):
+    """
+    Function to check if a stored password is in plain text or hashed at another cost than imports.kdf_iterations.
+
+    :param stored: value of 'User.password'
+    :return: True if the password should be hashed again
+    """
+
+    return not stored.startswith('{0}${1}$'.format(hash_scheme, imports.kdf_iterations))
+
 
 class User(Base):
     """
@@ -27,7 +79,7 @@ class User(Base):
         Constructor for 'User' class.
 
         :param email: user email
-        :param password: user password
+        :param password: user password, stored hashed
         :param user_id: user id
         :param name: name of the user
         """
@@ -35,7 +87,7 @@ class User(Base):
         self.user_id = uuid4().int >> 96 if user_id is None else user_id
         self.name = name
         self.email = email
-        self.password = password
+        self.password = hash_password(password)
 
         # TODO: create checks for valid email and password
 
@@ -57,12 +109,11 @@ class User(Base):
 
         print('\nUser Info: ')
         variables = {key: value for key, value in vars(self).items() if key not in ('password', '_sa_instance_state')}
-        df = pandas.DataFrame.from_records([variables])
-        print(tabulate(df.T, tablefmt='simple'))
+        print(tabulate(variables.items(), tablefmt='simple'))
 
         # insert into database table 'activity' as 'displayed_user_info' activity
         activity = Activity(category=Category.displayed_user_info, user_id=self.user_id)
-        dbutil.insert_into_db(activity)
+        dbutil.log_activity(activity)
 
     def edit(self, name=None, email=None, password=None):
         """
@@ -71,23 +122,30 @@ class User(Base):
 
         :param name: name of the user
         :param email: user email
-        :param password: user password
+        :param password: user password, stored hashed in the verifier pool of authutil.py, a change revokes the
+            session tokens of the user once it is committed
         """
 
         if name not in (self.name, '', None):
             self.name = name
             # create related activity and insert into database table 'Activity'
             activity = Activity(category=Category.changed_name, user_id=self.user_id)
-            dbutil.insert_into_db(activity)
+            dbutil.log_activity(activity)
 
         if email not in (self.email, '', None):
             self.email = email
             # create related activity and insert into database table 'Activity'
             activity = Activity(category=Category.changed_email, user_id=self.user_id)
-            dbutil.insert_into_db(activity)
-
-        if password not in (self.password, '', None):
-            self.password = password
-            # create related activity and insert into database table 'Activity'
-            activity = Activity(category=Category.changed_password, user_id=self.user_id)
-            dbutil.insert_into_db(activity)
+            dbutil.log_activity(activity)
+
+        if password not in ('', None):
+            from authutil import verifier_pool
+
+            if not verifier_pool.submit(verify_password, password, self.password).result():
+                self.password = verifier_pool.submit(hash_password, password).result()
+                # the sessions opened with the old password are closed, unless the change is rolled back
+                user_id = self.user_id
+                dbutil.after_commit(lambda: tokenutil.token_store.revoke(user_id=user_id))
+                # create related activity and insert into database table 'Activity'
+                activity = Activity(category=Category.changed_password, user_id=self.user_id)
+                dbutil.log_activity(activity)
@@ -1,4 +1,5 @@
 from getpass import getpass
+import authutil
 import dbutil
 from user import User
 
@@ -54,6 +55,12 @@ def user_module(user_id):
                 print("\nUser account is successfully deleted! Exiting the app now...\n")
                 exit()
 
+        elif command == 'logout':
+            # end the session, the next run asks for the credentials again
+            authutil.logout(user_id=user_id)
+            print("\nYou are logged out. Exiting the app now...\n")
+            exit()
+
         elif command == 'list_user_commands':
             print()
             list_user_commands()
@@ -80,4 +87,5 @@ def list_user_commands():
           '-\tdisplay_my_activity',
           '-\tdelete_my_activity',
           '-\tdelete_my_account',
+          '-\tlogout',
           '-\tlist_user_commands', sep='\n')